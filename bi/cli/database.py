@@ -53,9 +53,30 @@ def create_tables():
     if is_db_empty():
         load_extensions(db)
 
-        # To create triggers for searchable models, we need to call configure_mappers().
-        sqlalchemy.orm.configure_mappers()
-        db.create_all()
+    # To create triggers for searchable models, we need to call configure_mappers().
+    sqlalchemy.orm.configure_mappers()
+    # On an existing database this only creates the tables added since it was created.
+    db.create_all()
+
+
+@manager.command()
+def partition_query_results():
+    """Convert query_results to a table partitioned by retrieved_at (PostgreSQL 11+)."""
+    from bi.models import db, query_result_partitions
+
+    _wait_for_db_connection(db)
+
+    if query_result_partitions.is_partitioned():
+        print("query_results is already partitioned.")
+        return
+
+    # Rewrites the whole table while holding an exclusive lock on it.
+    query_result_partitions.convert()
+    print(
+        "Partitioned query_results: {} partitions.".format(
+            len(query_result_partitions.partitions())
+        )
+    )
 
 
 @manager.command()
@@ -1,4 +1,6 @@
-from click import argument
+from click import argument, option
+from funcy import chunks
+from sqlalchemy import bindparam, select
 from flask.cli import AppGroup
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -62,3 +64,161 @@ def remove_tag(query_id, tag):
     models.db.session.commit()
 
     print("Tag removed.")
+
+
+@manager.command()
+@option("--count", default=50000, help="Number of scheduled queries to create.")
+def benchmark_scheduler(count):
+    """
+    Times Query.outdated_queries() against the previous full scan with COUNT temporary
+    scheduled queries. They are created in a transaction that is rolled back afterwards.
+    """
+    import datetime
+    import time
+
+    import pytz
+    from sqlalchemy.orm import joinedload
+    from bi import models, utils
+
+    org = models.Organization.query.first()
+    user = models.User.query.first()
+    data_source = models.DataSource.query.first()
+    if org is None or user is None or data_source is None:
+        print("An organization, a user and a data source are needed.")
+        exit(1)
+
+    # An end date in the future, so both paths parse it like they would for real schedules.
+    until = (utils.utcnow() + datetime.timedelta(days=365)).strftime("%Y-%m-%d")
+    schedule = {"interval": 3600, "time": None, "day_of_week": None, "until": until}
+    started = time.time()
+    queries = [
+        models.Query(
+            org=org,
+            user=user,
+            data_source=data_source,
+            name="Scheduler benchmark {}".format(i),
+            query_text="SELECT {}".format(i),
+            schedule=dict(schedule),
+            is_draft=False,
+        )
+        for i in range(count)
+    ]
+    models.db.session.add_all(queries)
+    models.db.session.flush()
+    query_ids = [q.id for q in queries]
+    # The index is only updated when the session commits, which this never does; add the
+    # queries to it as new ones would be.
+    models.scheduled_queries_index.update({query_id: 0 for query_id in query_ids})
+    print("Created {} scheduled queries in {:.2f}s.".format(count, time.time() - started))
+
+    try:
+        started = time.time()
+        models.Query.outdated_queries()
+        print("First tick, every query re-evaluated: {:.3f}s".format(time.time() - started))
+
+        started = time.time()
+        models.Query.outdated_queries()
+        print("Next tick, nothing due: {:.3f}s".format(time.time() - started))
+
+        # The previous Query.outdated_queries(), minus disabling queries that fail.
+        started = time.time()
+        now = utils.utcnow()
+        all_scheduled = (
+            models.Query.query.options(
+                joinedload(models.Query.latest_query_data).load_only("retrieved_at")
+            )
+            .filter(models.Query.schedule.isnot(None))
+            .order_by(models.Query.id)
+            .all()
+        )
+        models.scheduled_queries_executions.refresh()
+        for query in all_scheduled:
+            if query.schedule.get("disabled"):
+                continue
+
+            if query.schedule["until"]:
+                schedule_until = pytz.utc.localize(
+                    datetime.datetime.strptime(query.schedule["until"], "%Y-%m-%d")
+                )
+                if schedule_until <= now:
+                    continue
+
+            retrieved_at = models.scheduled_queries_executions.get(query.id) or (
+                query.latest_query_data and query.latest_query_data.retrieved_at
+            )
+            models.should_schedule_next(
+                retrieved_at or now,
+                now,
+                query.schedule["interval"],
+                query.schedule["time"],
+                query.schedule["day_of_week"],
+                query.schedule_failures,
+            )
+        print("Full scan of every scheduled query: {:.3f}s".format(time.time() - started))
+    finally:
+        models.db.session.rollback()
+        models.scheduled_queries_index.remove(query_ids)
+
+
+@manager.command()
+@option("--batch-size", default=1000, help="Number of rows updated per transaction.")
+def rehash(batch_size):
+    """
+    Recomputes the hashes of saved queries and stored query results, after the way query
+    texts are hashed changed. Rows that already have the right hash are left alone, so it's
+    safe to run again. Results cached in Redis under the old hashes simply expire.
+    """
+    from bi import models, utils
+
+    def update_hashes(table, changes):
+        # Updated directly rather than through the ORM, so the queries' versions and update
+        # listeners aren't touched.
+        for batch in chunks(batch_size, changes):
+            with models.db.engine.begin() as connection:
+                connection.execute(
+                    table.update()
+                    .where(table.c.id == bindparam("_id"))
+                    .values(query_hash=bindparam("_hash")),
+                    batch,
+                )
+
+    # Loaded once, instead of lazily for every query.
+    query_runners = {
+        data_source.id: data_source.query_runner
+        for data_source in models.DataSource.query
+    }
+    queries = models.Query.__table__
+    rows = models.db.session.execute(
+        select(
+            [
+                queries.c.id,
+                queries.c.data_source_id,
+                queries.c.query,
+                queries.c.options,
+                queries.c.query_hash,
+            ]
+        )
+    )
+    changes = []
+    for row in rows:
+        query_hash = models.Query.compute_query_hash(
+            query_runners.get(row.data_source_id), row.query, row.options
+        )
+        if query_hash != row.query_hash:
+            changes.append({"_id": row.id, "_hash": query_hash})
+    models.db.session.rollback()
+    update_hashes(queries, changes)
+    print("Rehashed {} queries.".format(len(changes)))
+
+    results = models.QueryResult.__table__
+    rows = models.db.session.execute(
+        select([results.c.id, results.c.query_hash, results.c.query_text])
+    )
+    changes = []
+    for row in rows:
+        query_hash = utils.gen_query_hash(row.query_text)
+        if query_hash != row.query_hash:
+            changes.append({"_id": row.id, "_hash": query_hash})
+    models.db.session.rollback()
+    update_hashes(results, changes)
+    print("Rehashed {} query results.".format(len(changes)))
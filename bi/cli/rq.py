@@ -4,7 +4,7 @@ import sys
 import datetime
 from itertools import chain
 
-from click import argument
+from click import argument, option
 from flask.cli import AppGroup
 from rq import Connection
 from rq.worker import WorkerStatus
@@ -12,9 +12,10 @@ from sqlalchemy.orm import configure_mappers
 from supervisor_checks import check_runner
 from supervisor_checks.check_modules import base
 
-from bi import rq_redis_connection
+from bi import rq_redis_connection, settings
 from bi.tasks import (
     Worker,
+    BiSimpleWorker,
     rq_scheduler,
     schedule_periodic_jobs,
     periodic_job_definitions,
@@ -33,7 +34,12 @@ def scheduler():
 
 @manager.command()
 @argument("queues", nargs=-1)
-def worker(queues):
+@option(
+    "--fork/--no-fork",
+    default=None,
+    help="Run each job in a forked work horse (defaults to DEEPBI_RQ_WORKER_FORK_JOBS).",
+)
+def worker(queues, fork):
     # Configure any SQLAlchemy mappers loaded until now so that the mapping configuration
     # will already be available to the forked work horses and they won't need
     # to spend valuable time re-doing that on every fork.
@@ -44,8 +50,12 @@ def worker(queues):
     else:
         queues = chain(*[queue.split(",") for queue in queues])
 
+    if fork is None:
+        fork = settings.RQ_WORKER_FORK_JOBS
+    worker_class = Worker if fork else BiSimpleWorker
+
     with Connection(rq_redis_connection):
-        w = Worker(queues, log_job_description=False, job_monitoring_interval=5)
+        w = worker_class(queues, log_job_description=False, job_monitoring_interval=5)
         w.work()
 
 
@@ -1,7 +1,12 @@
-from flask import jsonify
+import hmac
+
+from flask import Response, jsonify, request
 from flask_login import login_required
 
+from bi import settings
+
 from bi.handlers.api import api
+from bi.metrics import prometheus
 from bi.handlers.base import routes
 from bi.monitor import get_status
 from bi.permissions import require_super_admin
@@ -22,6 +27,26 @@ def status_api():
     return jsonify(status)
 
 
+def metrics_response():
+    return Response(prometheus.render(), mimetype="text/plain; version=0.0.4")
+
+
+@login_required
+@require_super_admin
+def super_admin_metrics():
+    return metrics_response()
+
+
+@routes.route("/metrics")
+def metrics_api():
+    token = settings.METRICS_AUTH_TOKEN
+    authorization = request.headers.get("Authorization", "").encode("utf-8")
+    if token and hmac.compare_digest(authorization, "Bearer {}".format(token).encode("utf-8")):
+        return metrics_response()
+
+    return super_admin_metrics()
+
+
 def init_app(app):
     from bi.handlers import (
         embed,
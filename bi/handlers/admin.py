@@ -1,4 +1,4 @@
-from flask import request
+from flask import abort, request
 from flask_login import login_required, current_user
 
 from bi import models, redis_connection
@@ -9,6 +9,7 @@ from bi.permissions import require_super_admin
 from bi.serializers import QuerySerializer
 from bi.utils import json_loads
 from bi.monitor import rq_status
+from bi.tasks.queries.routing import runtime_estimates
 
 
 @routes.route("/api/admin/queries/outdated", methods=["GET"])
@@ -52,3 +53,74 @@ def queries_rq_status():
     )
 
     return json_response(rq_status())
+
+
+@routes.route("/api/admin/queries/runtime_estimates", methods=["GET"])
+@require_super_admin
+@login_required
+def queries_runtime_estimates():
+    data_source_id = request.args.get("data_source_id", type=int)
+
+    record_event(
+        current_org,
+        current_user._get_current_object(),
+        {"action": "list", "object_type": "runtime_estimates"},
+    )
+
+    return json_response({"estimates": runtime_estimates.all(data_source_id)})
+
+
+@routes.route("/api/admin/queries/slow", methods=["GET"])
+@require_super_admin
+@login_required
+def slow_queries():
+    page = request.args.get("page", 1, type=int)
+    page_size = min(request.args.get("page_size", 25, type=int), 250)
+    total, entries = models.slow_query_log.list(
+        offset=(max(page, 1) - 1) * page_size,
+        limit=page_size,
+        data_source_id=request.args.get("data_source_id", type=int),
+        query_hash=request.args.get("query_hash"),
+    )
+
+    record_event(
+        current_org,
+        current_user._get_current_object(),
+        {"action": "list", "object_type": "slow_queries"},
+    )
+
+    return json_response(
+        {"count": total, "page": page, "page_size": page_size, "results": entries}
+    )
+
+
+@routes.route("/api/admin/queries/slow/<int:entry_id>", methods=["GET"])
+@require_super_admin
+@login_required
+def slow_query(entry_id):
+    entry = models.slow_query_log.get(entry_id)
+    if entry is None:
+        abort(404)
+
+    record_event(
+        current_org,
+        current_user._get_current_object(),
+        {"action": "view", "object_type": "slow_query", "object_id": entry_id},
+    )
+
+    return json_response(entry)
+
+
+@routes.route("/api/admin/queries/worker_time", methods=["GET"])
+@require_super_admin
+@login_required
+def queries_worker_time():
+    limit = min(request.args.get("limit", 100, type=int), 1000)
+
+    record_event(
+        current_org,
+        current_user._get_current_object(),
+        {"action": "list", "object_type": "worker_time"},
+    )
+
+    return json_response(models.slow_query_log.worker_time(limit))
@@ -397,6 +397,7 @@ def client_config():
         "pageSize": settings.PAGE_SIZE,
         "pageSizeOptions": settings.PAGE_SIZE_OPTIONS,
         "tableCellMaxJSONSize": settings.TABLE_CELL_MAX_JSON_SIZE,
+        "jobStatusWait": settings.JOB_EVENTS_MAX_WAIT,
     }
 
     client_config.update(defaults)
@@ -196,6 +196,15 @@ class DataSourceSchemaResource(BaseResource):
         )
         require_access(data_source, self.current_user, view_only)
         refresh = request.args.get("refresh") is not None
+        table_name = request.args.get("table")
+
+        if table_name is not None and not refresh:
+            table = data_source.get_cached_table_schema(table_name)
+            if table is None:
+                abort(404, message="Table not found in the cached schema.")
+
+            table.setdefault("comment", [])
+            return {"table": table}
 
         if not refresh:
             cached_schema = data_source.get_cached_schema()
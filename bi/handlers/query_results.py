@@ -2,11 +2,12 @@ import logging
 import time
 
 import unicodedata
-from flask import make_response, request
+from flask import Response, make_response, request, stream_with_context
 from flask_login import current_user
 from flask_restful import abort
 from werkzeug.urls import url_quote
 from bi import models, settings
+from bi.metrics import prometheus as metrics
 from bi.handlers.base import BaseResource, get_object_or_404, record_event
 from bi.permissions import (
     has_access,
@@ -20,10 +21,14 @@ from bi.tasks import Job
 from bi.tasks.queries import enqueue_query
 from bi.utils import (
     collect_parameters_from_request,
+    gen_legacy_query_hash,
+    gen_query_hash,
+    job_events,
     json_dumps,
     utcnow,
     to_filename,
 )
+from bi.utils.downsampling import downsampled_data
 from bi.models.parameterized_query import (
     ParameterizedQuery,
     InvalidParameterError,
@@ -31,10 +36,12 @@ from bi.models.parameterized_query import (
     dropdown_values,
 )
 from bi.serializers import (
+    JOB_STATUS_FAILED,
+    JOB_STATUS_FINISHED,
     serialize_query_result,
-    serialize_query_result_to_dsv,
-    serialize_query_result_to_xlsx,
     serialize_job,
+    stream_query_result_to_dsv,
+    stream_query_result_to_xlsx,
 )
 
 
@@ -61,7 +68,13 @@ error_messages = {
 
 
 def run_query(
-    query, parameters, data_source, query_id, should_apply_auto_limit, max_age=0
+    query,
+    parameters,
+    data_source,
+    query_id,
+    should_apply_auto_limit,
+    max_age=0,
+    visualization=None,
 ):
     if data_source.paused:
         if data_source.pause_reason:
@@ -107,9 +120,14 @@ def run_query(
     )
 
     if query_result:
+        data = (
+            downsampled_data(query_result, visualization)
+            if visualization is not None
+            else None
+        )
         return {
             "query_result": serialize_query_result(
-                query_result, current_user.is_api_user()
+                query_result, current_user.is_api_user(), data=data
             )
         }
     else:
@@ -128,6 +146,17 @@ def run_query(
         return serialize_job(job)
 
 
+def get_query_visualization(visualization_id, query, org):
+    """Returns the visualization, which has to be one of `query`'s (404 otherwise)."""
+    visualization = get_object_or_404(
+        models.Visualization.get_by_id_and_org, visualization_id, org
+    )
+    if query is None or visualization.query_id != query.id:
+        abort(404, message="Visualization not found.")
+
+    return visualization
+
+
 def get_download_filename(query_result, query, filetype):
     retrieved_at = query_result.retrieved_at.strftime("%Y_%m_%d")
     if query:
@@ -282,6 +311,8 @@ class QueryResultResource(BaseResource):
                                 return them, otherwise execute the query; if omitted or -1, returns
                                 any cached result, or executes if not available. Set to zero to
                                 always execute.
+        :param number visualization_id: When a cached result is returned, downsample its data
+                                        for this visualization of the query (see the GET method).
         """
         params = request.get_json(force=True, silent=True) or {}
         parameter_values = params.get("parameters", {})
@@ -299,6 +330,12 @@ class QueryResultResource(BaseResource):
         allow_executing_with_view_only_permissions = query.parameterized.is_safe
         should_apply_auto_limit = params.get("apply_auto_limit", False)
 
+        visualization = None
+        if params.get("visualization_id") is not None:
+            visualization = get_query_visualization(
+                params["visualization_id"], query, self.current_org
+            )
+
         if has_access(
             query, self.current_user, allow_executing_with_view_only_permissions
         ):
@@ -309,6 +346,7 @@ class QueryResultResource(BaseResource):
                 query_id,
                 should_apply_auto_limit,
                 max_age,
+                visualization,
             )
         else:
             if not query.parameterized.is_safe:
@@ -335,6 +373,13 @@ class QueryResultResource(BaseResource):
         :<json number data_source_id: ID of data source that produced this result
         :<json number runtime: Length of execution time in seconds
         :<json string retrieved_at: Query retrieval date/time, in ISO format
+
+        For JSON results, the `offset` and `limit` query string arguments return only a page
+        of rows and `columns` (comma separated names) only the given columns. The paged
+        `data` also has a `total_rows` count of the whole result.
+
+        With `visualization_id` (a visualization of the query given by `query_id`), the data
+        is downsampled for that chart when its options enable it (see bi.utils.downsampling).
         """
         # TODO:
         # This method handles two cases: retrieving result by id & retrieving result by query id.
@@ -371,7 +416,12 @@ class QueryResultResource(BaseResource):
                 and query_result is not None
                 and self.current_user.is_api_user()
             ):
-                if query.query_hash != query_result.query_hash:
+                # Either side may still have a hash from before the hashing changed.
+                if query.query_hash not in (
+                    query_result.query_hash,
+                    gen_query_hash(query_result.query_text),
+                    gen_legacy_query_hash(query_result.query_text),
+                ):
                     abort(404, message="No cached result found for this query.")
 
         if query_result:
@@ -397,13 +447,25 @@ class QueryResultResource(BaseResource):
 
                 self.record_event(event)
 
-            response_builders = {
-                "json": self.make_json_response,
-                "xlsx": self.make_excel_response,
-                "csv": self.make_csv_response,
-                "tsv": self.make_tsv_response,
-            }
-            response = response_builders[filetype](query_result)
+            page = self.requested_page()
+            visualization_id = request.args.get("visualization_id", type=int)
+            if filetype == "json" and visualization_id is not None:
+                visualization = get_query_visualization(
+                    visualization_id, query, self.current_org
+                )
+                response = self.make_json_visualization_response(
+                    query_result, visualization
+                )
+            elif filetype == "json" and page is not None:
+                response = self.make_json_page_response(query_result, *page)
+            else:
+                response_builders = {
+                    "json": self.make_json_response,
+                    "xlsx": self.make_excel_response,
+                    "csv": self.make_csv_response,
+                    "tsv": self.make_tsv_response,
+                }
+                response = response_builders[filetype](query_result)
 
             if len(settings.ACCESS_CONTROL_ALLOW_ORIGIN) > 0:
                 self.add_cors_headers(response.headers)
@@ -424,23 +486,68 @@ class QueryResultResource(BaseResource):
             abort(404, message="No cached result found for this query.")
 
     @staticmethod
+    @metrics.serialization_time.time(serializer="query_result")
     def make_json_response(query_result):
         data = json_dumps({"query_result": query_result.to_dict()})
         headers = {"Content-Type": "application/json"}
         return make_response(data, 200, headers)
 
+    @staticmethod
+    def requested_page():
+        """Returns (offset, limit, columns) when a page of the result was requested."""
+        if not any(arg in request.args for arg in ("offset", "limit", "columns")):
+            return None
+
+        offset = request.args.get("offset", 0, type=int)
+        limit = request.args.get("limit", type=int)
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, message="offset and limit must be non-negative integers.")
+
+        # Without a limit every row from `offset` on is returned, e.g. for a column subset
+        # of the whole result.
+        if limit is not None:
+            limit = min(limit, settings.QUERY_RESULTS_PAGE_MAX_LIMIT)
+
+        columns = request.args.get("columns")
+        if columns is not None:
+            columns = [name for name in columns.split(",") if name]
+
+        return offset, limit, columns
+
+    @staticmethod
+    @metrics.serialization_time.time(serializer="query_result_page")
+    def make_json_page_response(query_result, offset, limit, columns):
+        page = query_result.data_slice(offset, limit, columns)
+        page["offset"] = offset
+        page["limit"] = limit
+        data = json_dumps({"query_result": query_result.to_dict(data=page)})
+        headers = {"Content-Type": "application/json"}
+        return make_response(data, 200, headers)
+
+    @staticmethod
+    @metrics.serialization_time.time(serializer="query_result_visualization")
+    def make_json_visualization_response(query_result, visualization):
+        data = downsampled_data(query_result, visualization)
+        data = json_dumps({"query_result": query_result.to_dict(data=data)})
+        headers = {"Content-Type": "application/json"}
+        return make_response(data, 200, headers)
+
     @staticmethod
     def make_csv_response(query_result):
         headers = {"Content-Type": "text/csv; charset=UTF-8"}
-        return make_response(
-            serialize_query_result_to_dsv(query_result, ","), 200, headers
+        return Response(
+            stream_with_context(stream_query_result_to_dsv(query_result, ",")),
+            200,
+            headers,
         )
 
     @staticmethod
     def make_tsv_response(query_result):
         headers = {"Content-Type": "text/tab-separated-values; charset=UTF-8"}
-        return make_response(
-            serialize_query_result_to_dsv(query_result, "\t"), 200, headers
+        return Response(
+            stream_with_context(stream_query_result_to_dsv(query_result, "\t")),
+            200,
+            headers,
         )
 
     @staticmethod
@@ -448,16 +555,38 @@ class QueryResultResource(BaseResource):
         headers = {
             "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         }
-        return make_response(serialize_query_result_to_xlsx(query_result), 200, headers)
+        return Response(stream_query_result_to_xlsx(query_result), 200, headers)
 
 
 class JobResource(BaseResource):
     def get(self, job_id, query_id=None):
         """
         Retrieve info about a running query job.
+
+        :qparam number wait: Seconds to hold the request until the job's status differs from
+            `status` (or from its status when the request came in), instead of polling
+        :qparam number status: The job status the client last saw
         """
-        job = Job.fetch(job_id)
-        return serialize_job(job)
+        wait = min(request.args.get("wait", 0, type=float), settings.JOB_EVENTS_MAX_WAIT)
+        if wait <= 0:
+            return serialize_job(Job.fetch(job_id))
+
+        deadline = time.time() + wait
+        known_status = request.args.get("status", type=int)
+        # Subscribed before reading the job, so a change in between isn't missed.
+        with job_events.subscription(job_id) as pubsub:
+            while True:
+                serialized = serialize_job(Job.fetch(job_id))
+                status = serialized["job"]["status"]
+                if known_status is None:
+                    known_status = status
+
+                remaining = deadline - time.time()
+                if status != known_status or status in (JOB_STATUS_FINISHED, JOB_STATUS_FAILED) or remaining <= 0:
+                    return serialized
+
+                if job_events.next_event(pubsub, remaining) is None:
+                    return serialize_job(Job.fetch(job_id))
 
     def delete(self, job_id):
         """
@@ -58,3 +58,11 @@ def after_execute(conn, elt, multiparams, params, result):
         g.queries_duration += duration
 
     return result
+
+
+def request_query_stats():
+    """Returns the number of SQL statements run in the current request and their total duration."""
+    if not has_request_context():
+        return 0, 0.0
+
+    return g.get("queries_count", 0), g.get("queries_duration", 0.0)
@@ -0,0 +1,294 @@
+"""
+Counters and histograms shared by every web and worker process, exposed on /metrics in the
+Prometheus text format.
+
+Observations are added to one Redis hash per metric, so a scrape of any web process sees the
+totals of all of them, including the RQ workers'. Histogram buckets are stored as plain counts
+and made cumulative when rendered. Values computed at scrape time, such as queue depths, are
+registered as collectors.
+
+Increments are buffered in the process and written in a single pipeline at most every
+METRICS_FLUSH_INTERVAL seconds, after each API request and at the end of every RQ job.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+
+from bi import redis_connection, settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "metrics"
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 50000, 100000, 500000, 1000000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 52428800, 104857600, 524288000)
+
+metrics = []
+collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    return ",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values))
+
+
+def _braces(labels):
+    return "{" + labels + "}" if labels else ""
+
+
+class _Buffer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed_at = time.time()
+
+    def add(self, key, increments):
+        with self._lock:
+            fields = self._pending.setdefault(key, {})
+            for field, amount in increments:
+                fields[field] = fields.get(field, 0) + amount
+
+    def is_due(self):
+        return time.time() - self._flushed_at >= settings.METRICS_FLUSH_INTERVAL
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.time()
+
+        if not pending:
+            return
+
+        try:
+            pipe = redis_connection.pipeline(transaction=False)
+            for key, fields in pending.items():
+                for field, amount in fields.items():
+                    pipe.hincrbyfloat(key, field, amount)
+            pipe.execute()
+        except Exception:
+            # Metrics are never worth failing the work they measure.
+            logger.exception("Failed writing %d metrics", len(pending))
+
+    def discard(self):
+        """Drops increments inherited from the parent process, which flushes them itself."""
+        # Another thread may have held the lock when the process forked.
+        self._lock = threading.Lock()
+        self._pending = {}
+
+
+_buffer = _Buffer()
+
+
+def flush():
+    """Writes the buffered increments to Redis."""
+    _buffer.flush()
+
+
+def flush_if_due():
+    if _buffer.is_due():
+        _buffer.flush()
+
+
+atexit.register(flush)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_buffer.discard)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = "{}_{}".format(settings.METRICS_PREFIX, name)
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.key = "{}:{}".format(KEY_PREFIX, self.name)
+        metrics.append(self)
+
+    def _labels(self, labels):
+        return _format_labels(self.labelnames, [labels.get(name, "") for name in self.labelnames])
+
+    def _header(self):
+        return [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+
+    def _write(self, increments):
+        if not settings.METRICS_ENABLED:
+            return
+
+        _buffer.add(self.key, increments)
+        flush_if_due()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._write([(self._labels(labels), amount)])
+
+    def render(self, values):
+        lines = self._header()
+        for labels, value in sorted(values.items()):
+            lines.append("{}{} {}".format(self.name, _braces(labels), value))
+        return lines
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started_at, **self.labels)
+        return False
+
+    def _recreate_cm(self):
+        # A fresh timer per call, so decorated functions can run concurrently.
+        return _Timer(self.histogram, self.labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        labels = self._labels(labels)
+        bucket = next((b for b in self.buckets if value <= b), "+Inf")
+        self._write(
+            [
+                ("{}|{}".format(labels, bucket), 1),
+                ("{}|sum".format(labels), value),
+                ("{}|count".format(labels), 1),
+            ]
+        )
+
+    def time(self, **labels):
+        """Observes the seconds spent in a `with` block or decorated function."""
+        return _Timer(self, labels)
+
+    def render(self, values):
+        series = {}
+        for field, value in values.items():
+            labels, _, suffix = field.rpartition("|")
+            series.setdefault(labels, {})[suffix] = float(value)
+
+        lines = self._header()
+        for labels in sorted(series):
+            observed = series[labels]
+            cumulative = 0
+            for bucket in self.buckets:
+                cumulative += observed.get(str(bucket), 0)
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name, _braces(_join(labels, 'le="{}"'.format(bucket))), cumulative
+                    )
+                )
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name, _braces(_join(labels, 'le="+Inf"')), observed.get("count", 0)
+                )
+            )
+            lines.append("{}_sum{} {}".format(self.name, _braces(labels), observed.get("sum", 0)))
+            lines.append(
+                "{}_count{} {}".format(self.name, _braces(labels), observed.get("count", 0))
+            )
+        return lines
+
+
+def _join(*labels):
+    return ",".join(label for label in labels if label)
+
+
+def collector(name, documentation, labelnames=(), type="gauge"):
+    """
+    Registers a function returning the current values of a gauge (or of a counter kept
+    elsewhere) as (label values, value) pairs, called on every scrape.
+    """
+
+    def register(fn):
+        collectors.append(
+            (
+                "{}_{}".format(settings.METRICS_PREFIX, name),
+                documentation,
+                tuple(labelnames),
+                type,
+                fn,
+            )
+        )
+        return fn
+
+    return register
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    pipe = redis_connection.pipeline(transaction=False)
+    for metric in metrics:
+        pipe.hgetall(metric.key)
+
+    lines = []
+    for metric, values in zip(metrics, pipe.execute()):
+        lines.extend(metric.render(values))
+
+    for name, documentation, labelnames, type, fn in collectors:
+        lines.append("# HELP {} {}".format(name, documentation))
+        lines.append("# TYPE {} {}".format(name, type))
+        try:
+            samples = fn()
+        except Exception:
+            logger.exception("Failed collecting metric %s", name)
+            continue
+        for values, value in samples:
+            lines.append(
+                "{}{} {}".format(name, _braces(_format_labels(labelnames, values)), value)
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+# Recorded by the query execution pipeline (see bi.tasks.queries.execution and bi.tasks.worker).
+jobs_enqueued = Counter(
+    "query_jobs_enqueued_total",
+    "Query executions requested, by whether a new job was created or a running one reused.",
+    ["data_source_id", "outcome"],
+)
+enqueue_time = Histogram("enqueue_seconds", "Time spent enqueuing query jobs.")
+queue_wait_time = Histogram(
+    "job_queue_wait_seconds", "Time jobs spent queued before a worker started them.", ["queue"]
+)
+job_time = Histogram(
+    "job_duration_seconds", "Time workers spent running jobs.", ["queue", "status"]
+)
+query_time = Histogram(
+    "query_execution_seconds",
+    "Time spent running queries against their data source.",
+    ["data_source_id", "type", "status"],
+)
+result_rows = Histogram(
+    "query_result_rows", "Rows of query results.", ["data_source_id"], buckets=ROW_BUCKETS
+)
+result_bytes = Histogram(
+    "query_result_bytes",
+    "Size of query results as returned by the data source.",
+    ["data_source_id"],
+    buckets=BYTE_BUCKETS,
+)
+# Recorded by the serializers and API handlers.
+serialization_time = Histogram(
+    "serialization_seconds", "Time spent serializing API responses.", ["serializer"]
+)
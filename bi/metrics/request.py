@@ -5,6 +5,8 @@ from collections import namedtuple
 from flask import g, request
 
 from bi import statsd_client
+from bi.metrics import prometheus
+from bi.metrics.database import request_query_stats
 
 metrics_logger = logging.getLogger("metrics")
 
@@ -18,8 +20,7 @@ def calculate_metrics(response):
         return response
 
     request_duration = (time.time() - g.start_time) * 1000
-    queries_duration = g.get("queries_duration", 0.0)
-    queries_count = g.get("queries_count", 0.0)
+    queries_count, queries_duration = request_query_stats()
     endpoint = (request.endpoint or "unknown").replace(".", "_")
 
     metrics_logger.info(
@@ -38,6 +39,9 @@ def calculate_metrics(response):
     statsd_client.timing(
         "requests.{}.{}".format(endpoint, request.method.lower()), request_duration
     )
+    statsd_client.timing(
+        "requests.{}.{}.queries".format(endpoint, request.method.lower()), queries_count
+    )
 
     return response
 
@@ -52,7 +56,12 @@ def calculate_metrics_on_exception(error):
         calculate_metrics(MockResponse(500, "?", -1))
 
 
+def flush_metrics(error):
+    prometheus.flush_if_due()
+
+
 def init_app(app):
     app.before_request(record_request_start_time)
     app.after_request(calculate_metrics)
     app.teardown_request(calculate_metrics_on_exception)
+    app.teardown_request(flush_metrics)
@@ -1,15 +1,25 @@
 import datetime
 import calendar
+import hashlib
 import logging
 import time
 import numbers
 import pytz
 
-from sqlalchemy import distinct, or_, and_, UniqueConstraint, cast
+from funcy import chunks
+from sqlalchemy import distinct, or_, and_, UniqueConstraint, cast, select
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, contains_eager, joinedload, subqueryload, load_only
+from sqlalchemy.orm import (
+    Session,
+    backref,
+    contains_eager,
+    joinedload,
+    load_only,
+    object_session,
+    subqueryload,
+)
 from sqlalchemy.orm.exc import NoResultFound  # noqa: F401
 from sqlalchemy import func
 from sqlalchemy_utils import generic_relationship
@@ -31,6 +41,8 @@ from bi.query_runner import (
     TYPE_DATE,
     TYPE_DATETIME,
     BaseQueryRunner)
+from bi.query_runner.pool import pools as query_runner_pools
+from bi.utils import columnar
 from bi.utils import (
     generate_token,
     json_dumps,
@@ -38,7 +50,9 @@ from bi.utils import (
     mustache_render,
     base_url,
     sentry,
-    gen_query_hash)
+    gen_query_hash,
+    gen_legacy_query_hash,
+)
 from bi.utils.configuration import ConfigurationContainer
 from bi.models.parameterized_query import ParameterizedQuery
 
@@ -46,6 +60,11 @@ from .base import db, gfk_type, Column, GFKBase, SearchBaseQuery, key_type, prim
 from .changes import ChangeTrackingMixin, Change  # noqa
 from .mixins import BelongsToOrgMixin, TimestampMixin
 from .organizations import Organization
+from .dashboard_cache import dashboard_cache
+from .partitions import query_result_partitions
+from .result_cache import query_result_cache
+from .schema_cache import schema_cache, table_fingerprint
+from .slow_query_log import slow_query_log, slow_query_threshold
 from .types import (
     EncryptedConfiguration,
     Configuration,
@@ -65,8 +84,18 @@ class ScheduledQueriesExecutions(object):
     def __init__(self):
         self.executions = {}
 
-    def refresh(self):
-        self.executions = redis_connection.hgetall(self.KEY_NAME)
+    def refresh(self, query_ids=None):
+        if query_ids is None:
+            self.executions = redis_connection.hgetall(self.KEY_NAME)
+        elif query_ids:
+            timestamps = redis_connection.hmget(self.KEY_NAME, query_ids)
+            self.executions = {
+                str(query_id): timestamp
+                for query_id, timestamp in zip(query_ids, timestamps)
+                if timestamp is not None
+            }
+        else:
+            self.executions = {}
 
     def update(self, query_id):
         redis_connection.hmset(self.KEY_NAME, {query_id: time.time()})
@@ -82,6 +111,61 @@ class ScheduledQueriesExecutions(object):
 scheduled_queries_executions = ScheduledQueriesExecutions()
 
 
+class ScheduledQueriesIndex(object):
+    """
+    Sorted set of scheduled query ids scored by the timestamp at which each one is next
+    due, so refresh_queries only has to load the queries that are due.
+
+    Editing a query (including its schedule, failures and latest result) resets its score
+    to 0, which makes the next tick re-evaluate it and store its real next run. Due queries
+    keep their score until they've run and are re-evaluated every tick, like before. Queries
+    that are disabled or past their end date are parked at +inf until they're edited.
+    """
+
+    KEY_NAME = "sq:next_run"
+
+    def touch(self, query_id):
+        redis_connection.zadd(self.KEY_NAME, {query_id: 0})
+
+    def remove(self, query_ids):
+        if query_ids:
+            redis_connection.zrem(self.KEY_NAME, *query_ids)
+
+    def update(self, next_runs, parked_ids=(), removed_ids=()):
+        pipe = redis_connection.pipeline()
+        if next_runs:
+            pipe.zadd(self.KEY_NAME, next_runs)
+        if parked_ids:
+            pipe.zadd(self.KEY_NAME, {query_id: "+inf" for query_id in parked_ids})
+        if removed_ids:
+            pipe.zrem(self.KEY_NAME, *removed_ids)
+        pipe.execute()
+
+    def rebuild(self):
+        query_ids = [
+            query_id
+            for query_id, in db.session.query(Query.id).filter(Query.schedule.isnot(None))
+        ]
+        pipe = redis_connection.pipeline()
+        for chunk in chunks(1000, query_ids):
+            pipe.zadd(self.KEY_NAME, {query_id: 0 for query_id in chunk}, nx=True)
+        pipe.execute()
+
+    def due(self, now):
+        if not redis_connection.exists(self.KEY_NAME):
+            self.rebuild()
+
+        return [
+            int(query_id)
+            for query_id in redis_connection.zrangebyscore(
+                self.KEY_NAME, "-inf", now.timestamp()
+            )
+        ]
+
+
+scheduled_queries_index = ScheduledQueriesIndex()
+
+
 @generic_repr("id", "name", "type", "org_id", "created_at")
 class DataSource(BelongsToOrgMixin, db.Model):
     id = primary_key("DataSource")
@@ -185,17 +269,19 @@ class DataSource(BelongsToOrgMixin, db.Model):
         Query.query.filter(Query.data_source == self).update(
             dict(data_source_id=None, latest_query_data_id=None)
         )
-        QueryResult.query.filter(QueryResult.data_source == self).delete()
+        QueryResult.delete_results(QueryResult.data_source_id == self.id)
         res = db.session.delete(self)
         db.session.commit()
 
-        redis_connection.delete(self._schema_key)
+        schema_cache.delete(self.id)
 
         return res
 
     def get_cached_schema(self):
-        cache = redis_connection.get(self._schema_key)
-        return json_loads(cache) if cache else None
+        return schema_cache.get(self.id)
+
+    def get_cached_table_schema(self, table_name):
+        return schema_cache.get_table(self.id, table_name)
 
     def get_schema(self, refresh=False):
         out_schema = None
@@ -203,43 +289,87 @@ class DataSource(BelongsToOrgMixin, db.Model):
             out_schema = self.get_cached_schema()
 
         if out_schema is None:
-            query_runner = self.query_runner
-            schema = query_runner.get_schema(get_stats=refresh)
+            self._refresh_schema(get_stats=refresh)
+            out_schema = self.get_cached_schema()
+
+        return out_schema
+
+    def _refresh_schema(self, get_stats=False):
+        """
+        Fetches the tables whose fingerprint changed since the last refresh and rewrites only
+        those in the schema cache. Runners that can't fingerprint tables without fetching
+        them get a full fetch, but unchanged tables are still not rewritten.
+        """
+        query_runner = self.query_runner
+        cached_fingerprints = schema_cache.fingerprints(self.id)
+        fingerprints = None
+
+        if not (get_stats and settings.SCHEMA_RUN_TABLE_SIZE_CALCULATIONS):
+            fingerprints = query_runner.get_table_fingerprints()
+
+        if fingerprints is not None:
+            changed = [
+                name
+                for name, fingerprint in fingerprints.items()
+                if cached_fingerprints.get(name) != fingerprint
+            ]
+            schema = []
+            for names in chunks(settings.SCHEMA_REFRESH_BATCH_SIZE, changed):
+                schema.extend(query_runner.get_tables_schema(names))
+        else:
+            schema = query_runner.get_schema(get_stats=get_stats)
 
+        tables = []
+        for table in schema:
             try:
-                out_schema = self._sort_schema(schema)
+                table = self._sort_table(table)
             except Exception:
                 logging.exception(
                     "Error sorting schema columns for data_source {}".format(self.id)
                 )
-                out_schema = schema
-            finally:
-                redis_connection.set(self._schema_key, json_dumps(out_schema))
-
-        return out_schema
+            tables.append(table)
+
+        if fingerprints is None:
+            fingerprints = {table["name"]: table_fingerprint(table) for table in tables}
+            changed = [
+                name
+                for name, fingerprint in fingerprints.items()
+                if cached_fingerprints.get(name) != fingerprint
+            ]
+            changed_names = set(changed)
+            tables = [table for table in tables if table["name"] in changed_names]
+
+        removed = [name for name in cached_fingerprints if name not in fingerprints]
+        # Only tables that were actually fetched get a fingerprint, so the ones a runner
+        # fingerprints but can't fetch are tried again next time instead of passing as current.
+        fetched = set(table["name"] for table in tables)
+        fingerprints = {name: fingerprints[name] for name in changed if name in fetched}
+        schema_cache.update(self.id, tables, fingerprints, removed)
+
+        logger.info(
+            "Refreshed schema of data source %s: %d tables rewritten, %d removed.",
+            self.id,
+            len(tables),
+            len(removed),
+        )
 
-    def _sort_schema(self, schema):
-        result = []
-        for i in sorted(schema, key=lambda x: x["name"]):
-            if 'comment' in i:
-                combined = list(zip(i['columns'], i['comment']))
-                combined.sort()
-                i['columns'], i['comment'] = zip(*combined)
-                result.append({
-                    "name": i["name"],
-                    "columns": i['columns'],
-                    "comment": i['comment']
-                })
-            else:
-                result.append({
-                    "name": i["name"],
-                    "columns": sorted(i["columns"], key=lambda x: x["name"] if isinstance(x, dict) else x),
-                })
-        return result
+    @staticmethod
+    def _sort_table(table):
+        if "comment" in table:
+            combined = sorted(zip(table["columns"], table["comment"]))
+            columns, comments = zip(*combined) if combined else ((), ())
+            return {
+                "name": table["name"],
+                "columns": list(columns),
+                "comment": list(comments),
+            }
 
-    @property
-    def _schema_key(self):
-        return "data_source:schema:{}".format(self.id)
+        return {
+            "name": table["name"],
+            "columns": sorted(
+                table["columns"], key=lambda x: x["name"] if isinstance(x, dict) else x
+            ),
+        }
 
     @property
     def _pause_key(self):
@@ -288,6 +418,9 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
         if self.uses_ssh_tunnel:
             query_runner = with_ssh_tunnel(query_runner, self.options.get("ssh_tunnel"))
+        elif query_runner is not None:
+            # Tunnels are opened per query, so only direct connections are pooled.
+            query_runner.data_source_id = self.id
 
         return query_runner
 
@@ -336,11 +469,126 @@ class DBPersistence(object):
         self._data = data
 
 
+class ColumnarPersistence(DBPersistence):
+    """
+    Stores QueryResult data in the compressed columnar format (see bi.utils.columnar).
+    Results stored as legacy row JSON are still read transparently.
+    """
+
+    @property
+    def data(self):
+        if self._data is None:
+            return None
+
+        if not hasattr(self, DESERIALIZED_DATA_ATTR):
+            setattr(self, DESERIALIZED_DATA_ATTR, columnar.loads(self._data))
+
+        return self._deserialized_data
+
+    @data.setter
+    def data(self, data):
+        if hasattr(self, DESERIALIZED_DATA_ATTR):
+            delattr(self, DESERIALIZED_DATA_ATTR)
+
+        if data is None or columnar.is_columnar(data) or len(data) < settings.QUERY_RESULTS_COLUMNAR_MIN_SIZE:
+            self._data = data
+            return
+
+        deserialized = json_loads(data)
+        body = columnar.to_columns(deserialized)
+        if body is None:
+            self._data = data
+        else:
+            self._data = columnar.dump_body(body, settings.QUERY_RESULTS_COMPRESSION)
+
+        # We already paid for parsing the payload, keep it for readers in this process.
+        setattr(self, DESERIALIZED_DATA_ATTR, deserialized)
+
+
+if settings.QUERY_RESULTS_STORAGE_FORMAT == "columnar":
+    _default_persistence = ColumnarPersistence
+else:
+    _default_persistence = DBPersistence
+
 QueryResultPersistence = (
-    settings.dynamic_settings.QueryResultPersistence or DBPersistence
+    settings.dynamic_settings.QueryResultPersistence or _default_persistence
 )
 
 
+BLOB_REF_PREFIX = "blob:"
+
+
+@generic_repr("id", "org_id", "content_hash", "refcount")
+class QueryResultBlob(db.Model, QueryResultPersistence):
+    """
+    A result payload shared by all of an organization's query results with the same
+    content. `refcount` is the number of QueryResult rows referencing it; the blob is
+    deleted when it drops to zero.
+    """
+
+    id = primary_key("QueryResultBlob")
+    org_id = Column(key_type("Organization"), db.ForeignKey("organizations.id"))
+    content_hash = Column(db.String(64), nullable=False)
+    _data = Column("data", db.Text)
+    refcount = Column(db.Integer, default=0, nullable=False)
+    created_at = Column(db.DateTime(True), default=db.func.now())
+
+    __tablename__ = "query_result_blobs"
+    __table_args__ = (UniqueConstraint("org_id", "content_hash"),)
+
+    _table_exists = None
+
+    @classmethod
+    def available(cls):
+        """Whether the table exists, as databases created before it need `create_tables` to be run."""
+        if cls._table_exists is None:
+            cls._table_exists = db.engine.has_table(cls.__tablename__)
+
+        return cls._table_exists
+
+    @staticmethod
+    def content_hash_for(data):
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def acquire(cls, org_id, content_hash, data):
+        """Adds a reference to the blob for `content_hash`, creating it from `data` if needed."""
+        updated = cls.query.filter(
+            cls.org_id == org_id, cls.content_hash == content_hash
+        ).update({cls.refcount: cls.refcount + 1}, synchronize_session=False)
+
+        if updated:
+            return
+
+        # Encode through the configured persistence, then insert; a concurrent writer may
+        # have created the blob in the meantime.
+        encoded = cls(data=data)._data
+        insert = postgresql.insert(cls.__table__).values(
+            org_id=org_id, content_hash=content_hash, data=encoded, refcount=1
+        )
+        db.session.execute(
+            insert.on_conflict_do_update(
+                index_elements=["org_id", "content_hash"],
+                set_={"refcount": cls.__table__.c.refcount + 1},
+            )
+        )
+
+    @classmethod
+    def release(cls, refs):
+        """
+        Drops references to blobs. `refs` is a list of (org_id, blob ref, count) tuples, as
+        returned by QueryResult.delete_results.
+        """
+        for org_id, ref, count in refs:
+            content_hash = ref[len(BLOB_REF_PREFIX):]
+            cls.query.filter(
+                cls.org_id == org_id, cls.content_hash == content_hash
+            ).update({cls.refcount: cls.refcount - count}, synchronize_session=False)
+
+        if refs:
+            cls.query.filter(cls.refcount <= 0).delete(synchronize_session=False)
+
+
 @generic_repr("id", "org_id", "data_source_id", "query_hash", "runtime", "retrieved_at")
 class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
     id = primary_key("QueryResult")
@@ -356,20 +604,121 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
 
     __tablename__ = "query_results"
 
+    # Set by store_result when the new result is identical to the previous one.
+    unchanged = False
+
     def __str__(self):
         return "%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
-    def to_dict(self):
+    @property
+    def blob(self):
+        """The shared payload this result references, when it was stored deduplicated."""
+        if not (self._data and self._data.startswith(BLOB_REF_PREFIX)):
+            return None
+
+        if not hasattr(self, "_blob"):
+            self._blob = QueryResultBlob.query.filter(
+                QueryResultBlob.org_id == self.org_id,
+                QueryResultBlob.content_hash == self._data[len(BLOB_REF_PREFIX):],
+            ).first()
+
+        return self._blob
+
+    @property
+    def payload(self):
+        """The stored (possibly compressed) payload, with shared blobs resolved."""
+        blob = self.blob
+        return blob._data if blob is not None else self._data
+
+    @property
+    def data(self):
+        blob = self.blob
+        if blob is not None:
+            return blob.data
+
+        return QueryResultPersistence.data.fget(self)
+
+    @data.setter
+    def data(self, data):
+        QueryResultPersistence.data.fset(self, data)
+
+    def to_dict(self, data=None):
         return {
             "id": self.id,
             "query_hash": self.query_hash,
             "query": self.query_text,
-            "data": self.data,
+            "data": self.data if data is None else data,
             "data_source_id": self.data_source_id,
             "runtime": self.runtime,
             "retrieved_at": self.retrieved_at,
         }
 
+    def columns_and_rows(self):
+        """
+        Returns the result's columns and an iterator over its rows as value sequences in
+        column order. Columnar payloads are read straight from their column lists, without
+        building a dict per row.
+        """
+        payload = self.payload
+        if not hasattr(self, DESERIALIZED_DATA_ATTR) and columnar.is_columnar(payload):
+            body = columnar.load_body(payload)
+            columns = body["columns"]
+            if columns:
+                return columns, zip(*body["values"])
+            return columns, iter([()] * body["length"])
+
+        data = self.data
+        columns = data["columns"] or []
+        names = [column["name"] for column in columns]
+        return columns, ([row.get(name) for name in names] for row in data["rows"])
+
+    def columnar_body(self):
+        """
+        Returns the result as a columnar body (see bi.utils.columnar): its columns, row count,
+        a list of values per column and its other fields. Columnar payloads are returned as
+        stored, without building a dict per row.
+        """
+        payload = self.payload
+        if not hasattr(self, DESERIALIZED_DATA_ATTR) and columnar.is_columnar(payload):
+            return columnar.load_body(payload)
+
+        data = self.data
+        columns = data["columns"] or []
+        rows = data["rows"] or []
+        return {
+            "columns": columns,
+            "length": len(rows),
+            "values": [[row.get(column["name"]) for row in rows] for column in columns],
+            "extra": {k: v for k, v in data.items() if k not in ("columns", "rows")},
+        }
+
+    def data_slice(self, offset=0, limit=None, columns=None):
+        """
+        Returns `limit` rows of the result starting at `offset`, with only the named
+        `columns` (all when None), plus the result's total row count. Columnar payloads
+        only build the requested rows.
+        """
+        names = set(columns) if columns is not None else None
+        payload = self.payload
+        if not hasattr(self, DESERIALIZED_DATA_ATTR) and columnar.is_columnar(payload):
+            return columnar.slice_payload(payload, offset, limit, names)
+
+        data = self.data
+        end = None if limit is None else offset + limit
+        rows = data["rows"] or []
+        sliced = dict(data)
+        sliced["columns"] = [
+            column
+            for column in data["columns"] or []
+            if names is None or column["name"] in names
+        ]
+        sliced["rows"] = [
+            row if names is None else {k: v for k, v in row.items() if k in names}
+            for row in rows[offset:end]
+        ]
+        sliced["total_rows"] = len(rows)
+        return sliced
+
     @classmethod
     def unused(cls, days=7):
         age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
@@ -382,14 +731,20 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
     @classmethod
     def get_latest(cls, data_source, query, max_age=0):
         query_hash = gen_query_hash(query)
+        # Results stored before the hashing changed are found by their legacy hash.
+        query_hashes = [query_hash, gen_legacy_query_hash(query)]
+
+        cached = query_result_cache.get(data_source.id, query_hash, max_age)
+        if cached is not None:
+            return cls.from_cache(cached)
 
         if max_age == -1:
             query = cls.query.filter(
-                cls.query_hash == query_hash, cls.data_source == data_source
+                cls.query_hash.in_(query_hashes), cls.data_source == data_source
             )
         else:
             query = cls.query.filter(
-                cls.query_hash == query_hash,
+                cls.query_hash.in_(query_hashes),
                 cls.data_source == data_source,
                 (
                     db.func.timezone("utc", cls.retrieved_at)
@@ -398,11 +753,90 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
                 ),
             )
 
-        return query.order_by(cls.retrieved_at.desc()).first()
+        query_result = query.order_by(cls.retrieved_at.desc()).first()
+        if query_result is not None:
+            query_result_cache.set(query_result, query_hash)
+
+        return query_result
+
+    @classmethod
+    def from_cache(cls, entry):
+        """
+        Builds a detached QueryResult from a cache entry. It is never added to the session, so
+        only read it.
+        """
+        return cls(
+            id=int(entry["id"]),
+            org_id=int(entry["org_id"]),
+            data_source_id=int(entry["data_source_id"]),
+            query_hash=entry["query_hash"],
+            query_text=entry["query_text"],
+            runtime=entry["runtime"],
+            retrieved_at=entry["retrieved_at"],
+            _data=entry["data"],
+        )
+
+    @classmethod
+    def delete_results(cls, *criterion):
+        """
+        Deletes the results matching `criterion` and releases the blobs they reference.
+        Returns the number of deleted results.
+        """
+        refs = (
+            db.session.query(cls.org_id, cls._data, func.count())
+            .filter(cls._data.startswith(BLOB_REF_PREFIX), *criterion)
+            .group_by(cls.org_id, cls._data)
+            .all()
+        )
+        deleted_count = cls.query.filter(*criterion).delete(synchronize_session=False)
+        QueryResultBlob.release(refs)
+
+        return deleted_count
 
     @classmethod
     def store_result(
         cls, org, data_source, query_hash, query, data, run_time, retrieved_at
+    ):
+        if (
+            not settings.QUERY_RESULTS_DEDUP_ENABLED
+            or not isinstance(data, str)
+            or not QueryResultBlob.available()
+        ):
+            return cls._store_result(
+                org, data_source, query_hash, query, data, run_time, retrieved_at
+            )
+
+        content_hash = QueryResultBlob.content_hash_for(data)
+        ref = BLOB_REF_PREFIX + content_hash
+
+        latest = (
+            db.session.query(cls.id, cls._data == ref)
+            .filter(cls.query_hash == query_hash, cls.data_source == data_source)
+            .order_by(cls.retrieved_at.desc())
+            .first()
+        )
+
+        if latest is not None and latest[1]:
+            # Same content as the previous run: only record when it was retrieved.
+            query_result = cls.query.get(latest[0])
+            query_result.runtime = run_time
+            query_result.retrieved_at = retrieved_at
+            query_result.unchanged = True
+            db.session.add(query_result)
+            query_result_cache.invalidate(data_source.id, query_hash)
+            logging.info("Query (%s) result unchanged; id=%s", query_hash, query_result.id)
+
+            return query_result
+
+        QueryResultBlob.acquire(org, content_hash, data)
+
+        return cls._store_result(
+            org, data_source, query_hash, query, None, run_time, retrieved_at, blob_ref=ref
+        )
+
+    @classmethod
+    def _store_result(
+        cls, org, data_source, query_hash, query, data, run_time, retrieved_at, blob_ref=None
     ):
         query_result = cls(
             org_id=org,
@@ -411,10 +845,14 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
             runtime=run_time,
             data_source=data_source,
             retrieved_at=retrieved_at,
-            data=data,
         )
+        if blob_ref is not None:
+            query_result._data = blob_ref
+        else:
+            query_result.data = data
 
         db.session.add(query_result)
+        query_result_cache.invalidate(data_source.id, query_hash)
         logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
 
         return query_result
@@ -427,6 +865,19 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
 def should_schedule_next(
     previous_iteration, now, interval, time=None, day_of_week=None, failures=0
 ):
+    next_iteration = next_scheduled_run(
+        previous_iteration, interval, time, day_of_week, failures
+    )
+    return next_iteration is not None and now > next_iteration
+
+
+def next_scheduled_run(
+    previous_iteration, interval, time=None, day_of_week=None, failures=0
+):
+    """
+    Returns when a query that last ran at `previous_iteration` is due next, or None if
+    its backoff after `failures` failures overflows.
+    """
     # if time exists then interval > 23 hours (82800s)
     # if day_of_week exists then interval > 6 days (518400s)
     if time is None:
@@ -467,8 +918,8 @@ def should_schedule_next(
         try:
             next_iteration += datetime.timedelta(minutes=2 ** failures)
         except OverflowError:
-            return False
-    return now > next_iteration
+            return None
+    return next_iteration
 
 
 @gfk_type
@@ -655,22 +1106,30 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
     @classmethod
     def outdated_queries(cls):
+        now = utils.utcnow()
+        due_ids = scheduled_queries_index.due(now)
+        if not due_ids:
+            return []
+
         queries = (
             Query.query.options(
                 joinedload(Query.latest_query_data).load_only("retrieved_at")
             )
-                .filter(Query.schedule.isnot(None))
+                .filter(Query.id.in_(due_ids), Query.schedule.isnot(None))
                 .order_by(Query.id)
                 .all()
         )
 
-        now = utils.utcnow()
         outdated_queries = {}
-        scheduled_queries_executions.refresh()
+        next_runs = {}
+        parked_ids = []
+        removed_ids = set(due_ids) - {query.id for query in queries}
+        scheduled_queries_executions.refresh(due_ids)
 
         for query in queries:
             try:
                 if query.schedule.get("disabled"):
+                    parked_ids.append(query.id)
                     continue
 
                 if query.schedule["until"]:
@@ -679,22 +1138,28 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                     )
 
                     if schedule_until <= now:
+                        parked_ids.append(query.id)
                         continue
 
                 retrieved_at = scheduled_queries_executions.get(query.id) or (
                     query.latest_query_data and query.latest_query_data.retrieved_at
                 )
 
-                if should_schedule_next(
+                next_run = next_scheduled_run(
                     retrieved_at or now,
-                    now,
                     query.schedule["interval"],
                     query.schedule["time"],
                     query.schedule["day_of_week"],
                     query.schedule_failures,
-                ):
+                )
+
+                if next_run is None:
+                    parked_ids.append(query.id)
+                elif now > next_run:
                     key = "{}:{}".format(query.query_hash, query.data_source_id)
                     outdated_queries[key] = query
+                else:
+                    next_runs[query.id] = next_run.timestamp()
             except Exception as e:
                 query.schedule["disabled"] = True
                 db.session.commit()
@@ -708,6 +1173,8 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                     type(e)(message).with_traceback(e.__traceback__)
                 )
 
+        scheduled_queries_index.update(next_runs, parked_ids, removed_ids)
+
         return list(outdated_queries.values())
 
     @classmethod
@@ -791,8 +1258,13 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     @classmethod
     def update_latest_result(cls, query_result):
         # TODO: Investigate how big an impact this select-before-update makes.
+        # Queries saved before the hashing changed keep their legacy hash until `queries
+        # rehash` runs, or until they're updated (which recomputes it, see
+        # receive_before_insert_update), so they are matched on both.
         queries = Query.query.filter(
-            Query.query_hash == query_result.query_hash,
+            Query.query_hash.in_(
+                [query_result.query_hash, gen_legacy_query_hash(query_result.query_text)]
+            ),
             Query.data_source == query_result.data_source,
         )
 
@@ -887,10 +1359,20 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
         api_keys = db.session.execute(query, {"id": self.id}).fetchall()
         return [api_key[0] for api_key in api_keys]
 
+    @staticmethod
+    def compute_query_hash(query_runner, query_text, options):
+        should_apply_auto_limit = options.get("apply_auto_limit", False) if options else False
+        return (query_runner or BaseQueryRunner({})).gen_query_hash(query_text, should_apply_auto_limit)
+
     def update_query_hash(self):
-        should_apply_auto_limit = self.options.get("apply_auto_limit", False) if self.options else False
-        query_runner = self.data_source.query_runner if self.data_source else BaseQueryRunner({})
-        self.query_hash = query_runner.gen_query_hash(self.query_text, should_apply_auto_limit)
+        query_runner = self.data_source.query_runner if self.data_source else None
+        self.query_hash = self.compute_query_hash(query_runner, self.query_text, self.options)
+
+
+@listens_for(DataSource, "after_update")
+@listens_for(DataSource, "after_delete")
+def invalidate_query_runner_pool(mapper, connection, target):
+    query_runner_pools.invalidate(target.id)
 
 
 @listens_for(Query, "before_insert")
@@ -899,6 +1381,48 @@ def receive_before_insert_update(mapper, connection, target):
     target.update_query_hash()
 
 
+# Changes to the schedule index are applied once the session commits, so refresh_queries
+# never re-evaluates a query before its new row is visible, and a rollback leaves the index
+# untouched.
+SCHEDULE_REINDEX_KEY = "scheduled_queries_reindex"
+
+
+def _defer_reindex(target, indexed):
+    session = object_session(target)
+    if session is None:
+        return
+
+    session.info.setdefault(SCHEDULE_REINDEX_KEY, {})[target.id] = indexed
+
+
+@listens_for(Query, "after_insert")
+@listens_for(Query, "after_update")
+def reindex_query_schedule(mapper, connection, target):
+    _defer_reindex(target, target.schedule is not None)
+
+
+@listens_for(Query, "after_delete")
+def unindex_query_schedule(mapper, connection, target):
+    _defer_reindex(target, False)
+
+
+@listens_for(Session, "after_commit")
+def apply_schedule_reindex(session):
+    pending = session.info.pop(SCHEDULE_REINDEX_KEY, None)
+    if not pending:
+        return
+
+    scheduled_queries_index.update(
+        {query_id: 0 for query_id, indexed in pending.items() if indexed},
+        removed_ids=[query_id for query_id, indexed in pending.items() if not indexed],
+    )
+
+
+@listens_for(Session, "after_rollback")
+def discard_schedule_reindex(session):
+    session.info.pop(SCHEDULE_REINDEX_KEY, None)
+
+
 @listens_for(Query.user_id, "set")
 def query_last_modified_by(target, val, oldval, initiator):
     target.last_modified_by_id = val
@@ -1230,13 +1754,26 @@ class Alert(TimestampMixin, BelongsToOrgMixin, db.Model):
     def get_by_id_and_org(cls, object_id, org):
         return super(Alert, cls).get_by_id_and_org(object_id, org, Query)
 
-    def evaluate(self):
-        data = self.query_rel.latest_query_data.data
-
-        if data["rows"] and self.options["column"] in data["rows"][0]:
+    @classmethod
+    def evaluate_many(cls, alerts, query_result):
+        """
+        Returns the new state of each of `alerts` (all on the same query) by id, reading only
+        the first row of the columns they check from `query_result`.
+        """
+        columns = {alert.options["column"] for alert in alerts}
+        rows = query_result.data_slice(0, 1, columns)["rows"]
+        first_row = rows[0] if rows else {}
+        return {alert.id: alert.evaluate(first_row) for alert in alerts}
+
+    def evaluate(self, first_row=None):
+        if first_row is None:
+            data = self.query_rel.latest_query_data.data
+            first_row = data["rows"][0] if data["rows"] else {}
+
+        if self.options["column"] in first_row:
             op = OPERATORS.get(self.options["op"], lambda v, t: False)
 
-            value = data["rows"][0][self.options["column"]]
+            value = first_row[self.options["column"]]
             threshold = self.options["value"]
 
             new_state = next_state(op, value, threshold)
@@ -1485,6 +2022,47 @@ class Widget(TimestampMixin, BelongsToOrgMixin, db.Model):
         return super(Widget, cls).get_by_id_and_org(object_id, org, Dashboard)
 
 
+@listens_for(Widget, "after_insert")
+@listens_for(Widget, "after_update")
+@listens_for(Widget, "after_delete")
+def invalidate_widget_dashboard(mapper, connection, target):
+    dashboard_cache.invalidate(target.dashboard_id)
+
+
+@listens_for(Dashboard, "after_update")
+@listens_for(Dashboard, "after_delete")
+def invalidate_dashboard(mapper, connection, target):
+    dashboard_cache.invalidate(target.id)
+
+
+@listens_for(Visualization, "after_update")
+def invalidate_visualization_dashboards(mapper, connection, target):
+    dashboard_ids = connection.execute(
+        select([Widget.dashboard_id]).where(Widget.visualization_id == target.id)
+    )
+    dashboard_cache.invalidate(*[row[0] for row in dashboard_ids])
+
+
+@listens_for(Query, "after_update")
+def invalidate_query_dashboards(mapper, connection, target):
+    if not db.session.is_modified(target, include_collections=False):
+        return
+
+    dashboard_ids = connection.execute(
+        select([Widget.dashboard_id])
+        .select_from(Widget.__table__.join(Visualization.__table__))
+        .where(Visualization.query_id == target.id)
+    )
+    dashboard_cache.invalidate(*[row[0] for row in dashboard_ids])
+
+
+@listens_for(DataSourceGroup, "after_insert")
+@listens_for(DataSourceGroup, "after_update")
+@listens_for(DataSourceGroup, "after_delete")
+def invalidate_all_dashboards(mapper, connection, target):
+    dashboard_cache.invalidate_all()
+
+
 @generic_repr(
     "id", "object_type", "object_id", "action", "user_id", "org_id", "created_at"
 )
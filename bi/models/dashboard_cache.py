@@ -0,0 +1,70 @@
+"""
+Redis cache of serialized dashboard widgets.
+
+Entries are versioned rather than deleted: every dashboard has a generation counter, bumped
+whenever one of its widgets, their visualizations or queries, or the dashboard itself
+changes, and a global generation bumped when data source group permissions change. Both are
+part of the cache key, so a reader that raced an edit can only write an entry nobody will
+read again.
+"""
+from bi import redis_connection, settings, statsd_client
+from bi.utils import json_dumps, json_loads
+
+
+class DashboardCache(object):
+    KEY_PREFIX = "dashboard:widgets"
+    GENERATION_PREFIX = "dashboard:generation"
+    GLOBAL_GENERATION_KEY = "dashboard:generation"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def enabled(self):
+        return settings.DASHBOARD_CACHE_ENABLED
+
+    def _generation_key(self, dashboard_id):
+        return "{}:{}".format(self.GENERATION_PREFIX, dashboard_id)
+
+    def _key(self, dashboard_id, variant):
+        generations = self.connection.mget(
+            [self.GLOBAL_GENERATION_KEY, self._generation_key(dashboard_id)]
+        )
+        return "{}:{}:{}:{}:{}".format(
+            self.KEY_PREFIX,
+            dashboard_id,
+            generations[0] or 0,
+            generations[1] or 0,
+            variant,
+        )
+
+    def get_or_set(self, dashboard_id, variant, build):
+        """Returns the cached `variant` of the dashboard's widgets, storing `build()` on a miss."""
+        if not self.enabled:
+            return build()
+
+        key = self._key(dashboard_id, variant)
+        cached = self.connection.get(key)
+        if cached is not None:
+            statsd_client.incr("dashboard_cache.hits")
+            return json_loads(cached)
+
+        statsd_client.incr("dashboard_cache.misses")
+        value = build()
+        self.connection.set(key, json_dumps(value), ex=settings.DASHBOARD_CACHE_TTL)
+        return value
+
+    def invalidate(self, *dashboard_ids):
+        if not dashboard_ids:
+            return
+
+        pipe = self.connection.pipeline()
+        for dashboard_id in set(dashboard_ids):
+            pipe.incr(self._generation_key(dashboard_id))
+        pipe.execute()
+
+    def invalidate_all(self):
+        self.connection.incr(self.GLOBAL_GENERATION_KEY)
+
+
+dashboard_cache = DashboardCache(redis_connection)
@@ -1,6 +1,10 @@
+import threading
+from collections import OrderedDict
+
 import pystache
 from functools import partial
 from numbers import Number
+from bi import settings
 from bi.utils import mustache_render, json_loads
 from bi.permissions import require_access, view_only
 from funcy import distinct
@@ -15,27 +19,80 @@ def _pluck_name_and_value(default_column, row):
     return {"name": row[name_column], "value": str(row[value_column])}
 
 
-def _load_result(query_id, org):
+def _load_query(query_id, org):
     from bi import models
 
     query = models.Query.get_by_id_and_org(query_id, org)
 
     if query.data_source:
-        query_result = models.QueryResult.get_by_id_and_org(
-            query.latest_query_data_id, org
-        )
-        return query_result.data
+        return query
     else:
         raise QueryDetachedFromDataSourceError(query_id)
 
 
-def dropdown_values(query_id, org):
-    data = _load_result(query_id, org)
+def _load_result(query_id, org):
+    from bi import models
+
+    query = _load_query(query_id, org)
+    query_result = models.QueryResult.get_by_id_and_org(query.latest_query_data_id, org)
+    return query_result.data
+
+
+def _pluck_dropdown_values(data):
     first_column = data["columns"][0]["name"]
     pluck = partial(_pluck_name_and_value, first_column)
     return list(map(pluck, data["rows"]))
 
 
+def dropdown_values(query_id, org):
+    return _pluck_dropdown_values(_load_result(query_id, org))
+
+
+class DropdownValueSets(object):
+    """
+    Per-process LRU of the values offered by dropdown queries, as sets, for validating
+    "query" parameters. Entries are keyed by the dropdown query's latest result, so a new
+    result replaces the query's entry the next time it's looked up.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query_id, org):
+        from bi import models
+
+        query = _load_query(query_id, org)
+        result_id = query.latest_query_data_id
+
+        with self._lock:
+            entry = self._entries.get(query.id)
+            if entry is not None and entry[0] == result_id:
+                self._entries.move_to_end(query.id)
+                return entry[1]
+
+        query_result = models.QueryResult.get_by_id_and_org(result_id, org)
+        values = frozenset(
+            v["value"] for v in _pluck_dropdown_values(query_result.data)
+        )
+
+        with self._lock:
+            self._entries[query.id] = (result_id, values)
+            self._entries.move_to_end(query.id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return values
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+dropdown_value_sets = DropdownValueSets(settings.PARAMETER_DROPDOWN_CACHE_SIZE)
+
+
 def join_parameter_list_values(parameters, schema):
     updated_parameters = {}
     for (key, value) in parameters.items():
@@ -113,7 +170,7 @@ def _is_date_range(obj):
 
 def _is_value_within_options(value, dropdown_options, allow_list=False):
     if isinstance(value, list):
-        return allow_list and set(map(str, value)).issubset(set(dropdown_options))
+        return allow_list and set(map(str, value)).issubset(dropdown_options)
     return str(value) in dropdown_options
 
 
@@ -166,7 +223,7 @@ class ParameterizedQuery(object):
             ),
             "query": lambda value: _is_value_within_options(
                 value,
-                [v["value"] for v in dropdown_values(query_id, self.org)],
+                dropdown_value_sets.get(query_id, self.org),
                 allow_multiple_values,
             ),
             "date": _is_date,
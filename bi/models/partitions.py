@@ -0,0 +1,242 @@
+"""
+Range partitioning of query_results by retrieved_at (PostgreSQL 11 or later).
+
+`manage database partition_query_results` converts the table once. From then on the cleanup
+job keeps partitions of QUERY_RESULTS_PARTITION_DAYS days created ahead of time, and drops
+the ones older than QUERY_RESULTS_CLEANUP_MAX_AGE whole instead of deleting their rows. Results
+of those partitions that a query still shows are first copied into the default partition,
+query_results_retained, where the row by row cleanup removes them once they're unused.
+
+Partitioned tables can't be referenced by foreign keys on `id` alone, so the conversion drops
+the one from queries.latest_query_data_id.
+"""
+import datetime
+import re
+
+from dateutil.parser import parse as parse_date
+
+from bi import settings
+
+from .base import db
+
+PARENT_TABLE = "query_results"
+RETAINED_PARTITION = "query_results_retained"
+PARTITION_PREFIX = "query_results_p"
+UNPARTITIONED_TABLE = "query_results_unpartitioned"
+MOVED_TABLE = "query_results_moved"
+
+BOUNDS_REGEX = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def _period_start(day):
+    """Start of the partition period `day` falls in, periods being aligned on day ordinals."""
+    days = settings.QUERY_RESULTS_PARTITION_DAYS
+    ordinal = day.toordinal()
+    return datetime.date.fromordinal(ordinal - ordinal % days)
+
+
+def _bound(day):
+    return "{:%Y-%m-%d} 00:00:00+00".format(day)
+
+
+class QueryResultPartitions(object):
+    def is_partitioned(self):
+        return bool(
+            db.session.execute(
+                "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)",
+                {"table": PARENT_TABLE},
+            ).scalar()
+        )
+
+    def partitions(self):
+        """Returns the (name, start, end) of each range partition, oldest first."""
+        rows = db.session.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:table)
+            """,
+            {"table": PARENT_TABLE},
+        )
+
+        partitions = []
+        for name, bounds in rows:
+            match = BOUNDS_REGEX.search(bounds or "")
+            if match:
+                partitions.append(
+                    (name, parse_date(match.group(1)), parse_date(match.group(2)))
+                )
+
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    def _periods(self, since):
+        """Yields the (start, end) of the periods from the one of `since` up to QUERY_RESULTS_PARTITIONS_AHEAD from now."""
+        days = datetime.timedelta(days=settings.QUERY_RESULTS_PARTITION_DAYS)
+        start = _period_start(since)
+        last = (
+            _period_start(datetime.datetime.utcnow().date())
+            + days * settings.QUERY_RESULTS_PARTITIONS_AHEAD
+        )
+        while start <= last:
+            yield start, start + days
+            start += days
+
+    def _create(self, start, end):
+        """
+        Creates the partition of [start, end). Results of that range already in the default
+        partition (when the partition is created late, e.g. after a missed cleanup run or a
+        change of QUERY_RESULTS_PARTITION_DAYS) are moved to it, as PostgreSQL refuses to
+        create a partition for rows the default partition holds.
+        """
+        name = "{}{:%Y%m%d}".format(PARTITION_PREFIX, start)
+        bounds = {"start": _bound(start), "end": _bound(end)}
+        in_range = "retrieved_at >= :start AND retrieved_at < :end"
+        misplaced = db.session.execute(
+            "SELECT 1 FROM {} WHERE {} LIMIT 1".format(RETAINED_PARTITION, in_range), bounds
+        ).scalar()
+
+        if misplaced:
+            db.session.execute(
+                "CREATE TEMPORARY TABLE {} (LIKE {}) ON COMMIT DROP".format(
+                    MOVED_TABLE, PARENT_TABLE
+                )
+            )
+            db.session.execute(
+                "WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) "
+                "INSERT INTO {} SELECT * FROM moved".format(
+                    RETAINED_PARTITION, in_range, MOVED_TABLE
+                ),
+                bounds,
+            )
+
+        db.session.execute(
+            "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, PARENT_TABLE, _bound(start), _bound(end)
+            )
+        )
+
+        if misplaced:
+            db.session.execute(
+                "INSERT INTO {} SELECT * FROM {}".format(PARENT_TABLE, MOVED_TABLE)
+            )
+            db.session.execute("DROP TABLE {}".format(MOVED_TABLE))
+
+        return name
+
+    def ensure(self):
+        """Creates the missing partitions up to QUERY_RESULTS_PARTITIONS_AHEAD periods from now."""
+        existing = [(s.date(), e.date()) for _, s, e in self.partitions()]
+        created = []
+        for start, end in self._periods(datetime.datetime.utcnow().date()):
+            # Periods overlapping a partition made with another QUERY_RESULTS_PARTITION_DAYS
+            # are already covered.
+            if not any(s < end and start < e for s, e in existing):
+                created.append(self._create(start, end))
+
+        db.session.commit()
+        return created
+
+    def expired(self, days):
+        """Returns the names of the partitions holding only results older than `days` days."""
+        threshold = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            days=days
+        )
+        return [name for name, _, end in self.partitions() if end <= threshold]
+
+    def drop(self, name):
+        """
+        Drops partition `name`, keeping the results queries still show in the default
+        partition. Returns the number of dropped and of kept results.
+        """
+        from bi.models import BLOB_REF_PREFIX, QueryResultBlob
+
+        still_used = (
+            "EXISTS (SELECT 1 FROM queries q WHERE q.latest_query_data_id = p.id)"
+        )
+        db.session.execute(
+            "ALTER TABLE {} DETACH PARTITION {}".format(PARENT_TABLE, name)
+        )
+        # The detached range isn't covered anymore, so these rows go to the default partition.
+        kept = db.session.execute(
+            "INSERT INTO {} SELECT p.* FROM {} p WHERE {}".format(
+                PARENT_TABLE, name, still_used
+            )
+        ).rowcount
+        total = db.session.execute("SELECT count(*) FROM {}".format(name)).scalar()
+        refs = db.session.execute(
+            "SELECT p.org_id, p.data, count(*) FROM {} p "
+            "WHERE p.data LIKE :prefix AND NOT {} GROUP BY p.org_id, p.data".format(
+                name, still_used
+            ),
+            {"prefix": BLOB_REF_PREFIX + "%"},
+        ).fetchall()
+        db.session.execute("DROP TABLE {}".format(name))
+        QueryResultBlob.release(refs)
+        db.session.commit()
+
+        return total - kept, kept
+
+    def convert(self):
+        """Turns query_results into a partitioned table, in a single transaction."""
+        from bi.models import QueryResult
+
+        columns = [column.name for column in QueryResult.__table__.columns]
+        select_columns = [
+            "coalesce(retrieved_at, now())" if name == "retrieved_at" else name
+            for name in columns
+        ]
+        oldest = db.session.execute(
+            "SELECT min(retrieved_at) FROM {}".format(PARENT_TABLE)
+        ).scalar()
+
+        for statement in (
+            "ALTER TABLE queries DROP CONSTRAINT IF EXISTS queries_latest_query_data_id_fkey",
+            "ALTER TABLE {} RENAME TO {}".format(PARENT_TABLE, UNPARTITIONED_TABLE),
+            "ALTER SEQUENCE query_results_id_seq OWNED BY NONE",
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (retrieved_at)".format(
+                PARENT_TABLE, UNPARTITIONED_TABLE
+            ),
+            "ALTER TABLE {} ADD PRIMARY KEY (id, retrieved_at)".format(PARENT_TABLE),
+            "ALTER TABLE {} ADD FOREIGN KEY (org_id) REFERENCES organizations (id)".format(
+                PARENT_TABLE
+            ),
+            "ALTER TABLE {} ADD FOREIGN KEY (data_source_id) REFERENCES data_sources (id)".format(
+                PARENT_TABLE
+            ),
+            "CREATE TABLE {} PARTITION OF {} DEFAULT".format(
+                RETAINED_PARTITION, PARENT_TABLE
+            ),
+        ):
+            db.session.execute(statement)
+
+        for start, end in self._periods(
+            oldest.date() if oldest else datetime.datetime.utcnow().date()
+        ):
+            self._create(start, end)
+
+        for statement in (
+            "INSERT INTO {} ({}) SELECT {} FROM {}".format(
+                PARENT_TABLE, ", ".join(columns), ", ".join(select_columns), UNPARTITIONED_TABLE
+            ),
+            "DROP TABLE {}".format(UNPARTITIONED_TABLE),
+            "ALTER SEQUENCE query_results_id_seq OWNED BY {}.id".format(PARENT_TABLE),
+            "CREATE INDEX ix_query_results_query_hash ON {} (query_hash)".format(PARENT_TABLE),
+        ):
+            db.session.execute(statement)
+
+        db.session.commit()
+
+    def total_size(self):
+        """Size of the table with all its partitions (pg_total_relation_size of the parent is 0)."""
+        return db.session.execute(
+            """
+            SELECT coalesce(sum(pg_total_relation_size(c.oid)), 0)
+            FROM pg_class c
+            WHERE c.oid = to_regclass(:table)
+               OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:table))
+            """,
+            {"table": PARENT_TABLE},
+        ).scalar()
+
+
+query_result_partitions = QueryResultPartitions()
@@ -0,0 +1,162 @@
+"""
+Redis cache of the latest query result per (data source, query hash).
+
+Each entry is a Redis hash holding the result's metadata and its stored (usually columnar,
+compressed) payload, so a hit can be served without touching Postgres. Entries are tracked
+in a sorted set scored by last access time together with their payload size, and the least
+recently used ones are evicted once the total goes over QUERY_RESULTS_CACHE_MAX_SIZE.
+
+Hits, misses and evictions are counted in a single Redis hash, shown on the status page and
+exported on /metrics (see bi.monitor).
+"""
+import logging
+import time
+
+from bi import redis_connection, settings, utils
+
+logger = logging.getLogger(__name__)
+
+
+class QueryResultCache(object):
+    KEY_PREFIX = "query_result:latest"
+    LRU_KEY = "query_result:latest:lru"
+    SIZES_KEY = "query_result:latest:sizes"
+    TOTAL_SIZE_KEY = "query_result:latest:total_size"
+    STATS_KEY = "query_result:latest:stats"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def enabled(self):
+        return settings.QUERY_RESULTS_CACHE_ENABLED
+
+    def _member(self, data_source_id, query_hash):
+        return "{}:{}".format(data_source_id, query_hash)
+
+    def _key(self, member):
+        return "{}:{}".format(self.KEY_PREFIX, member)
+
+    def get(self, data_source_id, query_hash, max_age=0):
+        """
+        Returns the cached entry for the latest result as a dict, or None when there is no
+        entry or it is older than `max_age` seconds (-1 accepts any age).
+        """
+        if not self.enabled:
+            return None
+
+        member = self._member(data_source_id, query_hash)
+        entry = self.connection.hgetall(self._key(member))
+
+        if entry and max_age != -1:
+            age = time.time() - float(entry["retrieved_at"])
+            if age > max_age:
+                entry = None
+
+        if not entry:
+            self.connection.hincrby(self.STATS_KEY, "misses", 1)
+            return None
+
+        pipe = self.connection.pipeline()
+        pipe.zadd(self.LRU_KEY, {member: time.time()}, xx=True)
+        pipe.hincrby(self.STATS_KEY, "hits", 1)
+        pipe.execute()
+
+        entry["retrieved_at"] = utils.dt_from_timestamp(entry["retrieved_at"])
+        entry["runtime"] = float(entry["runtime"])
+        return entry
+
+    def set(self, query_result, query_hash):
+        """
+        Caches `query_result` as the latest result for `query_hash`, the hash it was looked
+        up by. It differs from the result's own hash for results stored before the hashing
+        changed, which would otherwise be cached where no lookup or invalidation finds them.
+        """
+        if not self.enabled or query_result.id is None:
+            return
+
+        payload = query_result.payload or ""
+        size = len(payload)
+        if size > settings.QUERY_RESULTS_CACHE_MAX_ENTRY_SIZE:
+            return
+
+        # Never outlive the point where cleanup_query_results may delete the row.
+        retrieved_at = query_result.retrieved_at.timestamp()
+        ttl = min(
+            settings.QUERY_RESULTS_CACHE_TTL,
+            int(
+                retrieved_at
+                + settings.QUERY_RESULTS_CLEANUP_MAX_AGE * 86400
+                - time.time()
+            ),
+        )
+        if ttl <= 0:
+            return
+
+        member = self._member(query_result.data_source_id, query_hash)
+        key = self._key(member)
+        previous_size = self.connection.hget(self.SIZES_KEY, member)
+
+        pipe = self.connection.pipeline()
+        pipe.hmset(
+            key,
+            {
+                "id": query_result.id,
+                "org_id": query_result.org_id,
+                "data_source_id": query_result.data_source_id,
+                "query_hash": query_result.query_hash,
+                "query_text": query_result.query_text,
+                "runtime": query_result.runtime,
+                "retrieved_at": retrieved_at,
+                "data": payload,
+            },
+        )
+        pipe.expire(key, ttl)
+        pipe.zadd(self.LRU_KEY, {member: time.time()})
+        pipe.hset(self.SIZES_KEY, member, size)
+        pipe.incrby(self.TOTAL_SIZE_KEY, size - int(previous_size or 0))
+        pipe.execute()
+
+        self._evict()
+
+    def invalidate(self, data_source_id, query_hash):
+        if not self.enabled:
+            return
+
+        self._remove([self._member(data_source_id, query_hash)])
+
+    def _remove(self, members):
+        sizes = self.connection.hmget(self.SIZES_KEY, members)
+
+        pipe = self.connection.pipeline()
+        pipe.delete(*[self._key(member) for member in members])
+        pipe.zrem(self.LRU_KEY, *members)
+        pipe.hdel(self.SIZES_KEY, *members)
+        pipe.decrby(self.TOTAL_SIZE_KEY, sum(int(size or 0) for size in sizes))
+        pipe.execute()
+
+    def _evict(self, batch_size=20):
+        evicted = 0
+        max_size = settings.QUERY_RESULTS_CACHE_MAX_SIZE
+        while int(self.connection.get(self.TOTAL_SIZE_KEY) or 0) > max_size:
+            members = self.connection.zrange(self.LRU_KEY, 0, batch_size - 1)
+            if not members:
+                # Nothing left to account for; the counter drifted, so reset it.
+                self.connection.set(self.TOTAL_SIZE_KEY, 0)
+                break
+
+            self._remove(members)
+            evicted += len(members)
+
+        if evicted:
+            self.connection.hincrby(self.STATS_KEY, "evictions", evicted)
+            logger.debug("Evicted %d entries from the query result cache.", evicted)
+
+    def stats(self):
+        stats = {k: int(v) for k, v in self.connection.hgetall(self.STATS_KEY).items()}
+        stats["entries"] = self.connection.zcard(self.LRU_KEY)
+        stats["size"] = int(self.connection.get(self.TOTAL_SIZE_KEY) or 0)
+        return stats
+
+
+query_result_cache = QueryResultCache(redis_connection)
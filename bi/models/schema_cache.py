@@ -0,0 +1,103 @@
+"""
+Per-table Redis cache of data source schemas.
+
+Each data source has a Redis hash of its tables, every table stored compressed on its own so
+it can be read alone, and a hash of table fingerprints. A refresh compares fingerprints and
+only fetches and rewrites the tables that changed. Schemas cached by earlier versions as a
+single JSON value are still read until the first refresh replaces them.
+"""
+import base64
+import hashlib
+
+from bi import redis_connection, settings
+from bi.utils import columnar, json_dumps, json_loads
+
+
+def table_fingerprint(table):
+    """Fingerprint of a table's definition, for runners that can't fingerprint tables themselves."""
+    return hashlib.md5(json_dumps(table, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _compress(table):
+    codec = columnar.resolve_codec(settings.QUERY_RESULTS_COMPRESSION)
+    compress, _ = columnar.codecs[codec]
+    raw = compress(json_dumps(table).encode("utf-8"))
+    return "{}:{}".format(codec, base64.b64encode(raw).decode("ascii"))
+
+
+def _decompress(value):
+    codec, encoded = value.split(":", 1)
+    _, decompress = columnar.codecs[codec]
+    return json_loads(decompress(base64.b64decode(encoded)).decode("utf-8"))
+
+
+class SchemaCache(object):
+    LEGACY_KEY_PREFIX = "data_source:schema"
+    TABLES_KEY_PREFIX = "data_source:schema:tables"
+    FINGERPRINTS_KEY_PREFIX = "data_source:schema:fingerprints"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _legacy_key(self, data_source_id):
+        return "{}:{}".format(self.LEGACY_KEY_PREFIX, data_source_id)
+
+    def _tables_key(self, data_source_id):
+        return "{}:{}".format(self.TABLES_KEY_PREFIX, data_source_id)
+
+    def _fingerprints_key(self, data_source_id):
+        return "{}:{}".format(self.FINGERPRINTS_KEY_PREFIX, data_source_id)
+
+    def get(self, data_source_id):
+        """Returns the cached schema sorted by table name, or None if it was never fetched."""
+        tables = self.connection.hgetall(self._tables_key(data_source_id))
+        if tables:
+            return [_decompress(tables[name]) for name in sorted(tables)]
+
+        legacy = self.connection.get(self._legacy_key(data_source_id))
+        return json_loads(legacy) if legacy else None
+
+    def get_table(self, data_source_id, table_name):
+        value = self.connection.hget(self._tables_key(data_source_id), table_name)
+        return _decompress(value) if value is not None else None
+
+    def fingerprints(self, data_source_id):
+        """Returns the fingerprints of the cached tables (none if the tables are gone)."""
+        pipe = self.connection.pipeline()
+        pipe.exists(self._tables_key(data_source_id))
+        pipe.hgetall(self._fingerprints_key(data_source_id))
+        tables_exist, fingerprints = pipe.execute()
+        return fingerprints if tables_exist else {}
+
+    def update(self, data_source_id, tables, fingerprints, removed=()):
+        """
+        Writes the given tables and fingerprints and drops the `removed` table names, leaving
+        every other cached table untouched.
+        """
+        tables_key = self._tables_key(data_source_id)
+        fingerprints_key = self._fingerprints_key(data_source_id)
+
+        pipe = self.connection.pipeline()
+        if removed:
+            pipe.hdel(tables_key, *removed)
+            pipe.hdel(fingerprints_key, *removed)
+        if tables:
+            pipe.hmset(tables_key, {table["name"]: _compress(table) for table in tables})
+        if fingerprints:
+            pipe.hmset(fingerprints_key, fingerprints)
+        pipe.delete(self._legacy_key(data_source_id))
+        pipe.hlen(tables_key)
+
+        if not pipe.execute()[-1]:
+            # Remember that the data source has no tables, so it isn't fetched on every read.
+            self.connection.set(self._legacy_key(data_source_id), json_dumps([]))
+
+    def delete(self, data_source_id):
+        self.connection.delete(
+            self._legacy_key(data_source_id),
+            self._tables_key(data_source_id),
+            self._fingerprints_key(data_source_id),
+        )
+
+
+schema_cache = SchemaCache(redis_connection)
@@ -0,0 +1,203 @@
+"""
+Redis log of slow query executions, and totals of the worker time spent on each query.
+
+QueryExecutor records every execution's runtime in two sorted sets, summing the seconds per
+data source and per (data source, query hash), and logs the ones running longer than their
+data source's threshold (SLOW_QUERY_THRESHOLD, overridden by SLOW_QUERY_THRESHOLDS). Each log
+entry is a JSON document listed in a sorted set scored by its id, so the newest come first and
+only the last SLOW_QUERY_LOG_SIZE are kept. Entries are also listed per data source and per
+query hash, so filtered pages are read straight from their own index. For data sources that support it, the query's
+EXPLAIN plan is added to the entry afterwards by a separate job (see
+bi.tasks.queries.slow_queries).
+"""
+import time
+
+import redis
+
+from bi import redis_connection, settings
+from bi.utils import json_dumps, json_loads
+
+# Only the queries with the most worker time are kept, so one-off ad-hoc queries don't grow
+# the totals without bounds.
+WORKER_TIME_MAX_QUERIES = 10000
+
+
+def slow_query_threshold(data_source_id):
+    return settings.SLOW_QUERY_THRESHOLDS.get(
+        data_source_id, settings.SLOW_QUERY_THRESHOLD
+    )
+
+
+class SlowQueryLog(object):
+    KEY_PREFIX = "slow_query"
+    INDEX_KEY = "slow_queries"
+    DATA_SOURCE_INDEX_KEY = "slow_queries:data_source:{}"
+    QUERY_INDEX_KEY = "slow_queries:query:{}"
+    ID_KEY = "slow_queries:id"
+    DATA_SOURCES_TIME_KEY = "worker_time:data_sources"
+    QUERIES_TIME_KEY = "worker_time:queries"
+    QUERIES_COUNT_KEY = "worker_time:queries:count"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _key(self, entry_id):
+        return "{}:{}".format(self.KEY_PREFIX, entry_id)
+
+    def _filter_keys(self, entry):
+        return [
+            self.DATA_SOURCE_INDEX_KEY.format(entry["data_source_id"]),
+            self.QUERY_INDEX_KEY.format(entry["query_hash"]),
+        ]
+
+    def record_worker_time(self, data_source_id, query_hash, runtime):
+        member = "{}:{}".format(data_source_id, query_hash)
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.zincrby(self.DATA_SOURCES_TIME_KEY, runtime, data_source_id)
+        pipe.zincrby(self.QUERIES_TIME_KEY, runtime, member)
+        pipe.zincrby(self.QUERIES_COUNT_KEY, 1, member)
+        pipe.execute()
+
+        if self.connection.zcard(self.QUERIES_TIME_KEY) > WORKER_TIME_MAX_QUERIES * 1.1:
+            self._trim_worker_time()
+
+    def _trim_worker_time(self):
+        dropped = self.connection.zrange(
+            self.QUERIES_TIME_KEY, 0, -(WORKER_TIME_MAX_QUERIES + 1)
+        )
+        if dropped:
+            pipe = self.connection.pipeline()
+            pipe.zrem(self.QUERIES_TIME_KEY, *dropped)
+            pipe.zrem(self.QUERIES_COUNT_KEY, *dropped)
+            pipe.execute()
+
+    def worker_time(self, limit=100):
+        """Returns the data sources and the queries that took the most worker time, in seconds."""
+        data_sources = self.connection.zrevrange(
+            self.DATA_SOURCES_TIME_KEY, 0, -1, withscores=True
+        )
+        queries = self.connection.zrevrange(
+            self.QUERIES_TIME_KEY, 0, limit - 1, withscores=True
+        )
+        pipe = self.connection.pipeline(transaction=False)
+        for member, _ in queries:
+            pipe.zscore(self.QUERIES_COUNT_KEY, member)
+        counts = pipe.execute()
+
+        result_queries = []
+        for (member, runtime), count in zip(queries, counts):
+            data_source_id, query_hash = member.split(":", 1)
+            result_queries.append(
+                {
+                    "data_source_id": int(data_source_id),
+                    "query_hash": query_hash,
+                    "runtime": runtime,
+                    "executions": int(count or 0),
+                }
+            )
+
+        return {
+            "data_sources": [
+                {"data_source_id": int(data_source_id), "runtime": runtime}
+                for data_source_id, runtime in data_sources
+            ],
+            "queries": result_queries,
+        }
+
+    def record(self, **entry):
+        """Adds an entry with the given fields to the log. Returns its id."""
+        entry_id = self.connection.incr(self.ID_KEY)
+        entry.update(id=entry_id, recorded_at=time.time())
+
+        pipe = self.connection.pipeline()
+        pipe.set(self._key(entry_id), json_dumps(entry))
+        for index_key in [self.INDEX_KEY] + self._filter_keys(entry):
+            pipe.zadd(index_key, {entry_id: entry_id})
+        pipe.execute()
+
+        self._trim()
+        return entry_id
+
+    def _trim(self):
+        dropped = self.connection.zrange(
+            self.INDEX_KEY, 0, -(settings.SLOW_QUERY_LOG_SIZE + 1)
+        )
+        if dropped:
+            keys = [self._key(entry_id) for entry_id in dropped]
+            pipe = self.connection.pipeline()
+            pipe.zrem(self.INDEX_KEY, *dropped)
+            for entry_id, entry in zip(dropped, self.connection.mget(keys)):
+                if entry is not None:
+                    for index_key in self._filter_keys(json_loads(entry)):
+                        pipe.zrem(index_key, entry_id)
+            pipe.delete(*keys)
+            pipe.execute()
+
+    def update(self, entry_id, **fields):
+        """Sets fields of an entry, unless it was trimmed from the log already."""
+        key = self._key(entry_id)
+        with self.connection.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                entry = pipe.get(key)
+                if entry is None:
+                    return False
+
+                entry = json_loads(entry)
+                entry.update(fields)
+                pipe.multi()
+                pipe.set(key, json_dumps(entry))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                # The entry was trimmed meanwhile.
+                return False
+
+    def get(self, entry_id):
+        entry = self.connection.get(self._key(entry_id))
+        return json_loads(entry) if entry is not None else None
+
+    def list(self, offset=0, limit=50, data_source_id=None, query_hash=None):
+        """Returns (total, entries) of the log, newest first, without the query text and plan."""
+        if query_hash is not None:
+            index_key = self.QUERY_INDEX_KEY.format(query_hash)
+        elif data_source_id is not None:
+            index_key = self.DATA_SOURCE_INDEX_KEY.format(data_source_id)
+        else:
+            index_key = self.INDEX_KEY
+
+        # The same query text can run on several data sources; those entries are told apart
+        # after loading, which is cheap since a single query has few entries.
+        both = query_hash is not None and data_source_id is not None
+        if both:
+            entry_ids = self.connection.zrevrange(index_key, 0, -1)
+        else:
+            total = self.connection.zcard(index_key)
+            entry_ids = (
+                self.connection.zrevrange(index_key, offset, offset + limit - 1)
+                if limit > 0
+                else []
+            )
+
+        entries = []
+        if entry_ids:
+            for entry in self.connection.mget([self._key(i) for i in entry_ids]):
+                if entry is None:
+                    continue
+
+                entry = json_loads(entry)
+                if both and entry["data_source_id"] != data_source_id:
+                    continue
+
+                entry.pop("query", None)
+                entry.pop("explain", None)
+                entries.append(entry)
+
+        if both:
+            total = len(entries)
+            entries = entries[offset : offset + limit]
+
+        return total, entries
+
+
+slow_query_log = SlowQueryLog(redis_connection)
@@ -3,12 +3,26 @@ import itertools
 from funcy import flatten
 from sqlalchemy import union_all
 from bi import redis_connection, rq_redis_connection, __version__, settings, __DeepBI_version__
-from bi.models import db, DataSource, Query, QueryResult, Dashboard, Widget
+from bi.models import (
+    db,
+    DataSource,
+    Query,
+    QueryResult,
+    Dashboard,
+    Widget,
+    query_result_cache,
+    query_result_partitions,
+)
+from bi.metrics import prometheus
+from bi.utils.concurrency import concurrency_limit, data_source_semaphore
 from bi.utils import json_loads
 from rq import Queue, Worker
 from rq.job import Job
 from rq.registry import StartedJobRegistry
 
+# Backlog of the query results cleanup, as last reported by the job.
+QUERY_RESULTS_RETENTION_KEY = "query_results:retention"
+
 
 def get_redis_status():
     info = redis_connection.info()
@@ -33,15 +47,27 @@ def get_queues_status():
     return {queue.name: {"size": len(queue)} for queue in Queue.all(connection=rq_redis_connection)}
 
 
+def get_data_sources_in_flight():
+    data_sources = DataSource.query.with_entities(DataSource.id, DataSource.name).all()
+    in_flight = data_source_semaphore.in_flight([ds.id for ds in data_sources])
+
+    return {
+        ds.id: {
+            "name": ds.name,
+            "in_flight": in_flight[ds.id],
+            "limit": concurrency_limit(ds.id),
+        }
+        for ds in data_sources
+    }
+
+
 def get_db_sizes():
     database_metrics = []
     queries = [
-        [
-            "查询结果集容量",
-            "select pg_total_relation_size('query_results') as size from (select 1) as a",
-        ],
         ["数据库总体容量", "select pg_database_size(current_database()) as size"],
     ]
+    # Summed over its partitions, when query_results is partitioned.
+    database_metrics.append(["查询结果集容量", query_result_partitions.total_size()])
     for query_name, query in queries:
         result = db.session.execute(query).first()
         database_metrics.append([query_name, result[0]])
@@ -55,12 +81,35 @@ def get_status():
     status.update(get_object_counts())
     status["manager"] = redis_connection.hgetall("bi:status")
     status["manager"]["queues"] = get_queues_status()
+    status["query_result_cache"] = query_result_cache.stats()
+    status["data_sources_in_flight"] = get_data_sources_in_flight()
+    status["query_results_retention"] = redis_connection.hgetall(QUERY_RESULTS_RETENTION_KEY)
     status["database_metrics"] = {}
     status["database_metrics"]["metrics"] = get_db_sizes()
 
     return status
 
 
+@prometheus.collector("rq_queue_jobs", "Jobs in each RQ queue, by state.", ["queue", "state"])
+def rq_queue_depths():
+    samples = []
+    for queue in Queue.all(connection=redis_connection):
+        samples.append(((queue.name, "queued"), queue.count))
+        samples.append(((queue.name, "started"), StartedJobRegistry(queue=queue).count))
+    return samples
+
+
+@prometheus.collector(
+    "query_result_cache_lookups_total",
+    "Lookups of the latest query result in the Redis cache, by result.",
+    ["result"],
+    type="counter",
+)
+def query_result_cache_lookups():
+    stats = query_result_cache.stats()
+    return [(("hit",), stats.get("hits", 0)), (("miss",), stats.get("misses", 0))]
+
+
 def rq_job_ids():
     queues = Queue.all(connection=redis_connection)
 
@@ -120,4 +169,8 @@ def rq_workers():
 
 
 def rq_status():
-    return {"queues": rq_queues(), "workers": rq_workers()}
+    return {
+        "queues": rq_queues(),
+        "workers": rq_workers(),
+        "data_sources": get_data_sources_in_flight(),
+    }
@@ -1,3 +1,4 @@
+import io
 import logging
 
 from contextlib import ExitStack
@@ -10,9 +11,10 @@ from urllib.parse import urlparse
 from six import text_type
 from sshtunnel import open_tunnel
 from bi import settings, utils
-from bi.utils import json_loads
+from bi.utils import JSONEncoder, json_dumps, json_loads
 from rq.timeouts import JobTimeoutException
 
+from bi.query_runner.pool import ConnectionPool, pools
 from bi.utils.requests_session import requests_or_advocate, requests_session, UnacceptableAddressException
 
 import sqlparse
@@ -109,6 +111,72 @@ def find_last_keyword_idx(parsed_query):
     return -1
 
 
+class StreamingResultWriter(object):
+    """
+    Builds the serialized `{"columns": ..., "rows": ...}` payload incrementally, so only one
+    batch of rows is held as Python objects at a time. Once `max_rows` rows or `max_bytes`
+    characters of serialized rows are reached (0 disables either cap) further rows are
+    dropped and the result is marked with `"truncated": true`.
+    """
+
+    def __init__(self, columns, max_rows=0, max_bytes=0, encoder=JSONEncoder):
+        self.columns = columns
+        self.names = [column["name"] for column in columns]
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.encoder = encoder
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncated = False
+        self._rows = io.StringIO()
+
+    def _dumps(self, value):
+        return json_dumps(value, cls=self.encoder)
+
+    def _append(self, chunk, row_count):
+        if self.row_count:
+            self._rows.write(", ")
+        self._rows.write(chunk)
+        self.row_count += row_count
+        self.byte_count += len(chunk) + 2
+
+    def write(self, rows):
+        """Appends a batch of row tuples. Returns False once the result got truncated."""
+        if self.truncated:
+            return False
+
+        if self.max_rows and self.row_count + len(rows) > self.max_rows:
+            rows = rows[: self.max_rows - self.row_count]
+            self.truncated = True
+
+        if not rows:
+            return not self.truncated
+
+        batch = [dict(zip(self.names, row)) for row in rows]
+        chunk = self._dumps(batch)[1:-1]
+
+        if not self.max_bytes or self.byte_count + len(chunk) + 2 <= self.max_bytes:
+            self._append(chunk, len(batch))
+        else:
+            for row in batch:
+                chunk = self._dumps(row)
+                if self.byte_count + len(chunk) + 2 > self.max_bytes:
+                    self.truncated = True
+                    break
+                self._append(chunk, 1)
+
+        return not self.truncated
+
+    def getvalue(self):
+        payload = '{{"columns": {}, "rows": [{}]'.format(
+            self._dumps(self.columns), self._rows.getvalue()
+        )
+        if self.truncated:
+            payload += ', "truncated": true'
+
+        return payload + "}"
+
+
 class InterruptException(Exception):
     pass
 
@@ -121,6 +189,8 @@ class BaseQueryRunner(object):
     deprecated = False
     should_annotate_query = True
     noop_query = None
+    # Statement prefixed to a query to get its plan without running it (see explain_query).
+    explain_prefix = None
     limit_query = " LIMIT 1000"
     limit_keywords = ["LIMIT", "OFFSET"]
 
@@ -215,6 +285,37 @@ class BaseQueryRunner(object):
     def run_query(self, query, user):
         raise NotImplementedError()
 
+    @property
+    def supports_explain(self):
+        return self.explain_prefix is not None
+
+    def explain_query(self, query, user):
+        """
+        Returns the plan of `query` as text, from a connection of its own. Returns None when
+        the runner can't explain queries, or when `query` isn't a single SELECT statement:
+        EXPLAIN only prefixes the first statement, and runners executing every statement
+        would run the others again. Raises when the data source returns an error.
+        """
+        if not self.supports_explain:
+            return None
+
+        statements = split_sql_statements(query)
+        if len(statements) != 1 or sqlparse.parse(statements[0])[0].get_type() != "SELECT":
+            return None
+
+        data, error = self.run_query(
+            "{} {}".format(self.explain_prefix, statements[0]), user
+        )
+        if error is not None:
+            raise Exception(error)
+
+        result = json_loads(data)
+        columns = [column["name"] for column in result["columns"]]
+        return "\n".join(
+            "\t".join(str(row.get(column, "")) for column in columns)
+            for row in result["rows"]
+        )
+
     def fetch_columns(self, columns):
         column_names = []
         duplicates_counter = 1
@@ -236,6 +337,19 @@ class BaseQueryRunner(object):
     def get_schema(self, get_stats=False):
         raise NotSupported()
 
+    def get_table_fingerprints(self):
+        """
+        Returns {table name: fingerprint of its definition} from a query much cheaper than
+        fetching the schema, or None when the runner can't. Used to only refresh the tables
+        that changed (see DataSource.get_schema).
+        """
+        return None
+
+    def get_tables_schema(self, table_names):
+        """Returns the schema of the given tables only."""
+        names = set(table_names)
+        return [table for table in self.get_schema() if table["name"] in names]
+
     def _handle_run_query_error(self, error):
         if error is None:
             return
@@ -270,8 +384,76 @@ class BaseQueryRunner(object):
         query_text = self.apply_auto_limit(query_text, set_auto_limit)
         return utils.gen_query_hash(query_text)
 
+    @property
+    def supports_incremental(self):
+        return False
+
+    def apply_watermark(self, query_text, column, watermark):
+        """Returns `query_text` restricted to rows whose `column` is past `watermark`."""
+        raise NotImplementedError()
+
 
 class BaseSQLQueryRunner(BaseQueryRunner):
+    # Set by DataSource.query_runner; connections are only pooled for known data sources.
+    data_source_id = None
+    _pool = None
+
+    def _acquire_connection(self, connect, is_alive=None, reset=None):
+        """
+        Returns a connection from this data source's pool, or a new one from `connect()`
+        when pooling is disabled (or pointless in this process, see `pools.disable`) or the
+        runner isn't bound to a data source.
+        """
+        if (
+            self.data_source_id is None
+            or not settings.QUERY_RUNNER_POOL_ENABLED
+            or not pools.enabled
+        ):
+            self._pool = None
+            return connect()
+
+        self._pool = pools.get(
+            self.data_source_id,
+            self.configuration,
+            lambda: ConnectionPool(connect, is_alive=is_alive, reset=reset),
+        )
+        return self._pool.acquire()
+
+    def _release_connection(self, connection, reusable=True):
+        if self._pool is None:
+            connection.close()
+        else:
+            self._pool.release(connection, reusable)
+
+    @property
+    def max_result_rows(self):
+        return int(self.configuration.get("max_result_rows") or settings.QUERY_RESULTS_MAX_ROWS)
+
+    @property
+    def max_result_bytes(self):
+        return int(self.configuration.get("max_result_bytes") or settings.QUERY_RESULTS_MAX_BYTES)
+
+    def _fetch_result(self, cursor, columns, encoder=JSONEncoder):
+        """
+        Streams the rows of `cursor` in batches of `QUERY_RESULTS_FETCH_BATCH_SIZE` into a
+        `StreamingResultWriter`, honoring this data source's row and size caps.
+        """
+        writer = StreamingResultWriter(
+            columns, self.max_result_rows, self.max_result_bytes, encoder
+        )
+
+        while True:
+            rows = cursor.fetchmany(settings.QUERY_RESULTS_FETCH_BATCH_SIZE)
+            if not rows or not writer.write(rows):
+                break
+
+        if writer.truncated:
+            logger.warning(
+                "Result truncated at %d rows (%d bytes).", writer.row_count, writer.byte_count
+            )
+
+        return writer
+
     def get_schema(self, get_stats=False):
         schema_dict = {}
         self._get_tables(schema_dict)
@@ -313,6 +495,27 @@ class BaseSQLQueryRunner(BaseQueryRunner):
             parsed_query.tokens += limit_tokens
         return str(parsed_query)
 
+    @property
+    def supports_incremental(self):
+        return True
+
+    def quote_identifier(self, name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def quote_literal(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return repr(value)
+
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def apply_watermark(self, query_text, column, watermark):
+        queries = split_sql_statements(query_text)
+        # Like auto limit, only the last statement produces the result.
+        queries[-1] = "SELECT * FROM (\n{}\n) AS incremental_source WHERE {} > {}".format(
+            queries[-1], self.quote_identifier(column), self.quote_literal(watermark)
+        )
+        return combine_sql_statements(queries)
+
     def apply_auto_limit(self, query_text, should_apply_auto_limit):
         if should_apply_auto_limit:
             queries = split_sql_statements(query_text)
@@ -5,6 +5,10 @@ from bi.query_runner import *
 
 logger = logging.getLogger(__name__)
 # step3
+from concurrent.futures import ThreadPoolExecutor
+
+from bi import redis_connection, settings
+from bi.query_runner.pool import configuration_hash
 from bi.settings import WEB_LANGUAGE
 from bi.utils import json_loads, parse_human_time  # step 6
 from dateutil.parser import parse  # step 6
@@ -73,54 +77,52 @@ def parse_oids(oids):
 
 
 # def 6-f2
-def parse_results(results):
+def parse_results(results, max_depth=1, max_rows=0):
+    """
+    Flattens documents into rows in a single pass. Nested documents become `parent.child`
+    columns down to `max_depth` levels (deeper values are kept as they are). Columns are
+    indexed by name, so each key costs one dict lookup. Stops after `max_rows` rows when
+    given; returns (rows, columns, truncated).
+    """
     rows = []
     columns = []
+    column_index = {}
+
+    def add_value(parsed_row, name, value, depth):
+        if isinstance(value, dict) and depth < max_depth:
+            for inner_key, inner_value in value.items():
+                add_value(parsed_row, "{}.{}".format(name, inner_key), inner_value, depth + 1)
+            return
+
+        if name not in column_index:
+            column = {
+                "name": name,
+                "friendly_name": name,
+                "type": TYPES_MAP.get(type(value), TYPE_STRING),
+            }
+            column_index[name] = column
+            columns.append(column)
 
-    for row in results:
-        parsed_row = {}
-
-        for key in row:
-            if isinstance(row[key], dict):
-                for inner_key in row[key]:
-                    column_name = "{}.{}".format(key, inner_key)
-                    if _get_column_by_name(columns, column_name) is None:
-                        columns.append(
-                            {
-                                "name": column_name,
-                                "friendly_name": column_name,
-                                "type": TYPES_MAP.get(
-                                    type(row[key][inner_key]), TYPE_STRING
-                                ),
-                            }
-                        )
-
-                    parsed_row[column_name] = row[key][inner_key]
+        parsed_row[name] = value
 
-            else:
-                if _get_column_by_name(columns, key) is None:
-                    columns.append(
-                        {
-                            "name": key,
-                            "friendly_name": key,
-                            "type": TYPES_MAP.get(type(row[key]), TYPE_STRING),
-                        }
-                    )
+    truncated = False
+    for row in results:
+        if max_rows and len(rows) >= max_rows:
+            truncated = True
+            break
 
-                parsed_row[key] = row[key]
+        parsed_row = {}
+        for key, value in row.items():
+            add_value(parsed_row, key, value, 0)
 
         rows.append(parsed_row)
 
-    return rows, columns
+    return rows, columns, truncated
 
 
-# def 6-f2-f1
-def _get_column_by_name(columns, column_name):
-    for c in columns:
-        if "name" in c and c["name"] == column_name:
-            return c
-
-    return None
+def _describe_field(stats):
+    """Describes a sampled field for the schema browser, e.g. "string, 87% of documents"."""
+    return "{}, {:.0%} of documents".format("/".join(stats["types"]), stats["presence"])
 
 
 # def 6-f3
@@ -176,6 +178,7 @@ class MongoDB(BaseQueryRunner):
                     "password": {"type": "string", "title": "密码"},
                     "dbName": {"type": "string", "title": "数据库名称"},
                     "replicaSetName": {"type": "string", "title": "副本集名称"},
+                    "max_result_rows": {"type": "number", "title": "最大结果行数 Max result rows"},
                 },
                 "secret": ["password"],
                 "required": ["connectionString", "dbName"],
@@ -189,6 +192,7 @@ class MongoDB(BaseQueryRunner):
                     "password": {"type": "string", "title": "Password"},
                     "dbName": {"type": "string", "title": "Authentication Database"},
                     "replicaSetName": {"type": "string", "title": "Replica Set Name"},
+                    "max_result_rows": {"type": "number", "title": "Max result rows"},
                 },
                 "secret": ["password"],  # this mark secret
                 "required": ["connectionString", "dbName"],  # mast input
@@ -223,66 +227,106 @@ class MongoDB(BaseQueryRunner):
 
     # step 5 get schema
     def get_schema(self, get_stats=False):
-        schema = {}
         db = self._get_db()  # get connect obj,
-        for collection_name in db.list_collection_names():
-            if collection_name.startswith("system."):
+        collection_names = [
+            name
+            for name in db.list_collection_names()
+            if not name.startswith("system.")
+        ]
+
+        fields = self._get_cached_fields(collection_names)
+        missing = [name for name in collection_names if fields.get(name) is None]
+        if missing:
+            # Sample the collections concurrently; the client is thread safe.
+            with ThreadPoolExecutor(settings.MONGODB_SCHEMA_CONCURRENCY) as executor:
+                sampled = executor.map(
+                    lambda name: self._get_collection_fields(db, name), missing
+                )
+                for collection_name, collection_fields in zip(missing, sampled):
+                    fields[collection_name] = collection_fields
+
+            self._cache_fields({name: fields[name] for name in missing})
+
+        schema = []
+        for collection_name in sorted(collection_names):
+            collection_fields = fields[collection_name]
+            if not collection_fields:
                 continue
-            columns = self._get_collection_fields(db, collection_name)
-            if columns:
-                schema[collection_name] = {
+
+            names = sorted(collection_fields)
+            schema.append(
+                {
                     "name": collection_name,
-                    "columns": sorted(columns),
-                    "comment": sorted(columns)
+                    "columns": names,
+                    "comment": [_describe_field(collection_fields[n]) for n in names],
                 }
+            )
+
+        return schema
+
+    def _fields_cache_key(self, collection_name):
+        return "mongodb:fields:{}:{}".format(
+            configuration_hash(self.configuration), collection_name
+        )
+
+    def _get_cached_fields(self, collection_names):
+        if not collection_names:
+            return {}
 
-        return list(schema.values())
+        cached = redis_connection.mget(
+            [self._fields_cache_key(name) for name in collection_names]
+        )
+        return {
+            name: json_loads(value) if value is not None else None
+            for name, value in zip(collection_names, cached)
+        }
+
+    def _cache_fields(self, fields):
+        pipe = redis_connection.pipeline()
+        for collection_name, collection_fields in fields.items():
+            # Failed samples ([]) are retried on the next refresh.
+            if collection_fields:
+                pipe.set(
+                    self._fields_cache_key(collection_name),
+                    json_dumps(collection_fields),
+                    ex=settings.MONGODB_SCHEMA_CACHE_TTL,
+                )
+        pipe.execute()
 
     # step 5-1 The method being called， return connection obj
     def _get_collection_fields(self, db, collection_name):
         # Since MongoDB is a document based database and each document doesn't have
-        # to have the same fields as another documet in the collection its a bit hard to
-        # show these attributes as fields in the schema.
-        #
-        # For now, the logic is to take the first and last documents (last is determined
-        # by the Natural Order (http://www.mongodb.org/display/DOCS/Sorting+and+Natural+Order)
-        # as we don't know the correct order. In most single server installations it would be
-        # fine. In replicaset when reading from non master it might not return the really last
-        # document written.
-        collection_is_a_view = self._is_collection_a_view(db, collection_name)
-        documents_sample = []
+        # to have the same fields as another document in the collection, fields are
+        # inferred from a random sample of documents ($sample reads random documents
+        # without scanning large collections). For each field, the share of sampled
+        # documents that have it and the types seen are kept.
         try:
-            if collection_is_a_view:
-                for d in db[collection_name].find().limit(2):
-                    documents_sample.append(d)
-            else:
-                for d in db[collection_name].find().sort([("$natural", 1)]).limit(1):
-                    documents_sample.append(d)
-
-                for d in db[collection_name].find().sort([("$natural", -1)]).limit(1):
-                    documents_sample.append(d)
+            documents_sample = list(
+                db[collection_name].aggregate(
+                    [{"$sample": {"size": settings.MONGODB_SCHEMA_SAMPLE_SIZE}}]
+                )
+            )
         except Exception as ex:
             template = "An exception of type {0} occurred. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
             logger.error(message)
-            return []
-        columns = []
-        for d in documents_sample:
-            self._merge_property_names(columns, d)
-        return columns
-
-    # STEP 5-1-1
-    def _is_collection_a_view(self, db, collection_name):
-        if "viewOn" in db[collection_name].options():
-            return True
-        else:
-            return False
+            return {}
 
-    # STEP 5-1-2
-    def _merge_property_names(self, columns, document):
-        for property in document:
-            if property not in columns:
-                columns.append(property)
+        counts = {}
+        types = {}
+        for d in documents_sample:
+            row, _, _ = parse_results([d], max_depth=settings.MONGODB_FLATTEN_DEPTH)
+            for name, value in row[0].items():
+                counts[name] = counts.get(name, 0) + 1
+                types.setdefault(name, set()).add(TYPES_MAP.get(type(value), TYPE_STRING))
+
+        return {
+            name: {
+                "presence": round(count / len(documents_sample), 4),
+                "types": sorted(types[name]),
+            }
+            for name, count in counts.items()
+        }
 
     # STEP 6
     def run_query(self, query, user):
@@ -344,11 +388,21 @@ class MongoDB(BaseQueryRunner):
                 cursor = cursor.limit(query_data["limit"])
 
             if "count" in query_data:
-                cursor = len(list(cursor))
+                # Let the server count instead of fetching every document.
+                count_options = {
+                    k: query_data[k] for k in ("skip", "limit") if query_data.get(k)
+                }
+                cursor = db[collection].count_documents(q or {}, **count_options)
+            else:
+                cursor = cursor.batch_size(settings.MONGODB_BATCH_SIZE)
 
         elif aggregate:
-            allow_disk_use = query_data.get("allowDiskUse", False)
-            r = db[collection].aggregate(aggregate, allowDiskUse=allow_disk_use)
+            allow_disk_use = query_data.get("allowDiskUse", settings.MONGODB_ALLOW_DISK_USE)
+            r = db[collection].aggregate(
+                aggregate,
+                allowDiskUse=allow_disk_use,
+                batchSize=settings.MONGODB_BATCH_SIZE,
+            )
 
             # Backwards compatibility with older pymongo versions.
             #
@@ -360,6 +414,7 @@ class MongoDB(BaseQueryRunner):
             else:
                 cursor = r
 
+        truncated = False
         if "count" in query_data:
             columns.append(
                 {"name": "count", "friendly_name": "count", "type": TYPE_INTEGER}
@@ -367,22 +422,31 @@ class MongoDB(BaseQueryRunner):
 
             rows.append({"count": cursor})
         else:
-            rows, columns = parse_results(cursor)
+            rows, columns, truncated = parse_results(
+                cursor,
+                max_depth=query_data.get("flattenDepth", settings.MONGODB_FLATTEN_DEPTH),
+                max_rows=int(
+                    self.configuration.get("max_result_rows")
+                    or settings.QUERY_RESULTS_MAX_ROWS
+                ),
+            )
+            if truncated and hasattr(cursor, "close"):
+                # Stop the server from preparing batches nobody will read.
+                cursor.close()
 
         if f:
-            ordered_columns = []
-            for k in sorted(f, key=f.get):
-                column = _get_column_by_name(columns, k)
-                if column:
-                    ordered_columns.append(column)
-
-            columns = ordered_columns
+            columns_by_name = {column["name"]: column for column in columns}
+            columns = [
+                columns_by_name[k] for k in sorted(f, key=f.get) if k in columns_by_name
+            ]
 
         if query_data.get("sortColumns"):
             reverse = query_data["sortColumns"] == "desc"
             columns = sorted(columns, key=lambda col: col["name"], reverse=reverse)
 
         data = {"columns": columns, "rows": rows}
+        if truncated:
+            data["truncated"] = True
         error = None
         json_data = json_dumps(data, cls=MongoDBJSONEncoder)
 
@@ -14,10 +14,11 @@ from bi.query_runner import (
     register,
 )
 from bi.settings import parse_boolean
-from bi.utils import json_dumps, json_loads
+from bi.utils import json_loads
 
 try:
     import MySQLdb
+    from MySQLdb.cursors import SSCursor
 
     enabled = True
 except ImportError:
@@ -51,6 +52,7 @@ class Result(object):
 
 class Mysql(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    explain_prefix = "EXPLAIN"
 
     @classmethod
     def configuration_schema(cls):
@@ -69,6 +71,8 @@ class Mysql(BaseSQLQueryRunner):
                 "connect_timeout": {"type": "number", "default": 60, "title": "连接超时 Timeout"},
                 "charset": {"type": "string", "default": "utf8", "title": "字符集 "},
                 "use_unicode": {"type": "boolean", "default": True, "title": "使用 Unicode"},
+                "max_result_rows": {"type": "number", "title": "最大结果行数 Max result rows"},
+                "max_result_bytes": {"type": "number", "title": "最大结果大小(字节) Max result size (bytes)"},
             },
             "order": ["host", "port", "user", "passwd", "db", "connect_timeout", "charset", "use_unicode"],
             "required": ["db"],
@@ -125,15 +129,65 @@ class Mysql(BaseSQLQueryRunner):
 
         return connection
 
-    def _get_tables(self, schema):
+    def _table_name(self, row):
+        if row["table_schema"] != self.configuration["db"]:
+            return "{}.{}".format(row["table_schema"], row["table_name"])
+
+        return row["table_name"]
+
+    def get_table_fingerprints(self):
+        query = """
+        SELECT col.table_schema as table_schema,
+               col.table_name as table_name,
+               COUNT(*) as column_count,
+               SUM(CRC32(CONCAT_WS(':', col.ordinal_position, col.column_name, col.column_comment))) as checksum
+        FROM `information_schema`.`columns` col
+        WHERE col.table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys')
+        GROUP BY col.table_schema, col.table_name;
+        """
+
+        results, error = self.run_query(query, None)
+
+        if error is not None:
+            self._handle_run_query_error(error)
+
+        return {
+            self._table_name(row): "{}:{}".format(row["column_count"], row["checksum"])
+            for row in json_loads(results)["rows"]
+        }
+
+    def get_tables_schema(self, table_names):
+        conditions = []
+        for name in table_names:
+            candidates = [(self.configuration["db"], name)]
+            if "." in name:
+                candidates.append(tuple(name.split(".", 1)))
+
+            conditions.extend(
+                "(col.table_schema = {} AND col.table_name = {})".format(
+                    self.quote_literal(table_schema), self.quote_literal(table_name)
+                )
+                for table_schema, table_name in candidates
+            )
+
+        if not conditions:
+            return []
+
+        schema = {}
+        self._get_tables(schema, " OR ".join(conditions))
+        names = set(table_names)
+        return [table for name, table in schema.items() if name in names]
+
+    def _get_tables(self, schema, condition=None):
         query = """
         SELECT col.table_schema as table_schema,
                col.table_name as table_name,
                col.column_name as column_name,
                col.column_comment as column_comment
         FROM `information_schema`.`columns` col
-        WHERE col.table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys');
-        """
+        WHERE col.table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys')
+        AND ({});
+        """.format(condition or "TRUE")
 
         results, error = self.run_query(query, None)
 
@@ -143,10 +197,7 @@ class Mysql(BaseSQLQueryRunner):
         results = json_loads(results)
 
         for row in results["rows"]:
-            if row["table_schema"] != self.configuration["db"]:
-                table_name = "{}.{}".format(row["table_schema"], row["table_name"])
-            else:
-                table_name = row["table_name"]
+            table_name = self._table_name(row)
 
             if table_name not in schema:
                 schema[table_name] = {"name": table_name, "columns": [], 'comment': []}
@@ -162,8 +213,13 @@ class Mysql(BaseSQLQueryRunner):
         r = Result()
         t = None
 
+        connection = None
+        reusable = False
+
         try:
-            connection = self._connection()
+            connection = self._acquire_connection(
+                self._connection, is_alive=self._ping, reset=self._reset_session
+            )
             thread_id = connection.thread_id()
             t = threading.Thread(
                 target=self._run_query, args=(query, user, connection, r, ev)
@@ -171,54 +227,82 @@ class Mysql(BaseSQLQueryRunner):
             t.start()
             while not ev.wait(1):
                 pass
+            reusable = r.reusable
         except (KeyboardInterrupt, InterruptException, JobTimeoutException):
             self._cancel(thread_id)
             t.join()
             raise
+        finally:
+            if connection:
+                self._release_connection(connection, reusable)
 
         return r.json_data, r.error
 
+    def _ping(self, connection):
+        connection.ping()
+
+    def _reset_session(self, connection):
+        # End the implicit transaction, so the next query doesn't read from its snapshot,
+        # and undo any USE statement the query ran.
+        connection.rollback()
+        connection.select_db(self.configuration["db"])
+
     def _run_query(self, query, user, connection, r, ev):
+        cursor = None
+        r.reusable = False
         try:
-            cursor = connection.cursor()
-            logger.debug("MySQL running query: %s", query)
+            # Unbuffered cursor: rows are streamed from the server in batches instead of
+            # being loaded into the worker's memory all at once.
+            cursor = connection.cursor(SSCursor)
+            logger.debug("%s running query: %s", self.name(), query)
             cursor.execute(query)
 
-            data = cursor.fetchall()
-            desc = cursor.description
-
-            while cursor.nextset():
+            writer = None
+            while True:
                 if cursor.description is not None:
-                    data = cursor.fetchall()
-                    desc = cursor.description
+                    columns = self.fetch_columns(
+                        [(i[0], types_map.get(i[1], None)) for i in cursor.description]
+                    )
+                    writer = self._fetch_result(cursor, columns)
 
-            # TODO - very similar to pg.py
-            if desc is not None:
-                columns = self.fetch_columns(
-                    [(i[0], types_map.get(i[1], None)) for i in desc]
-                )
-                rows = [
-                    dict(zip((column["name"] for column in columns), row))
-                    for row in data
-                ]
+                    # Reaching the next result set would require reading the rest of this one.
+                    if writer.truncated:
+                        break
 
-                data = {"columns": columns, "rows": rows}
-                r.json_data = json_dumps(data)
+                if not cursor.nextset():
+                    break
+
+            if writer is not None:
+                r.json_data = writer.getvalue()
                 r.error = None
             else:
                 r.json_data = None
                 r.error = "No data was returned."
 
-            cursor.close()
+            # Closing an unbuffered cursor reads the remaining rows; closing the connection
+            # doesn't, so connections left with unread rows are discarded instead of reused.
+            if writer is None or not writer.truncated:
+                cursor.close()
+                r.reusable = True
         except MySQLdb.Error as e:
             if cursor:
                 cursor.close()
             r.json_data = None
             r.error = e.args[1]
+            r.reusable = not isinstance(
+                e, (MySQLdb.OperationalError, MySQLdb.InterfaceError)
+            )
         finally:
             ev.set()
-            if connection:
-                connection.close()
+
+    def quote_identifier(self, name):
+        return "`{}`".format(name.replace("`", "``"))
+
+    def quote_literal(self, value):
+        # MySQL treats backslashes in string literals as escapes.
+        if isinstance(value, str):
+            value = value.replace("\\", "\\\\")
+        return super().quote_literal(value)
 
     def _get_ssl_parameters(self):
         if not self.configuration.get("use_ssl"):
@@ -298,12 +382,20 @@ class Doris(Mysql):
     def name(cls):
         return "Doris"
 
+    def get_table_fingerprints(self):
+        # CRC32 isn't available in every version; refresh the whole schema instead.
+        return None
+
 
 class StarRocks(Mysql):
     @classmethod
     def name(cls):
         return "StarRocks"
 
+    def get_table_fingerprints(self):
+        # CRC32 isn't available in every version; refresh the whole schema instead.
+        return None
+
 
 register(Mysql)
 register(Doris)
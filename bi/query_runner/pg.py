@@ -9,7 +9,7 @@ import psycopg2
 from psycopg2.extras import Range
 
 from bi.query_runner import *
-from bi.utils import JSONEncoder, json_dumps, json_loads
+from bi.utils import JSONEncoder, json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +76,18 @@ def full_table_name(schema, name):
     return "{}.{}".format(schema, name)
 
 
+def split_table_name(name):
+    """Returns the (schema, table) of a table name built by build_schema."""
+    if "." not in name:
+        return "public", name
+
+    schema, table = name.split(".", 1)
+    if table.startswith('"') and table.endswith('"'):
+        table = table[1:-1]
+
+    return schema, table
+
+
 def build_schema(query_result, schema):
     # By default we omit the public schema name from the table name. But there are
     # edge cases, where this might cause conflicts. For example:
@@ -138,6 +150,7 @@ def _get_ssl_config(configuration):
 
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    explain_prefix = "EXPLAIN"
 
     @classmethod
     def configuration_schema(cls):
@@ -149,6 +162,8 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "host": {"type": "string", "title": "服务器 Server", "default": "127.0.0.1"},
                 "port": {"type": "number", "title": "端口 Port", "default": 5432},
                 "dbname": {"type": "string", "title": "数据库 Database"},
+                "max_result_rows": {"type": "number", "title": "最大结果行数 Max result rows"},
+                "max_result_bytes": {"type": "number", "title": "最大结果大小(字节) Max result size (bytes)"},
                 "sslmode": {
                     "type": "string",
                     "title": "SSL模式",
@@ -174,6 +189,8 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "sslrootcertFile",
                 "sslcertFile",
                 "sslkeyFile",
+                "max_result_rows",
+                "max_result_bytes",
             ],
         }
 
@@ -206,7 +223,11 @@ class PostgreSQL(BaseSQLQueryRunner):
         c = composite type
         """
 
-        query = """
+        self._get_definitions(schema, self.tables_query)
+
+        return list(schema.values())
+
+    tables_query = """
         SELECT s.nspname as table_schema,
                c.relname as table_name,
                a.attname as column_name,
@@ -231,9 +252,66 @@ class PostgreSQL(BaseSQLQueryRunner):
         WHERE table_schema NOT IN ('pg_catalog', 'information_schema')
         """
 
-        self._get_definitions(schema, query)
+    def get_table_fingerprints(self):
+        # Tables and views are only listed by tables_query (through information_schema.columns)
+        # with the columns the user has privileges on, so the same columns are fingerprinted.
+        query = """
+        SELECT s.nspname as table_schema,
+               c.relname as table_name,
+               md5(string_agg(a.attname || ':' || format_type(a.atttypid, a.atttypmod), ',' ORDER BY a.attnum)) as fingerprint
+        FROM pg_class c
+        JOIN pg_namespace s
+        ON c.relnamespace = s.oid
+        AND s.nspname NOT IN ('pg_catalog', 'information_schema')
+        JOIN pg_attribute a
+        ON a.attrelid = c.oid
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+        WHERE c.relkind IN ('m', 'f', 'p')
+        OR (
+            c.relkind IN ('r', 'v')
+            AND (
+                pg_has_role(c.relowner, 'USAGE')
+                OR has_column_privilege(c.oid, a.attnum, 'SELECT, INSERT, UPDATE, REFERENCES')
+            )
+        )
+        GROUP BY s.nspname, c.relname
+        """
 
-        return list(schema.values())
+        results, error = self.run_query(query, None)
+
+        if error is not None:
+            self._handle_run_query_error(error)
+
+        rows = json_loads(results)["rows"]
+        # Name the tables the way build_schema does.
+        table_names = set(full_table_name(r["table_schema"], r["table_name"]) for r in rows)
+        fingerprints = {}
+        for row in rows:
+            if row["table_schema"] == "public" and row["table_name"] not in table_names:
+                name = row["table_name"]
+            else:
+                name = full_table_name(row["table_schema"], row["table_name"])
+            fingerprints[name] = row["fingerprint"]
+
+        return fingerprints
+
+    def get_tables_schema(self, table_names):
+        if not table_names:
+            return []
+
+        tables = ", ".join(
+            "({}, {})".format(self.quote_literal(table_schema), self.quote_literal(table))
+            for table_schema, table in map(split_table_name, table_names)
+        )
+        query = "SELECT * FROM ({}) AS tables WHERE (table_schema, table_name) IN ({})".format(
+            self.tables_query, tables
+        )
+
+        schema = {}
+        self._get_definitions(schema, query)
+        names = set(table_names)
+        return [table for name, table in schema.items() if name in names]
 
     def _get_connection(self):
         self.ssl_config = _get_ssl_config(self.configuration)
@@ -249,11 +327,20 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return connection
 
+    def _ping(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        _wait(connection, timeout=10)
+        cursor.close()
+
     def run_query(self, query, user):
-        connection = self._get_connection()
+        # Only set when a new connection is opened; pooled ones have no certificates to clean up.
+        self.ssl_config = {}
+        connection = self._acquire_connection(self._get_connection, is_alive=self._ping)
         _wait(connection, timeout=10)
 
         cursor = connection.cursor()
+        reusable = False
 
         try:
             cursor.execute(query)
@@ -263,28 +350,30 @@ class PostgreSQL(BaseSQLQueryRunner):
                 columns = self.fetch_columns(
                     [(i[0], types_map.get(i[1], None)) for i in cursor.description]
                 )
-                rows = [
-                    dict(zip((column["name"] for column in columns), row))
-                    for row in cursor
-                ]
-
-                data = {"columns": columns, "rows": rows}
+                # Asynchronous connections can't use named (server side) cursors, but
+                # converting and serializing in batches still avoids holding every row
+                # as Python objects next to the full JSON payload.
+                writer = self._fetch_result(cursor, columns, PostgreSQLJSONEncoder)
                 error = None
-                json_data = json_dumps(data, ignore_nan=True, cls=PostgreSQLJSONEncoder)
+                json_data = writer.getvalue()
             else:
                 error = "Query completed but it returned no data."
                 json_data = None
+            reusable = True
         except (select.error, OSError) as e:
             error = "Query interrupted. Please retry."
             json_data = None
         except psycopg2.DatabaseError as e:
             error = str(e)
             json_data = None
+            # Asynchronous connections are in autocommit mode, so a failed statement
+            # doesn't leave an aborted transaction behind.
+            reusable = not isinstance(e, psycopg2.OperationalError) and not connection.closed
         except (KeyboardInterrupt, InterruptException, JobTimeoutException):
             connection.cancel()
             raise
         finally:
-            connection.close()
+            self._release_connection(connection, reusable)
             _cleanup_ssl_certs(self.ssl_config)
 
         return json_data, error
@@ -299,6 +388,10 @@ class Redshift(PostgreSQL):
     def name(cls):
         return "Redshift"
 
+    def get_table_fingerprints(self):
+        # Redshift has no string_agg; refresh the whole schema instead.
+        return None
+
     def _get_connection(self):
         self.ssl_config = {}
 
@@ -548,6 +641,10 @@ class CockroachDB(PostgreSQL):
     def type(cls):
         return "cockroach"
 
+    def get_table_fingerprints(self):
+        # CockroachDB's pg_catalog emulation is incomplete; refresh the whole schema instead.
+        return None
+
 
 register(PostgreSQL)
 # register(Redshift)
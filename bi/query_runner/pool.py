@@ -0,0 +1,191 @@
+"""
+Per-process pools of data source connections for the SQL query runners.
+
+Pools are keyed by data source id and a hash of the data source's configuration, so
+editing a data source's options retires its old pool in every process the next time the
+data source is used. Idle connections are closed once they exceed the configured idle
+time and are health checked before reuse when they've been idle for a while.
+
+Pooling only pays off in long-lived processes. RQ work horses are forked for a single job,
+so it is disabled in them; connections are reused by workers running jobs in-process
+(`manage.py rq worker --no-fork`, used for the fast lane queues by default).
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from bi import settings
+from bi.utils import json_dumps
+
+logger = logging.getLogger(__name__)
+
+
+def configuration_hash(configuration):
+    if hasattr(configuration, "to_json"):
+        serialized = configuration.to_json()
+    else:
+        serialized = json_dumps(configuration, sort_keys=True)
+
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.debug("Failed closing pooled connection.", exc_info=True)
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `max_size` idle connections for reuse. When none is idle a new connection
+    is opened; connections released while the pool is full are closed, as before pooling.
+
+    `is_alive(connection)` is the health check run on connections idle for longer than
+    `health_check_interval` and `reset(connection)` restores session state on release.
+    Both return False (or raise) when the connection shouldn't be reused.
+    """
+
+    def __init__(
+        self,
+        connect,
+        is_alive=None,
+        reset=None,
+        max_size=None,
+        max_idle_time=None,
+        health_check_interval=None,
+    ):
+        self.connect = connect
+        self.is_alive = is_alive
+        self.reset = reset
+        self.max_size = (
+            max_size if max_size is not None else settings.QUERY_RUNNER_POOL_MAX_SIZE
+        )
+        self.max_idle_time = (
+            max_idle_time
+            if max_idle_time is not None
+            else settings.QUERY_RUNNER_POOL_MAX_IDLE_TIME
+        )
+        self.health_check_interval = (
+            health_check_interval
+            if health_check_interval is not None
+            else settings.QUERY_RUNNER_POOL_HEALTH_CHECK_INTERVAL
+        )
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _check(self, connection, idle_for):
+        if idle_for > self.max_idle_time:
+            return False
+
+        if self.is_alive is None or idle_for < self.health_check_interval:
+            return True
+
+        try:
+            return self.is_alive(connection) is not False
+        except Exception:
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, released_at = self._idle.pop()
+
+            if self._check(connection, time.time() - released_at):
+                return connection
+
+            _close(connection)
+
+        return self.connect()
+
+    def release(self, connection, reusable=True):
+        if reusable and self.reset is not None:
+            try:
+                reusable = self.reset(connection) is not False
+            except Exception:
+                reusable = False
+
+        with self._lock:
+            if reusable and not self._closed and len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time()))
+                return
+
+        _close(connection)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            _close(connection)
+
+
+class PoolRegistry(object):
+    def __init__(self):
+        self._pools = {}
+        self._inherited = []
+        self._lock = threading.Lock()
+        self.enabled = True
+
+    def disable(self):
+        """
+        Turns pooling off for the rest of this process. Used by processes that run a single
+        job and exit, such as RQ's forked work horses: their connections could never be
+        reused, so pooling would only add the reset and health check round trips.
+        """
+        self.enabled = False
+
+    def get(self, data_source_id, configuration, factory):
+        """
+        Returns the pool for the data source's current configuration, creating it with
+        `factory()` if needed. Pools built for an older configuration of the same data
+        source are closed.
+        """
+        key = configuration_hash(configuration)
+        stale = None
+
+        with self._lock:
+            current = self._pools.get(data_source_id)
+            if current is not None and current[0] == key:
+                return current[1]
+
+            if current is not None:
+                stale = current[1]
+
+            pool = factory()
+            self._pools[data_source_id] = (key, pool)
+
+        if stale is not None:
+            stale.close()
+
+        return pool
+
+    def invalidate(self, data_source_id):
+        with self._lock:
+            current = self._pools.pop(data_source_id, None)
+
+        if current is not None:
+            current[1].close()
+
+    def discard_all(self):
+        """
+        Stops handing out pools inherited from the parent process. Their connections are
+        kept referenced rather than closed, since closing them would also end the parent's
+        sessions over the shared sockets.
+        """
+        # Another thread may have held the lock when the process forked.
+        self._lock = threading.Lock()
+        self._inherited.extend(self._pools.values())
+        self._pools = {}
+
+
+pools = PoolRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=pools.discard_all)
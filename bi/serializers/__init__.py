@@ -3,14 +3,18 @@ This will eventually replace all the `to_dict` methods of the different model
 classes we have. This will ensure cleaner code and better
 separation of concerns.
 """
+from collections import defaultdict
+
 from funcy import project
+from sqlalchemy.orm import joinedload
 
 from flask_login import current_user
 from rq.job import JobStatus
 from rq.timeouts import JobTimeoutException
 
 from bi import models
-from bi.permissions import has_access, view_only
+from bi.metrics import prometheus as metrics
+from bi.permissions import has_access, has_access_to_groups, view_only
 from bi.utils import json_loads
 from bi.models.parameterized_query import ParameterizedQuery
 
@@ -19,6 +23,8 @@ from .query_result import (
     serialize_query_result,
     serialize_query_result_to_dsv,
     serialize_query_result_to_xlsx,
+    stream_query_result_to_dsv,
+    stream_query_result_to_xlsx,
 )
 
 
@@ -58,14 +64,49 @@ def public_dashboard(dashboard):
         ("name", "layout", "dashboard_filters_enabled", "updated_at", "created_at", "options"),
     )
 
-    widget_list = (
+    dashboard_dict["widgets"] = models.dashboard_cache.get_or_set(
+        dashboard.id,
+        "public",
+        lambda: [public_widget(w) for w in load_dashboard_widgets(dashboard)],
+    )
+    return dashboard_dict
+
+
+def load_dashboard_widgets(dashboard):
+    """
+    Loads the dashboard's widgets together with their visualizations, queries and the
+    queries' users in a single statement.
+    """
+    query_rel = joinedload(models.Widget.visualization).joinedload(
+        models.Visualization.query_rel
+    )
+    return (
         models.Widget.query.filter(models.Widget.dashboard_id == dashboard.id)
-        .outerjoin(models.Visualization)
-        .outerjoin(models.Query)
+        .options(
+            query_rel.joinedload(models.Query.user),
+            query_rel.joinedload(models.Query.last_modified_by),
+            query_rel.joinedload(models.Query.org),
+        )
+        .order_by(models.Widget.id)
+        .all()
     )
 
-    dashboard_dict["widgets"] = [public_widget(w) for w in widget_list]
-    return dashboard_dict
+
+def _data_source_groups(widgets):
+    """Returns the group permissions of the widgets' data sources, in one statement."""
+    data_source_ids = {
+        w.visualization.query_rel.data_source_id
+        for w in widgets
+        if w.visualization is not None
+    }
+    groups = defaultdict(dict)
+    if data_source_ids:
+        for group in models.DataSourceGroup.query.filter(
+            models.DataSourceGroup.data_source_id.in_(data_source_ids)
+        ):
+            groups[group.data_source_id][group.group_id] = group.view_only
+
+    return groups
 
 
 class Serializer(object):
@@ -77,6 +118,7 @@ class QuerySerializer(Serializer):
         self.object_or_list = object_or_list
         self.options = kwargs
 
+    @metrics.serialization_time.time(serializer="query")
     def serialize(self):
         if isinstance(self.object_or_list, models.Query):
             result = serialize_query(self.object_or_list, **self.options)
@@ -215,31 +257,71 @@ def serialize_alert(alert, full=True):
     return d
 
 
+def _restricted_widget(widget):
+    widget = project(
+        widget,
+        (
+            "id",
+            "width",
+            "dashboard_id",
+            "options",
+            "created_at",
+            "updated_at",
+        ),
+    )
+    widget["restricted"] = True
+    return widget
+
+
+def _serialize_dashboard_widgets(dashboard):
+    """
+    Serializes every widget along with the group permissions of its query's data source
+    (None for text widgets), so access can be checked without loading the queries again.
+    """
+    widgets = load_dashboard_widgets(dashboard)
+    groups = _data_source_groups(widgets)
+
+    return [
+        {
+            "widget": serialize_widget(w),
+            "groups": None
+            if w.visualization is None
+            else list(groups[w.visualization.query_rel.data_source_id].items()),
+        }
+        for w in widgets
+    ]
+
+
+@metrics.serialization_time.time(serializer="dashboard_widgets")
+def serialize_dashboard_widgets(dashboard, user):
+    if user and user.is_api_user():
+        # API keys are checked against the queries themselves (see has_access).
+        return [
+            serialize_widget(w)
+            if w.visualization is None
+            or has_access(w.visualization.query_rel, user, view_only)
+            else _restricted_widget(serialize_widget(w))
+            for w in load_dashboard_widgets(dashboard)
+        ]
+
+    entries = models.dashboard_cache.get_or_set(
+        dashboard.id, "widgets", lambda: _serialize_dashboard_widgets(dashboard)
+    )
+
+    return [
+        entry["widget"]
+        if entry["groups"] is None
+        or (user and has_access_to_groups(dict(entry["groups"]), user, view_only))
+        else _restricted_widget(entry["widget"])
+        for entry in entries
+    ]
+
+
 def serialize_dashboard(obj, with_widgets=False, user=None, with_favorite_state=True):
     layout = json_loads(obj.layout)
 
-    widgets = []
-
     if with_widgets:
-        for w in obj.widgets:
-            if w.visualization_id is None:
-                widgets.append(serialize_widget(w))
-            elif user and has_access(w.visualization.query_rel, user, view_only):
-                widgets.append(serialize_widget(w))
-            else:
-                widget = project(
-                    serialize_widget(w),
-                    (
-                        "id",
-                        "width",
-                        "dashboard_id",
-                        "options",
-                        "created_at",
-                        "updated_at",
-                    ),
-                )
-                widget["restricted"] = True
-                widgets.append(widget)
+        widgets = serialize_dashboard_widgets(obj, user)
     else:
         widgets = None
 
@@ -274,6 +356,7 @@ class DashboardSerializer(Serializer):
         self.object_or_list = object_or_list
         self.options = kwargs
 
+    @metrics.serialization_time.time(serializer="dashboard")
     def serialize(self):
         if isinstance(self.object_or_list, models.Dashboard):
             result = serialize_dashboard(self.object_or_list, **self.options)
@@ -298,13 +381,20 @@ class DashboardSerializer(Serializer):
         return result
 
 
+# Job statuses as the client knows them (the old Job class statuses).
+JOB_STATUS_QUEUED = 1
+JOB_STATUS_STARTED = 2
+JOB_STATUS_FINISHED = 3
+JOB_STATUS_FAILED = 4
+
+
 def serialize_job(job):
     # TODO: this is mapping to the old Job class statuses. Need to update the client side and remove this
     STATUSES = {
-        JobStatus.QUEUED: 1,
-        JobStatus.STARTED: 2,
-        JobStatus.FINISHED: 3,
-        JobStatus.FAILED: 4,
+        JobStatus.QUEUED: JOB_STATUS_QUEUED,
+        JobStatus.STARTED: JOB_STATUS_STARTED,
+        JobStatus.FINISHED: JOB_STATUS_FINISHED,
+        JobStatus.FAILED: JOB_STATUS_FAILED,
     }
 
     job_status = job.get_status()
@@ -318,13 +408,13 @@ def serialize_job(job):
 
     if job.is_cancelled:
         error = "Query cancelled by user."
-        status = 4
+        status = JOB_STATUS_FAILED
     elif isinstance(job.result, Exception):
         error = str(job.result)
-        status = 4
+        status = JOB_STATUS_FAILED
     elif isinstance(job.result, dict) and "error" in job.result:
         error = job.result["error"]
-        status = 4
+        status = JOB_STATUS_FAILED
     else:
         error = ""
         result = query_result_id = job.result
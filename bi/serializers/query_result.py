@@ -1,12 +1,17 @@
 import io
 import csv
+import os
+import tempfile
 import xlsxwriter
 from funcy import rpartial, project
 from dateutil.parser import isoparse as parse_date
+from bi.metrics import prometheus as metrics
 from bi.utils import json_loads, UnicodeWriter
 from bi.query_runner import TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME
 from bi.authentication.org_resolving import current_org
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def _convert_format(fmt):
     return (
@@ -71,53 +76,103 @@ def _get_column_lists(columns):
     return fieldnames, special_columns
 
 
-def serialize_query_result(query_result, is_api_user):
+def serialize_query_result(query_result, is_api_user, data=None):
     if is_api_user:
         publicly_needed_keys = ["data", "retrieved_at"]
-        return project(query_result.to_dict(), publicly_needed_keys)
+        return project(query_result.to_dict(data=data), publicly_needed_keys)
     else:
-        return query_result.to_dict()
+        return query_result.to_dict(data=data)
 
 
-def serialize_query_result_to_dsv(query_result, delimiter):
-    s = io.StringIO()
+def _dsv_chunks(columns, rows, delimiter, special_columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+    writer.writerow([col["name"] for col in columns])
 
-    query_data = query_result.data
+    # Resolve the converters to column positions once instead of looking them up per row.
+    converters = [
+        (index, special_columns[col["name"]])
+        for index, col in enumerate(columns)
+        if col["name"] in special_columns
+    ]
 
-    fieldnames, special_columns = _get_column_lists(query_data["columns"] or [])
+    for row in rows:
+        if converters:
+            row = list(row)
+            for index, converter in converters:
+                row[index] = converter(row[index])
 
-    writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=fieldnames, delimiter=delimiter)
-    writer.writeheader()
+        writer.writerow(row)
 
-    for row in query_data["rows"]:
-        for col_name, converter in special_columns.items():
-            if col_name in row:
-                row[col_name] = converter(row[col_name])
+        if buffer.tell() >= STREAM_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
-        writer.writerow(row)
+    yield buffer.getvalue()
 
-    return s.getvalue()
 
+def stream_query_result_to_dsv(query_result, delimiter):
+    """
+    Returns a generator of CSV/TSV text chunks, so large results can be sent while they're
+    being serialized. Column formats are resolved before the generator is returned, so it
+    doesn't need the request context while it runs.
+    """
+    columns, rows = query_result.columns_and_rows()
+    _, special_columns = _get_column_lists(columns)
+
+    return _dsv_chunks(columns, rows, delimiter, special_columns)
+
+
+@metrics.serialization_time.time(serializer="query_result_dsv")
+def serialize_query_result_to_dsv(query_result, delimiter):
+    return "".join(stream_query_result_to_dsv(query_result, delimiter))
 
-def serialize_query_result_to_xlsx(query_result):
-    output = io.BytesIO()
 
-    query_data = query_result.data
+def _write_xlsx(query_result, output):
+    columns, rows = query_result.columns_and_rows()
     book = xlsxwriter.Workbook(output, {"constant_memory": True})
     sheet = book.add_worksheet("result")
 
-    column_names = []
-    for c, col in enumerate(query_data["columns"]):
+    for c, col in enumerate(columns):
         sheet.write(0, c, col["name"])
-        column_names.append(col["name"])
 
-    for r, row in enumerate(query_data["rows"]):
-        for c, name in enumerate(column_names):
-            v = row.get(name)
+    for r, row in enumerate(rows):
+        for c, v in enumerate(row):
             if isinstance(v, (dict, list)):
                 v = str(v)
             sheet.write(r + 1, c, v)
 
     book.close()
 
-    return output.getvalue()
+
+def _stream_file(f):
+    with f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def stream_query_result_to_xlsx(query_result):
+    """
+    Writes the workbook to a temporary file and returns a generator of its contents. The
+    file is unlinked as soon as it's open, so its space is freed when the file is closed,
+    even if the generator is never iterated.
+    """
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+
+    try:
+        _write_xlsx(query_result, path)
+        f = open(path, "rb")
+    finally:
+        os.remove(path)
+
+    return _stream_file(f)
+
+
+@metrics.serialization_time.time(serializer="query_result_xlsx")
+def serialize_query_result_to_xlsx(query_result):
+    return b"".join(stream_query_result_to_xlsx(query_result))
@@ -35,6 +35,14 @@ STATSD_HOST = os.environ.get("DEEPBI_STATSD_HOST", "127.0.0.1")
 STATSD_PORT = int(os.environ.get("DEEPBI_STATSD_PORT", "8125"))
 STATSD_PREFIX = os.environ.get("DEEPBI_STATSD_PREFIX", "deepbi")
 STATSD_USE_TAGS = parse_boolean(os.environ.get("DEEPBI_STATSD_USE_TAGS", "false"))
+# Counters and histograms kept in Redis and exposed on /metrics (see bi.metrics.prometheus).
+METRICS_ENABLED = parse_boolean(os.environ.get("DEEPBI_METRICS_ENABLED", "true"))
+METRICS_PREFIX = os.environ.get("DEEPBI_METRICS_PREFIX", "deepbi")
+# Seconds a process may keep metric increments buffered before writing them to Redis.
+METRICS_FLUSH_INTERVAL = float(os.environ.get("DEEPBI_METRICS_FLUSH_INTERVAL", "5"))
+# Lets scrapers read /metrics with an "Authorization: Bearer <token>" header instead of a
+# super admin's session or API key.
+METRICS_AUTH_TOKEN = os.environ.get("DEEPBI_METRICS_AUTH_TOKEN", "")
 
 # Connection settings for Bi's own database (where we store the queries, results, etc)
 SQLALCHEMY_DATABASE_URI = os.environ.get(
@@ -57,14 +65,137 @@ RQ_REDIS_URL = os.environ.get("RQ_REDIS_URL", _REDIS_URL)
 QUERY_RESULTS_CLEANUP_ENABLED = parse_boolean(
     os.environ.get("DEEPBI_QUERY_RESULTS_CLEANUP_ENABLED", "true")
 )
+# Unused results are deleted QUERY_RESULTS_CLEANUP_COUNT at a time, each batch in its own
+# transaction, until none are left or the job has run for QUERY_RESULTS_CLEANUP_TIME_LIMIT seconds.
 QUERY_RESULTS_CLEANUP_COUNT = int(
-    os.environ.get("DEEPBI_QUERY_RESULTS_CLEANUP_COUNT", "100")
+    os.environ.get("DEEPBI_QUERY_RESULTS_CLEANUP_COUNT", "1000")
 )
 QUERY_RESULTS_CLEANUP_MAX_AGE = int(
     os.environ.get("DEEPBI_QUERY_RESULTS_CLEANUP_MAX_AGE", "7")
 )
+QUERY_RESULTS_CLEANUP_TIME_LIMIT = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_CLEANUP_TIME_LIMIT", "120")
+)
+# Once query_results is partitioned (`manage database partition_query_results`), the length
+# in days of each partition and how many are created ahead of time.
+QUERY_RESULTS_PARTITION_DAYS = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_PARTITION_DAYS", "7")
+)
+QUERY_RESULTS_PARTITIONS_AHEAD = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_PARTITIONS_AHEAD", "2")
+)
+
+# How QueryResult data is stored: "columnar" (compressed, see bi.utils.columnar) or "json" (legacy rows).
+# Columnar storage reads legacy JSON results transparently, so it can be enabled on existing installs.
+QUERY_RESULTS_STORAGE_FORMAT = os.environ.get(
+    "DEEPBI_QUERY_RESULTS_STORAGE_FORMAT", "columnar"
+)
+# Compression codec for columnar results: "zstd", "lz4" or "zlib" (falls back to zlib if not installed).
+QUERY_RESULTS_COMPRESSION = os.environ.get("DEEPBI_QUERY_RESULTS_COMPRESSION", "zstd")
+# Results smaller than this (in bytes of JSON) are kept as plain JSON.
+QUERY_RESULTS_COLUMNAR_MIN_SIZE = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_COLUMNAR_MIN_SIZE", "4096")
+)
+# Defaults for charts with downsampling enabled in their options (see bi.utils.downsampling):
+# points kept per line/scatter series, pie slices kept besides "Other", and cache lifetime.
+VISUALIZATION_DOWNSAMPLING_MAX_POINTS = int(
+    os.environ.get("DEEPBI_VISUALIZATION_DOWNSAMPLING_MAX_POINTS", "2000")
+)
+VISUALIZATION_DOWNSAMPLING_TOP_N = int(
+    os.environ.get("DEEPBI_VISUALIZATION_DOWNSAMPLING_TOP_N", "10")
+)
+VISUALIZATION_DOWNSAMPLING_CACHE_TTL = int(
+    os.environ.get("DEEPBI_VISUALIZATION_DOWNSAMPLING_CACHE_TTL", str(24 * 3600))
+)
+# Largest page of rows returned by /api/query_results/<id>?offset=&limit= (see QueryResultResource).
+QUERY_RESULTS_PAGE_MAX_LIMIT = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_PAGE_MAX_LIMIT", "10000")
+)
+# Number of dropdown queries whose values each process keeps to validate "query" parameters.
+PARAMETER_DROPDOWN_CACHE_SIZE = int(
+    os.environ.get("DEEPBI_PARAMETER_DROPDOWN_CACHE_SIZE", "200")
+)
+
+# SQL query runners fetch rows in batches of this size instead of loading the whole result at once.
+QUERY_RESULTS_FETCH_BATCH_SIZE = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_FETCH_BATCH_SIZE", "5000")
+)
+# Default caps for a single query result (0 means no limit). Results over the cap are truncated and
+# marked with "truncated": true. Data sources can override them with max_result_rows/max_result_bytes.
+QUERY_RESULTS_MAX_ROWS = int(os.environ.get("DEEPBI_QUERY_RESULTS_MAX_ROWS", "0"))
+QUERY_RESULTS_MAX_BYTES = int(os.environ.get("DEEPBI_QUERY_RESULTS_MAX_BYTES", "0"))
+
+# MongoDB: documents fetched per round trip, default allowDiskUse for aggregations (queries can
+# set their own) and how many levels of nested documents are flattened into "a.b" columns.
+MONGODB_BATCH_SIZE = int(os.environ.get("DEEPBI_MONGODB_BATCH_SIZE", "1000"))
+MONGODB_ALLOW_DISK_USE = parse_boolean(
+    os.environ.get("DEEPBI_MONGODB_ALLOW_DISK_USE", "false")
+)
+MONGODB_FLATTEN_DEPTH = int(os.environ.get("DEEPBI_MONGODB_FLATTEN_DEPTH", "1"))
+# MongoDB schemas are inferred from $sample of SAMPLE_SIZE documents per collection, sampling
+# up to CONCURRENCY collections at once. Each collection's fields are cached for CACHE_TTL seconds.
+MONGODB_SCHEMA_SAMPLE_SIZE = int(os.environ.get("DEEPBI_MONGODB_SCHEMA_SAMPLE_SIZE", "1000"))
+MONGODB_SCHEMA_CONCURRENCY = int(os.environ.get("DEEPBI_MONGODB_SCHEMA_CONCURRENCY", "8"))
+MONGODB_SCHEMA_CACHE_TTL = int(os.environ.get("DEEPBI_MONGODB_SCHEMA_CACHE_TTL", "3600"))
+
+# Hot cache of the latest result per (data source, query hash), kept in Redis in front of
+# QueryResult.get_latest. MAX_SIZE is the total payload budget in bytes; least recently used
+# entries are evicted beyond it. Results larger than MAX_ENTRY_SIZE are never cached.
+QUERY_RESULTS_CACHE_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_QUERY_RESULTS_CACHE_ENABLED", "true")
+)
+QUERY_RESULTS_CACHE_MAX_SIZE = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_CACHE_MAX_SIZE", str(256 * 1024 * 1024))
+)
+QUERY_RESULTS_CACHE_MAX_ENTRY_SIZE = int(
+    os.environ.get("DEEPBI_QUERY_RESULTS_CACHE_MAX_ENTRY_SIZE", str(8 * 1024 * 1024))
+)
+QUERY_RESULTS_CACHE_TTL = int(os.environ.get("DEEPBI_QUERY_RESULTS_CACHE_TTL", "86400"))
+
+# Cache serialized dashboard widgets in Redis (see bi.models.dashboard_cache). Entries are
+# invalidated on widget, visualization, query and dashboard edits; the TTL bounds staleness
+# of anything else they include, such as query owners' names.
+DASHBOARD_CACHE_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_DASHBOARD_CACHE_ENABLED", "true")
+)
+DASHBOARD_CACHE_TTL = int(os.environ.get("DEEPBI_DASHBOARD_CACHE_TTL", "600"))
+
+# Store result payloads once per organization and content hash, shared between results (see
+# bi.models.QueryResultBlob). A re-run returning the same data only updates the previous result.
+QUERY_RESULTS_DEDUP_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_QUERY_RESULTS_DEDUP_ENABLED", "true")
+)
+
+# Per-process pools of data source connections used by the SQL query runners, effective in
+# workers that don't fork a work horse per job (see RQ_WORKER_FORK_JOBS). MAX_SIZE is the
+# number of idle connections kept per data source; connections idle for longer than
+# HEALTH_CHECK_INTERVAL seconds are pinged before reuse and closed after MAX_IDLE_TIME.
+QUERY_RUNNER_POOL_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_QUERY_RUNNER_POOL_ENABLED", "true")
+)
+QUERY_RUNNER_POOL_MAX_SIZE = int(os.environ.get("DEEPBI_QUERY_RUNNER_POOL_MAX_SIZE", "2"))
+QUERY_RUNNER_POOL_MAX_IDLE_TIME = int(
+    os.environ.get("DEEPBI_QUERY_RUNNER_POOL_MAX_IDLE_TIME", "300")
+)
+QUERY_RUNNER_POOL_HEALTH_CHECK_INTERVAL = int(
+    os.environ.get("DEEPBI_QUERY_RUNNER_POOL_HEALTH_CHECK_INTERVAL", "30")
+)
 
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("DEEPBI_SCHEMAS_REFRESH_SCHEDULE", 30))
+# Time limit of a scheduled schema refresh job, with per data source overrides given as
+# "<data source id>:<seconds>" pairs, e.g. "3:900".
+SCHEMA_REFRESH_TIME_LIMIT = int(os.environ.get("DEEPBI_SCHEMA_REFRESH_TIME_LIMIT", "300"))
+SCHEMA_REFRESH_TIME_LIMITS = {
+    int(data_source_id): int(limit)
+    for data_source_id, limit in (
+        pair.split(":")
+        for pair in array_from_string(
+            os.environ.get("DEEPBI_SCHEMA_REFRESH_TIME_LIMITS", "")
+        )
+    )
+}
+# Number of changed tables fetched per query by incremental schema refreshes.
+SCHEMA_REFRESH_BATCH_SIZE = int(os.environ.get("DEEPBI_SCHEMA_REFRESH_BATCH_SIZE", "200"))
 
 AUTH_TYPE = os.environ.get("DEEPBI_AUTH_TYPE", "api_key")
 INVITATION_TOKEN_MAX_AGE = int(
@@ -264,6 +395,12 @@ SCHEDULED_QUERY_TIME_LIMIT = int(
 ADHOC_QUERY_TIME_LIMIT = int(os.environ.get("DEEPBI_ADHOC_QUERY_TIME_LIMIT", -1))
 
 JOB_EXPIRY_TIME = int(os.environ.get("DEEPBI_JOB_EXPIRY_TIME", 3600 * 12))
+# Longest a request to /api/jobs/<id>?wait=<seconds> is held open waiting for the job to change,
+# which the frontend then asks for between its polls. Off by default: the web server runs sync
+# gunicorn workers, each tied up for the whole wait; enable it with an async worker class.
+JOB_EVENTS_MAX_WAIT = float(os.environ.get("DEEPBI_JOB_EVENTS_MAX_WAIT", "0"))
+# Number of query locks read (and their jobs fetched) per round trip when removing ghost locks.
+GHOST_LOCKS_BATCH_SIZE = int(os.environ.get("DEEPBI_GHOST_LOCKS_BATCH_SIZE", "500"))
 JOB_DEFAULT_FAILURE_TTL = int(
     os.environ.get("DEEPBI_JOB_DEFAULT_FAILURE_TTL", 7 * 24 * 60 * 60)
 )
@@ -283,6 +420,71 @@ RQ_WORKER_JOB_LOG_FORMAT = os.environ.get(
                      "job.id=%(job_id)s %(message)s"
     ),
 )
+# Runtime-aware routing of query jobs (see bi.tasks.queries.routing). Queries whose rolling runtime
+# estimate is at most FAST_THRESHOLD seconds go to "<queue>_fast", those of at least SLOW_THRESHOLD
+# seconds to "<queue>_slow". Workers for custom data source queues need to listen on the lanes too.
+QUERY_ROUTING_ENABLED = parse_boolean(os.environ.get("DEEPBI_QUERY_ROUTING_ENABLED", "false"))
+QUERY_ROUTING_FAST_THRESHOLD = float(
+    os.environ.get("DEEPBI_QUERY_ROUTING_FAST_THRESHOLD", "5")
+)
+QUERY_ROUTING_SLOW_THRESHOLD = float(
+    os.environ.get("DEEPBI_QUERY_ROUTING_SLOW_THRESHOLD", "60")
+)
+# Weight of the latest runtime in the rolling estimate, and how long an estimate is kept unused.
+QUERY_ROUTING_ESTIMATE_WEIGHT = float(
+    os.environ.get("DEEPBI_QUERY_ROUTING_ESTIMATE_WEIGHT", "0.3")
+)
+QUERY_ROUTING_ESTIMATE_TTL = int(
+    os.environ.get("DEEPBI_QUERY_ROUTING_ESTIMATE_TTL", str(30 * 24 * 3600))
+)
+
+# Maximum number of queries running at once against a single data source, across all workers
+# (0 means unlimited). DATA_SOURCE_CONCURRENCY_LIMITS overrides it per data source as
+# "<data source id>:<limit>" pairs, e.g. "3:2,7:10". Jobs of a data source at its limit are handed
+# to the RQ scheduler, which puts them back at the end of their queue after RETRY_DELAY seconds
+# (checked every 5 seconds), while the worker moves on to other jobs.
+DATA_SOURCE_CONCURRENCY_LIMIT = int(
+    os.environ.get("DEEPBI_DATA_SOURCE_CONCURRENCY_LIMIT", "0")
+)
+DATA_SOURCE_CONCURRENCY_LIMITS = {
+    int(data_source_id): int(limit)
+    for data_source_id, limit in (
+        pair.split(":")
+        for pair in array_from_string(
+            os.environ.get("DEEPBI_DATA_SOURCE_CONCURRENCY_LIMITS", "")
+        )
+    )
+}
+DATA_SOURCE_CONCURRENCY_RETRY_DELAY = float(
+    os.environ.get("DEEPBI_DATA_SOURCE_CONCURRENCY_RETRY_DELAY", "1")
+)
+
+# Queries running for SLOW_QUERY_THRESHOLD seconds or more are recorded in the slow query log
+# (see bi.models.slow_query_log), with per data source overrides given as
+# "<data source id>:<seconds>" pairs in SLOW_QUERY_THRESHOLDS. The log keeps the last
+# SLOW_QUERY_LOG_SIZE entries, and an EXPLAIN plan of each when the data source supports it.
+SLOW_QUERY_LOG_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_SLOW_QUERY_LOG_ENABLED", "true")
+)
+SLOW_QUERY_THRESHOLD = float(os.environ.get("DEEPBI_SLOW_QUERY_THRESHOLD", "30"))
+SLOW_QUERY_THRESHOLDS = {
+    int(data_source_id): float(threshold)
+    for data_source_id, threshold in (
+        pair.split(":")
+        for pair in array_from_string(os.environ.get("DEEPBI_SLOW_QUERY_THRESHOLDS", ""))
+    )
+}
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("DEEPBI_SLOW_QUERY_LOG_SIZE", "1000"))
+SLOW_QUERY_EXPLAIN_ENABLED = parse_boolean(
+    os.environ.get("DEEPBI_SLOW_QUERY_EXPLAIN_ENABLED", "true")
+)
+
+# RQ workers run every job in a forked work horse, where connection pooling is disabled since
+# the horse exits after the job. Disabling this runs jobs in the worker process itself, which
+# lets pooled connections be reused across jobs, at the cost of the hard time limit enforced
+# by the parent worker and of cancelling jobs that are already running. The fast lane workers
+# started by the docker entrypoint don't fork regardless (see FAST_WORKER_FORK there).
+RQ_WORKER_FORK_JOBS = parse_boolean(os.environ.get("DEEPBI_RQ_WORKER_FORK_JOBS", "true"))
 
 # Mail settings:
 MAIL_SERVER = os.environ.get("DEEPBI_MAIL_SERVER", "localhost")
@@ -314,6 +516,15 @@ MAX_FAILURE_REPORTS_PER_QUERY = int(
 ALERTS_DEFAULT_MAIL_SUBJECT_TEMPLATE = os.environ.get(
     "DEEPBI_ALERTS_DEFAULT_MAIL_SUBJECT_TEMPLATE", "({state}) {alert_name}"
 )
+# Seconds during which new results of a query share a single alert check (0 checks every result
+# right away), and how many notifications are sent at once and for how long each may take.
+ALERTS_COALESCE_WINDOW = int(os.environ.get("DEEPBI_ALERTS_COALESCE_WINDOW", "10"))
+ALERTS_NOTIFICATION_CONCURRENCY = int(
+    os.environ.get("DEEPBI_ALERTS_NOTIFICATION_CONCURRENCY", "8")
+)
+ALERTS_NOTIFICATION_TIMEOUT = int(
+    os.environ.get("DEEPBI_ALERTS_NOTIFICATION_TIMEOUT", "30")
+)
 
 # How many requests are allowed per IP to the login page before
 # being throttled?
@@ -25,7 +25,7 @@ def periodic_jobs():
 
 
 # This provides the ability to override the way we store QueryResult's data column.
-# Reference implementation: bi.models.DBPersistence
+# Reference implementations: bi.models.DBPersistence and bi.models.ColumnarPersistence
 QueryResultPersistence = None
 
 
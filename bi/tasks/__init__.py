@@ -5,6 +5,7 @@ from .general import (
 )
 from .queries import (
     enqueue_query,
+    enqueue_queries,
     execute_query,
     refresh_queries,
     refresh_schemas,
@@ -14,7 +15,7 @@ from .queries import (
 )
 from .alerts import check_alerts_for_query
 from .failure_report import send_aggregated_errors
-from .worker import Worker, Queue, Job
+from .worker import Worker, Queue, Job, BiSimpleWorker
 from .schedule import rq_scheduler, schedule_periodic_jobs, periodic_job_definitions
 
 from bi import rq_redis_connection
@@ -1,21 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import current_app
 import datetime
 from bi.worker import job, get_job_logger
-from bi import models, utils
+from bi import models, redis_connection, settings, statsd_client, utils
 
 
 logger = get_job_logger(__name__)
 
+PENDING_KEY_PREFIX = "alerts:pending"
+
+
+def _pending_key(query_id):
+    return "{}:{}".format(PENDING_KEY_PREFIX, query_id)
+
+
+def schedule_alert_checks(query_ids):
+    """
+    Enqueues an alert check for each of the queries that have alerts. With
+    ALERTS_COALESCE_WINDOW set, the check runs after the window and any other result of the
+    query within it is covered by the same check.
+    """
+    if not query_ids:
+        return
+
+    query_ids = [
+        query_id
+        for (query_id,) in models.db.session.query(models.Alert.query_id)
+        .filter(models.Alert.query_id.in_(set(query_ids)))
+        .distinct()
+    ]
+    if not query_ids:
+        return
+
+    window = settings.ALERTS_COALESCE_WINDOW
+    if window <= 0:
+        for query_id in query_ids:
+            check_alerts_for_query.delay(query_id)
+        return
+
+    from bi.tasks.schedule import rq_scheduler
+
+    pipe = redis_connection.pipeline()
+    for query_id in query_ids:
+        # Outlives the window, so a stalled scheduler doesn't block checks for long.
+        pipe.set(_pending_key(query_id), 1, nx=True, ex=window * 2 + 60)
+
+    for query_id, pending in zip(query_ids, pipe.execute()):
+        if not pending:
+            logger.debug("Alert check for query %d already scheduled.", query_id)
+            continue
+
+        rq_scheduler.enqueue_in(
+            datetime.timedelta(seconds=window),
+            check_alerts_for_query,
+            query_id,
+            queue_name="default",
+            timeout=300,
+        )
+
 
-def notify_subscriptions(alert, new_state):
-    host = utils.base_url(alert.query_rel.org)
-    for subscription in alert.subscriptions:
+def _notify(app, subscription_id, alert_id, new_state, host):
+    # ORM objects can't be shared across threads, so each notification loads its own from a
+    # session of its own (the scoped session is per thread).
+    with app.app_context():
         try:
+            alert = models.Alert.query.get(alert_id)
+            subscription = models.AlertSubscription.query.get(subscription_id)
+            if alert is None or subscription is None:
+                return
+
             subscription.notify(
-                alert, alert.query_rel, subscription.user, new_state, current_app, host
+                alert, alert.query_rel, subscription.user, new_state, app, host
+            )
+        finally:
+            models.db.session.remove()
+
+
+def notify_subscriptions(notifications):
+    """
+    Notifies the subscribers of each (alert, new_state) pair concurrently. Notifications
+    still running after ALERTS_NOTIFICATION_TIMEOUT seconds are logged and counted, and the
+    ones that didn't start are cancelled.
+    """
+    app = current_app._get_current_object()
+    tasks = []
+    for alert, new_state in notifications:
+        host = utils.base_url(alert.query_rel.org)
+        for subscription in alert.subscriptions:
+            tasks.append((subscription.id, alert.id, new_state, host))
+
+    if not tasks:
+        return
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(settings.ALERTS_NOTIFICATION_CONCURRENCY, len(tasks))
+    )
+    futures = {executor.submit(_notify, app, *task): task for task in tasks}
+    done, not_done = wait(futures, timeout=settings.ALERTS_NOTIFICATION_TIMEOUT)
+    executor.shutdown(wait=False)
+
+    for future in done:
+        if future.exception() is not None:
+            subscription_id, alert_id = futures[future][:2]
+            logger.error(
+                "Error with processing destination of alert %d (subscription %d)",
+                alert_id,
+                subscription_id,
+                exc_info=future.exception(),
             )
-        except Exception as e:
-            logger.exception("Error with processing destination")
+
+    for future in not_done:
+        subscription_id, alert_id = futures[future][:2]
+        started = not future.cancel()
+        logger.warning(
+            "Notification of alert %d (subscription %d) %s after %ss.",
+            alert_id,
+            subscription_id,
+            "timed out" if started else "cancelled",
+            settings.ALERTS_NOTIFICATION_TIMEOUT,
+        )
+
+    if not_done:
+        statsd_client.incr("alerts.notifications.timed_out", len(not_done))
 
 
 def should_notify(alert, new_state):
@@ -34,12 +140,19 @@ def should_notify(alert, new_state):
 @job("default", timeout=300)
 def check_alerts_for_query(query_id):
     logger.debug("Checking query %d for alerts", query_id)
+    # Results arriving from now on need a check of their own.
+    redis_connection.delete(_pending_key(query_id))
 
     query = models.Query.query.get(query_id)
+    if query is None or not query.alerts or query.latest_query_data is None:
+        return
 
+    new_states = models.Alert.evaluate_many(query.alerts, query.latest_query_data)
+
+    notifications = []
     for alert in query.alerts:
         logger.info("Checking alert (%d) of query %d.", alert.id, query_id)
-        new_state = alert.evaluate()
+        new_state = new_states[alert.id]
 
         if should_notify(alert, new_state):
             logger.info("Alert %d new state: %s", alert.id, new_state)
@@ -47,7 +160,6 @@ def check_alerts_for_query(query_id):
 
             alert.state = new_state
             alert.last_triggered_at = utils.utcnow()
-            models.db.session.commit()
 
             if (
                 old_state == models.Alert.UNKNOWN_STATE
@@ -62,4 +174,7 @@ def check_alerts_for_query(query_id):
                 logger.debug("Skipping notification (alert muted).")
                 continue
 
-            notify_subscriptions(alert, new_state)
+            notifications.append((alert, new_state))
+
+    models.db.session.commit()
+    notify_subscriptions(notifications)
@@ -7,26 +7,98 @@ from rq.job import JobStatus
 from rq.timeouts import JobTimeoutException
 from rq.exceptions import NoSuchJobError
 
-from bi import models, redis_connection, settings
+from funcy import chunks, distinct
+
+from bi import models, redis_connection, rq_redis_connection, settings
 from bi.query_runner import InterruptException
 from bi.tasks.worker import Queue, Job
-from bi.tasks.alerts import check_alerts_for_query
+from bi.tasks.alerts import schedule_alert_checks
 from bi.tasks.failure_report import track_failure
-from bi.utils import gen_query_hash, json_dumps, utcnow
+from bi.utils import gen_query_hash, job_events, json_dumps, json_loads, utcnow
+from bi.utils.key_index import KeyIndex
+from bi.metrics import prometheus as metrics
+from bi.utils.incremental import (
+    incremental_options,
+    merge as incremental_merge,
+    watermark as incremental_watermark,
+)
 from bi.worker import get_job_logger
 
+from .routing import route_queue, runtime_estimates
+from .slow_queries import record_slow_query
+
 logger = get_job_logger(__name__)
 TIMEOUT_MESSAGE = "Query exceeded Bi query execution time limit."
 
 
+# Index of the query locks, so remove_ghost_locks can list them without KEYS.
+job_locks = KeyIndex("query_hash_job_index")
+
+
 def _job_lock_id(query_hash, data_source_id):
     return "query_hash_job:%s:%s" % (data_source_id, query_hash)
 
 
+def _lock(pipe, lock_id, job_id):
+    pipe.set(lock_id, job_id, settings.JOB_EXPIRY_TIME)
+    job_locks.add(lock_id, settings.JOB_EXPIRY_TIME, pipe=pipe)
+
+
 def _unlock(query_hash, data_source_id):
-    redis_connection.delete(_job_lock_id(query_hash, data_source_id))
+    lock_id = _job_lock_id(query_hash, data_source_id)
+    pipe = redis_connection.pipeline()
+    pipe.delete(lock_id)
+    job_locks.remove(lock_id, pipe=pipe)
+    pipe.execute()
+
+
+def _enqueue_kwargs(
+    data_source, user_id, is_api_key, scheduled_query, metadata, runtime_estimate=None
+):
+    if scheduled_query:
+        queue_name = data_source.scheduled_queue_name
+        scheduled_query_id = scheduled_query.id
+    else:
+        queue_name = data_source.queue_name
+        scheduled_query_id = None
+
+    queue_name = route_queue(queue_name, runtime_estimate)
+
+    time_limit = settings.dynamic_settings.query_time_limit(
+        scheduled_query, user_id, data_source.org_id
+    )
+    metadata["Queue"] = queue_name
 
+    enqueue_kwargs = {
+        "user_id": user_id,
+        "scheduled_query_id": scheduled_query_id,
+        "is_api_key": is_api_key,
+        "job_timeout": time_limit,
+        "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
+        "meta": {
+            "data_source_id": data_source.id,
+            "org_id": data_source.org_id,
+            "scheduled": scheduled_query_id is not None,
+            "query_id": metadata.get("query_id"),
+            "user_id": user_id,
+        },
+    }
 
+    if not scheduled_query:
+        enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
+
+    return queue_name, enqueue_kwargs
+
+
+def _lock_is_relevant(job):
+    if job is None:
+        return False
+
+    status = job.get_status(refresh=False)
+    return status not in [JobStatus.FINISHED, JobStatus.FAILED] and not job.is_cancelled
+
+
+@metrics.enqueue_time.time()
 def enqueue_query(
     query, data_source, user_id, is_api_key=False, scheduled_query=None, metadata={}
 ):
@@ -66,53 +138,34 @@ def enqueue_query(
 
                 if lock_is_irrelevant:
                     logger.info("[%s] %s, removing lock", query_hash, message)
-                    redis_connection.delete(_job_lock_id(query_hash, data_source.id))
+                    _unlock(query_hash, data_source.id)
                     job = None
 
+            outcome = "reused"
             if not job:
+                outcome = "created"
                 pipe.multi()
 
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-
-                time_limit = settings.dynamic_settings.query_time_limit(
-                    scheduled_query, user_id, data_source.org_id
+                runtime_estimate = (
+                    runtime_estimates.get(data_source.id, query_hash)
+                    if settings.QUERY_ROUTING_ENABLED
+                    else None
+                )
+                queue_name, enqueue_kwargs = _enqueue_kwargs(
+                    data_source,
+                    user_id,
+                    is_api_key,
+                    scheduled_query,
+                    metadata,
+                    runtime_estimate,
                 )
-                metadata["Queue"] = queue_name
-
                 queue = Queue(queue_name)
-                enqueue_kwargs = {
-                    "user_id": user_id,
-                    "scheduled_query_id": scheduled_query_id,
-                    "is_api_key": is_api_key,
-                    "job_timeout": time_limit,
-                    "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
-                    "meta": {
-                        "data_source_id": data_source.id,
-                        "org_id": data_source.org_id,
-                        "scheduled": scheduled_query_id is not None,
-                        "query_id": metadata.get("query_id"),
-                        "user_id": user_id,
-                    },
-                }
-
-                if not scheduled_query:
-                    enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
-
                 job = queue.enqueue(
                     execute_query, query, data_source.id, metadata, **enqueue_kwargs
                 )
 
                 logger.info("[%s] Created new job: %s", query_hash, job.id)
-                pipe.set(
-                    _job_lock_id(query_hash, data_source.id),
-                    job.id,
-                    settings.JOB_EXPIRY_TIME,
-                )
+                _lock(pipe, _job_lock_id(query_hash, data_source.id), job.id)
                 pipe.execute()
             break
 
@@ -121,10 +174,169 @@ def enqueue_query(
 
     if not job:
         logger.error("[Manager][%s] Failed adding job for query.", query_hash)
+    else:
+        metrics.jobs_enqueued.inc(data_source_id=data_source.id, outcome=outcome)
 
     return job
 
 
+@metrics.enqueue_time.time()
+def enqueue_queries(requests, batch_size=500):
+    """
+    Bulk version of enqueue_query. `requests` is a list of dicts with enqueue_query's
+    arguments; returns the job for each of them, in order. None marks the requests of a batch
+    that still conflicted with other enqueues after its retries; callers should fall back to
+    enqueue_query for them.
+
+    Locks are read, existing jobs fetched and new jobs and locks written with a handful of
+    pipelined round trips per batch. As in enqueue_query, a lock pointing at a job that is
+    still queued or running is reused, and the lock keys of a batch are WATCHed so a batch
+    that races with another enqueue is retried.
+    """
+    jobs = []
+    for batch in chunks(batch_size, requests):
+        jobs.extend(_enqueue_batch(batch))
+
+    return jobs
+
+
+def _withdraw(jobs):
+    """Cancels jobs that were pushed without taking their locks."""
+    pipe = rq_redis_connection.pipeline()
+    for job in jobs:
+        job.cancel(pipeline=pipe)
+    pipe.execute()
+
+
+def _enqueue_batch(requests):
+    requests = [dict(request) for request in requests]
+    for request in requests:
+        request.setdefault("is_api_key", False)
+        request.setdefault("scheduled_query", None)
+        request.setdefault("metadata", {})
+        request["query_hash"] = gen_query_hash(request["query"])
+        request["lock_id"] = _job_lock_id(
+            request["query_hash"], request["data_source"].id
+        )
+
+    if settings.QUERY_ROUTING_ENABLED:
+        estimates = runtime_estimates.get_many(
+            [(r["data_source"].id, r["query_hash"]) for r in requests]
+        )
+        for request, estimate in zip(requests, estimates):
+            request["runtime_estimate"] = estimate
+
+    lock_ids = list(distinct(request["lock_id"] for request in requests))
+    jobs_by_lock = {}
+    new_jobs = []
+
+    for _ in range(5):
+        pipe = redis_connection.pipeline()
+        try:
+            pipe.watch(*lock_ids)
+            job_ids = dict(zip(lock_ids, pipe.mget(lock_ids)))
+
+            existing_ids = [job_id for job_id in job_ids.values() if job_id]
+            existing = dict(
+                zip(
+                    existing_ids,
+                    Job.fetch_many(existing_ids, connection=rq_redis_connection),
+                )
+            )
+
+            jobs_by_lock = {}
+            new_jobs = []
+            for request in requests:
+                lock_id = request["lock_id"]
+                if lock_id in jobs_by_lock:
+                    continue
+
+                job = existing.get(job_ids[lock_id])
+                if _lock_is_relevant(job):
+                    logger.info(
+                        "[%s] Found existing job: %s", request["query_hash"], job.id
+                    )
+                    jobs_by_lock[lock_id] = job
+                    continue
+
+                queue_name, enqueue_kwargs = _enqueue_kwargs(
+                    request["data_source"],
+                    request["user_id"],
+                    request["is_api_key"],
+                    request["scheduled_query"],
+                    request["metadata"],
+                    request.get("runtime_estimate"),
+                )
+                queue = Queue(queue_name)
+                job = queue.create_job(
+                    execute_query,
+                    args=(
+                        request["query"],
+                        request["data_source"].id,
+                        request["metadata"],
+                    ),
+                    kwargs={
+                        key: enqueue_kwargs.pop(key)
+                        for key in ("user_id", "scheduled_query_id", "is_api_key")
+                    },
+                    timeout=enqueue_kwargs["job_timeout"],
+                    result_ttl=enqueue_kwargs.get("result_ttl"),
+                    failure_ttl=enqueue_kwargs["failure_ttl"],
+                    meta=enqueue_kwargs["meta"],
+                )
+                jobs_by_lock[lock_id] = job
+                new_jobs.append((queue, job, request))
+
+            # Push the jobs first, so a lock never points at a job that doesn't exist (which
+            # another enqueue or remove_ghost_locks would take as stale), then take the
+            # locks. Jobs of a batch that lost the race for its locks are withdrawn.
+            job_pipe = rq_redis_connection.pipeline()
+            for queue, job, _ in new_jobs:
+                queue.enqueue_job(job, pipeline=job_pipe)
+            job_pipe.execute()
+
+            try:
+                pipe.multi()
+                for _, job, request in new_jobs:
+                    _lock(pipe, request["lock_id"], job.id)
+                pipe.execute()
+            except Exception:
+                _withdraw([job for _, job, _ in new_jobs])
+                raise
+        except redis.WatchError:
+            jobs_by_lock = {}
+            new_jobs = []
+            continue
+        finally:
+            pipe.reset()
+
+        for _, job, request in new_jobs:
+            logger.info("[%s] Created new job: %s", request["query_hash"], job.id)
+        break
+    else:
+        logger.warning(
+            "[Manager] Gave up enqueuing a batch of %d queries racing with other enqueues.",
+            len(requests),
+        )
+
+    created = set(job.id for _, job, _ in new_jobs)
+    jobs = []
+    for request in requests:
+        job = jobs_by_lock.get(request["lock_id"])
+        if job is None:
+            logger.error(
+                "[Manager][%s] Failed adding job for query.", request["query_hash"]
+            )
+        else:
+            metrics.jobs_enqueued.inc(
+                data_source_id=request["data_source"].id,
+                outcome="created" if job.id in created else "reused",
+            )
+        jobs.append(job)
+
+    return jobs
+
+
 def signal_handler(*args):
     raise InterruptException
 
@@ -182,18 +394,34 @@ class QueryExecutor(object):
         self._log_progress("executing_query")
 
         query_runner = self.data_source.query_runner
-        annotated_query = self._annotate_query(query_runner)
+        incremental = self._load_incremental_state(query_runner)
 
-        try:
-            data, error = query_runner.run_query(annotated_query, self.user)
-        except Exception as e:
-            if isinstance(e, JobTimeoutException):
-                error = TIMEOUT_MESSAGE
-            else:
-                error = str(e)
+        if incremental is None:
+            data, error = self._run_query(query_runner, self.query)
+        else:
+            options, previous, watermark = incremental
+            column = options["watermark_column"]
+            logger.info(
+                "job=execute_query state=incremental query_hash=%s watermark=%s",
+                self.query_hash,
+                watermark,
+            )
+            data, error = self._run_query(
+                query_runner, query_runner.apply_watermark(self.query, column, watermark)
+            )
 
-            data = None
-            logger.warning("Unexpected error while running query:", exc_info=1)
+            if data is not None:
+                merged = incremental_merge(
+                    previous, json_loads(data), column, options.get("retention")
+                )
+                if merged is None:
+                    logger.info(
+                        "job=execute_query state=incremental_mismatch query_hash=%s",
+                        self.query_hash,
+                    )
+                    data, error = self._run_query(query_runner, self.query)
+                else:
+                    data = json_dumps(merged)
 
         run_time = time.time() - started_at
 
@@ -207,7 +435,24 @@ class QueryExecutor(object):
 
         _unlock(self.query_hash, self.data_source.id)
 
+        if settings.QUERY_ROUTING_ENABLED and (data is not None or error == TIMEOUT_MESSAGE):
+            runtime_estimates.record(self.data_source.id, self.query_hash, run_time)
+
+        if data is not None:
+            status = "ok"
+        elif error == TIMEOUT_MESSAGE:
+            status = "timeout"
+        else:
+            status = "error"
+        metrics.query_time.observe(
+            run_time,
+            data_source_id=self.data_source.id,
+            type=self.data_source.type,
+            status=status,
+        )
+
         if error is not None and data is None:
+            self._record_slow_query(run_time, status, None, error)
             result = QueryExecutionError(error)
             if self.is_scheduled_query:
                 self.query_model = models.db.session.merge(self.query_model, load=False)
@@ -230,24 +475,108 @@ class QueryExecutor(object):
                 utcnow(),
             )
 
+            rows = self._record_result_size(query_result, data)
+            self._record_slow_query(run_time, status, rows, error)
             updated_query_ids = models.Query.update_latest_result(query_result)
 
             models.db.session.commit()  # make sure that alert sees the latest query result
-            self._log_progress("checking_alerts")
-            for query_id in updated_query_ids:
-                check_alerts_for_query.delay(query_id)
+            # A concurrent get_latest may have re-cached the previous result before the commit.
+            models.query_result_cache.invalidate(self.data_source.id, self.query_hash)
+            if query_result.unchanged:
+                logger.info("Result unchanged, skipping alerts for query %s", self.query_hash)
+            else:
+                self._log_progress("checking_alerts")
+                schedule_alert_checks(updated_query_ids)
             self._log_progress("finished")
 
             result = query_result.id
             models.db.session.commit()
             return result
 
-    def _annotate_query(self, query_runner):
+    def _run_query(self, query_runner, query_text):
+        annotated_query = self._annotate_query(query_runner, query_text)
+
+        try:
+            return query_runner.run_query(annotated_query, self.user)
+        except Exception as e:
+            if isinstance(e, JobTimeoutException):
+                error = TIMEOUT_MESSAGE
+            else:
+                error = str(e)
+
+            logger.warning("Unexpected error while running query:", exc_info=1)
+            return None, error
+
+    def _load_incremental_state(self, query_runner):
+        """
+        Returns (options, previous data, watermark) when this run can fetch only new rows,
+        that is for scheduled queries in incremental mode with a previous result for the
+        same query text, complete (not truncated) and compatible with the settings. Returns
+        None otherwise.
+        """
+        options = incremental_options(self.query_model)
+        if (
+            options is None
+            or not self.is_scheduled_query
+            or not query_runner.supports_incremental
+            or not self.query_model.latest_query_data_id
+        ):
+            return None
+
+        previous = models.QueryResult.query.get(self.query_model.latest_query_data_id)
+        try:
+            if previous is None or previous.query_hash != self.query_hash:
+                return None
+
+            previous_data = previous.data
+        finally:
+            models.db.session.close()
+
+        if previous_data.get("truncated") or (
+            incremental_options(self.query_model, previous_data) is None
+        ):
+            return None
+
+        watermark = incremental_watermark(previous_data, options["watermark_column"])
+        if watermark is None:
+            return None
+
+        return options, previous_data, watermark
+
+    def _annotate_query(self, query_runner, query_text):
         self.metadata["Job ID"] = self.job.id
         self.metadata["Query Hash"] = self.query_hash
         self.metadata["Scheduled"] = self.is_scheduled_query
 
-        return query_runner.annotate_query(self.query, self.metadata)
+        return query_runner.annotate_query(query_text, self.metadata)
+
+    def _record_result_size(self, query_result, data):
+        metrics.result_bytes.observe(len(data), data_source_id=self.data_source.id)
+
+        # Rows are counted when the payload was already parsed to be stored, or is small
+        # enough to parse; large results kept as JSON text would cost a second parse.
+        parsed = getattr(query_result, models.DESERIALIZED_DATA_ATTR, None)
+        if parsed is None and len(data) < settings.QUERY_RESULTS_COLUMNAR_MIN_SIZE:
+            parsed = json_loads(data)
+        if parsed is None:
+            return None
+
+        rows = len(parsed.get("rows") or [])
+        metrics.result_rows.observe(rows, data_source_id=self.data_source.id)
+        return rows
+
+    def _record_slow_query(self, run_time, status, rows, error):
+        if not settings.SLOW_QUERY_LOG_ENABLED:
+            return
+
+        try:
+            models.slow_query_log.record_worker_time(
+                self.data_source.id, self.query_hash, run_time
+            )
+            record_slow_query(self, run_time, status, rows, error)
+        except Exception:
+            # The log is never worth failing the query it describes.
+            logger.exception("Failed recording slow query %s", self.query_hash)
 
     def _log_progress(self, state):
         logger.info(
@@ -262,6 +591,7 @@ class QueryExecutor(object):
             self.metadata.get("query_id", "unknown"),
             self.metadata.get("Username", "unknown"),
         )
+        job_events.publish(self.job.id, state)
 
     def _load_data_source(self):
         logger.info("job=execute_query state=load_ds ds_id=%d", self.data_source_id)
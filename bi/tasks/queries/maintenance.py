@@ -1,18 +1,20 @@
 import logging
 import time
 
+import redis
 from rq.timeouts import JobTimeoutException
-from bi import models, redis_connection, settings, statsd_client
+from bi import models, redis_connection, rq_redis_connection, settings, statsd_client
 from bi.models.parameterized_query import (
     InvalidParameterError,
     QueryDetachedFromDataSourceError,
 )
 from bi.tasks.failure_report import track_failure
+from bi.tasks.worker import Job, Queue
 from bi.utils import json_dumps, sentry
 from bi.worker import job, get_job_logger
-from bi.monitor import rq_job_ids
+from bi.monitor import QUERY_RESULTS_RETENTION_KEY
 
-from .execution import enqueue_query
+from .execution import _lock_is_relevant, enqueue_query, enqueue_queries, job_locks
 
 logger = get_job_logger(__name__)
 
@@ -83,9 +85,17 @@ def _apply_auto_limit(query_text, query):
     )
 
 
+def _report_enqueue_failure(query, e):
+    message = "Could not enqueue query %d due to %s" % (query.id, repr(e))
+    logging.info(message)
+    error = RefreshQueriesError(message).with_traceback(e.__traceback__)
+    sentry.capture_exception(error)
+
+
 def refresh_queries():
     logger.info("Refreshing queries...")
-    enqueued = []
+    queries = []
+    requests = []
     for query in models.Query.outdated_queries():
         if not _should_refresh_query(query):
             continue
@@ -93,19 +103,42 @@ def refresh_queries():
         try:
             query_text = _apply_default_parameters(query)
             query_text = _apply_auto_limit(query_text, query)
-            enqueue_query(
-                query_text,
-                query.data_source,
-                query.user_id,
-                scheduled_query=query,
-                metadata={"query_id": query.id, "Username": "Scheduled"},
-            )
-            enqueued.append(query)
         except Exception as e:
-            message = "Could not enqueue query %d due to %s" % (query.id, repr(e))
-            logging.info(message)
-            error = RefreshQueriesError(message).with_traceback(e.__traceback__)
-            sentry.capture_exception(error)
+            _report_enqueue_failure(query, e)
+            continue
+
+        queries.append(query)
+        requests.append(
+            {
+                "query": query_text,
+                "data_source": query.data_source,
+                "user_id": query.user_id,
+                "scheduled_query": query,
+                "metadata": {"query_id": query.id, "Username": "Scheduled"},
+            }
+        )
+
+    enqueued = []
+    try:
+        jobs = enqueue_queries(requests)
+    except Exception as e:
+        logging.info("Bulk enqueue failed due to %s, enqueuing one by one.", repr(e))
+        jobs = [None] * len(requests)
+
+    # Queries the bulk enqueue didn't get to are enqueued one by one, so a single bad query
+    # can't hold back the rest.
+    for index, (query, request) in enumerate(zip(queries, requests)):
+        if jobs[index] is not None:
+            continue
+
+        try:
+            jobs[index] = enqueue_query(**request)
+        except Exception as e:
+            _report_enqueue_failure(query, e)
+
+    for query, job in zip(queries, jobs):
+        if job is not None:
+            enqueued.append(query)
 
     status = {
         "outdated_queries_count": len(enqueued),
@@ -117,49 +150,144 @@ def refresh_queries():
     logger.info("Done refreshing queries: %s" % status)
 
 
+# Unused results are counted up to this many when reporting the cleanup backlog.
+BACKLOG_COUNT_LIMIT = 100000
+
+
 def cleanup_query_results():
     """
     Job to cleanup unused query results -- such that no query links to them anymore, and older than
     settings.QUERY_RESULTS_CLEANUP_MAX_AGE (a week by default, so it's less likely to be open in someone's browser and be used).
 
-    Each time the job deletes only settings.QUERY_RESULTS_CLEANUP_COUNT (100 by default) query results so it won't choke
-    the database in case of many such results.
+    When query_results is partitioned, expired partitions are dropped whole (see
+    bi.models.partitions). Other unused results are deleted settings.QUERY_RESULTS_CLEANUP_COUNT
+    at a time, each batch in its own transaction so it won't choke the database, for up to
+    settings.QUERY_RESULTS_CLEANUP_TIME_LIMIT seconds. What's left is reported as the backlog.
     """
 
     logger.info(
-        "Running query results clean up (removing maximum of %d unused results, that are %d days old or more)",
-        settings.QUERY_RESULTS_CLEANUP_COUNT,
+        "Running query results clean up (removing unused results that are %d days old or more)",
         settings.QUERY_RESULTS_CLEANUP_MAX_AGE,
     )
+    started_at = time.time()
+    partitions = models.query_result_partitions
+    expired = []
+
+    if partitions.is_partitioned():
+        created = partitions.ensure()
+        if created:
+            logger.info("Created query results partitions: %s", ", ".join(created))
+
+        expired = partitions.expired(settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
+        while expired and time.time() - started_at < settings.QUERY_RESULTS_CLEANUP_TIME_LIMIT:
+            name = expired.pop(0)
+            dropped, kept = partitions.drop(name)
+            logger.info(
+                "Dropped partition %s: %d unused query results, %d kept.", name, dropped, kept
+            )
 
-    unused_query_results = models.QueryResult.unused(
-        settings.QUERY_RESULTS_CLEANUP_MAX_AGE
-    )
-    deleted_count = models.QueryResult.query.filter(
-        models.QueryResult.id.in_(
-            unused_query_results.limit(settings.QUERY_RESULTS_CLEANUP_COUNT).subquery()
+    deleted_count = 0
+    while time.time() - started_at < settings.QUERY_RESULTS_CLEANUP_TIME_LIMIT:
+        unused_ids = [
+            query_result_id
+            for query_result_id, in models.QueryResult.unused(
+                settings.QUERY_RESULTS_CLEANUP_MAX_AGE
+            )
+            .with_entities(models.QueryResult.id)
+            .limit(settings.QUERY_RESULTS_CLEANUP_COUNT)
+        ]
+        if not unused_ids:
+            break
+
+        deleted_count += models.QueryResult.delete_results(
+            models.QueryResult.id.in_(unused_ids)
         )
-    ).delete(synchronize_session=False)
-    models.db.session.commit()
+        models.db.session.commit()
     logger.info("Deleted %d unused query results.", deleted_count)
 
+    backlog = (
+        models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
+        .with_entities(models.QueryResult.id)
+        .limit(BACKLOG_COUNT_LIMIT)
+        .count()
+    )
+    models.db.session.commit()
+    statsd_client.gauge("query_results.cleanup.backlog", backlog)
+    statsd_client.gauge("query_results.cleanup.expired_partitions", len(expired))
+    redis_connection.hmset(
+        QUERY_RESULTS_RETENTION_KEY,
+        {
+            "unused_results": backlog,
+            "unused_results_capped": int(backlog >= BACKLOG_COUNT_LIMIT),
+            "expired_partitions": len(expired),
+            "deleted_results": deleted_count,
+            "updated_at": time.time(),
+        },
+    )
+
+
+# Set once the locks taken before they were indexed have been added to the index.
+GHOST_LOCKS_BACKFILLED_KEY = "query_hash_job_index:backfilled"
+
+
+def _remove_lock(lock_id, job_id):
+    """Removes the lock if it still points at `job_id`, as it may have been taken again since."""
+    with redis_connection.pipeline() as pipe:
+        try:
+            pipe.watch(lock_id)
+            if pipe.get(lock_id) != job_id:
+                return False
+            pipe.multi()
+            pipe.delete(lock_id)
+            job_locks.remove(lock_id, pipe=pipe)
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
+
 
 def remove_ghost_locks():
     """
-    Removes query locks that reference a non existing RQ job.
+    Removes query locks that reference a non existing RQ job, or one that is no longer queued or
+    running. Locks are read from their index in batches; the whole keyspace is never scanned
+    after the first run.
     """
-    keys = redis_connection.keys("query_hash_job:*")
-    locks = {k: redis_connection.get(k) for k in keys}
-    jobs = list(rq_job_ids())
+    started_at = time.time()
 
+    if redis_connection.set(GHOST_LOCKS_BACKFILLED_KEY, 1, nx=True):
+        backfilled = job_locks.backfill("query_hash_job:*")
+        logger.info("Indexed %d existing query locks.", backfilled)
+
+    pruned = job_locks.prune()
+    locks_count = 0
     count = 0
 
-    for lock, job_id in locks.items():
-        if job_id not in jobs:
-            redis_connection.delete(lock)
-            count += 1
+    for batch in job_locks.scan(settings.GHOST_LOCKS_BATCH_SIZE):
+        locks_count += len(batch)
+        gone = [lock_id for lock_id, job_id in batch if job_id is None]
+        job_locks.remove(*gone)
+        pruned += len(gone)
+
+        held = [(lock_id, job_id) for lock_id, job_id in batch if job_id is not None]
+        jobs = Job.fetch_many(
+            [job_id for _, job_id in held], connection=rq_redis_connection
+        )
+        for (lock_id, job_id), job in zip(held, jobs):
+            if not _lock_is_relevant(job) and _remove_lock(lock_id, job_id):
+                count += 1
+
+    statsd_client.timing(
+        "remove_ghost_locks.duration", (time.time() - started_at) * 1000
+    )
+    statsd_client.gauge("remove_ghost_locks.locks", locks_count)
+    statsd_client.incr("remove_ghost_locks.removed", count)
+    statsd_client.incr("remove_ghost_locks.pruned", pruned)
 
-    logger.info("Locks found: {}, Locks removed: {}".format(len(locks), count))
+    logger.info(
+        "Locks found: {}, Locks removed: {}, Index entries pruned: {}".format(
+            locks_count, count, pruned
+        )
+    )
 
 
 @job("schemas")
@@ -223,7 +351,15 @@ def refresh_schemas():
                 u"task=refresh_schema state=skip ds_id=%s reason=org_disabled", ds.id
             )
         else:
-            refresh_schema.delay(ds.id)
+            # Data sources refresh in parallel on the schemas workers, each within its own
+            # time limit so a slow one can't hold a worker for long.
+            Queue("schemas").enqueue(
+                refresh_schema,
+                ds.id,
+                job_timeout=settings.SCHEMA_REFRESH_TIME_LIMITS.get(
+                    ds.id, settings.SCHEMA_REFRESH_TIME_LIMIT
+                ),
+            )
 
     logger.info(
         u"task=refresh_schemas state=finish total_runtime=%.2f",
@@ -0,0 +1,153 @@
+"""
+Runtime-aware routing of query jobs.
+
+A rolling (exponentially weighted) estimate of each query's runtime is kept in Redis per
+data source and query hash. With QUERY_ROUTING_ENABLED, jobs for queries known to be fast or
+slow go to the `<queue>_fast` or `<queue>_slow` lane of their data source's queue, so long
+reports don't hold up short queries; queries without history keep using the queue itself.
+Queries that have no estimate yet start from the runtime of their latest stored result.
+"""
+from bi import models, redis_connection, settings
+from bi.utils.key_index import KeyIndex
+
+FAST_LANE_SUFFIX = "_fast"
+SLOW_LANE_SUFFIX = "_slow"
+
+
+class RuntimeEstimates(object):
+    KEY_PREFIX = "query_runtime"
+
+    def __init__(self):
+        # Lists the estimates for the admin API without scanning the keyspace.
+        self.index = KeyIndex("query_runtime_index")
+
+    def _key(self, data_source_id, query_hash):
+        return "{}:{}:{}".format(self.KEY_PREFIX, data_source_id, query_hash)
+
+    def get(self, data_source_id, query_hash):
+        return self.get_many([(data_source_id, query_hash)])[0]
+
+    def get_many(self, keys):
+        """Returns the estimates for a list of (data_source_id, query_hash) pairs."""
+        if not keys:
+            return []
+
+        estimates = redis_connection.mget([self._key(*key) for key in keys])
+        estimates = [float(e) if e is not None else None for e in estimates]
+
+        missing = [key for key, estimate in zip(keys, estimates) if estimate is None]
+        if missing:
+            seeds = self._seed(missing)
+            estimates = [
+                seeds.get(key) if estimate is None else estimate
+                for key, estimate in zip(keys, estimates)
+            ]
+
+        return estimates
+
+    def _seed(self, keys):
+        """
+        Stores the runtime of the latest result of each (data_source_id, query_hash) pair as
+        its estimate, and returns them by pair. Pairs without results are left out.
+        """
+        keys = set(keys)
+        query_result = models.QueryResult
+        latest = (
+            models.db.session.query(
+                query_result.data_source_id, query_result.query_hash, query_result.runtime
+            )
+            .filter(
+                query_result.data_source_id.in_({ds_id for ds_id, _ in keys}),
+                query_result.query_hash.in_({query_hash for _, query_hash in keys}),
+            )
+            .order_by(
+                query_result.data_source_id,
+                query_result.query_hash,
+                query_result.retrieved_at.desc(),
+            )
+            .distinct(query_result.data_source_id, query_result.query_hash)
+        )
+        seeds = {
+            (ds_id, query_hash): runtime
+            for ds_id, query_hash, runtime in latest
+            if (ds_id, query_hash) in keys and runtime is not None
+        }
+
+        if seeds:
+            ttl = settings.QUERY_ROUTING_ESTIMATE_TTL
+            pipe = redis_connection.pipeline()
+            for key, runtime in seeds.items():
+                pipe.set(self._key(*key), runtime, ex=ttl, nx=True)
+                self.index.add(self._key(*key), ttl, pipe=pipe)
+            pipe.execute()
+
+        return seeds
+
+    def record(self, data_source_id, query_hash, runtime):
+        key = self._key(data_source_id, query_hash)
+        previous = redis_connection.get(key)
+
+        if previous is None:
+            estimate = runtime
+        else:
+            weight = settings.QUERY_ROUTING_ESTIMATE_WEIGHT
+            estimate = weight * runtime + (1 - weight) * float(previous)
+
+        pipe = redis_connection.pipeline()
+        pipe.set(key, estimate, ex=settings.QUERY_ROUTING_ESTIMATE_TTL)
+        self.index.add(key, settings.QUERY_ROUTING_ESTIMATE_TTL, pipe=pipe)
+        pipe.execute()
+        return estimate
+
+    def all(self, data_source_id=None):
+        self.index.prune()
+
+        estimates = []
+        for key, value in (entry for batch in self.index.scan(1000) for entry in batch):
+            if value is None:
+                continue
+
+            _, ds_id, query_hash = key.split(":", 2)
+            if data_source_id is not None and int(ds_id) != int(data_source_id):
+                continue
+
+            estimates.append(
+                {
+                    "data_source_id": int(ds_id),
+                    "query_hash": query_hash,
+                    "runtime": float(value),
+                    "lane": lane_for(float(value)),
+                }
+            )
+
+        return sorted(estimates, key=lambda e: e["runtime"], reverse=True)
+
+
+runtime_estimates = RuntimeEstimates()
+
+
+def lane_for(estimate):
+    if estimate is None:
+        return None
+
+    if estimate <= settings.QUERY_ROUTING_FAST_THRESHOLD:
+        return "fast"
+
+    if estimate >= settings.QUERY_ROUTING_SLOW_THRESHOLD:
+        return "slow"
+
+    return None
+
+
+def route_queue(queue_name, estimate):
+    """Returns the queue a job should go to given its runtime estimate (None if unknown)."""
+    if not settings.QUERY_ROUTING_ENABLED:
+        return queue_name
+
+    lane = lane_for(estimate)
+    if lane == "fast":
+        return queue_name + FAST_LANE_SUFFIX
+    if lane == "slow":
+        return queue_name + SLOW_LANE_SUFFIX
+
+    return queue_name
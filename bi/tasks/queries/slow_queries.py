@@ -0,0 +1,93 @@
+from rq.timeouts import JobTimeoutException
+
+from bi import models, settings
+from bi.tasks.worker import Queue
+from bi.worker import get_job_logger
+
+logger = get_job_logger(__name__)
+
+EXPLAIN_TIMEOUT = 300
+EXPLAIN_TTL = 600
+
+
+def record_slow_query(executor, run_time, status, rows, error):
+    """
+    Adds an execution of `executor` that ran over its data source's threshold to the slow
+    query log, and enqueues the capture of its plan.
+    """
+    data_source = executor.data_source
+    if run_time < models.slow_query_threshold(data_source.id):
+        return None
+
+    query_runner = data_source.query_runner
+    explain = settings.SLOW_QUERY_EXPLAIN_ENABLED and query_runner.supports_explain
+    entry_id = models.slow_query_log.record(
+        data_source_id=data_source.id,
+        data_source_type=data_source.type,
+        query_id=executor.query_id,
+        query_hash=executor.query_hash,
+        query=executor.query,
+        runtime=run_time,
+        rows=rows,
+        status=status,
+        error=error,
+        scheduled=executor.is_scheduled_query,
+        job_id=executor.job.id,
+        queue=executor.metadata.get("Queue"),
+        username=executor.metadata.get("Username"),
+        explain_status="pending" if explain else None,
+    )
+    logger.info(
+        "job=execute_query state=slow_query query_hash=%s ds_id=%d runtime=%.2f entry=%d",
+        executor.query_hash,
+        data_source.id,
+        run_time,
+        entry_id,
+    )
+
+    if explain:
+        # Queued with the data source's own ad-hoc queries, under its concurrency limit, so
+        # plans of a slow database neither crowd out schema refreshes nor pile onto it.
+        Queue(data_source.queue_name).enqueue(
+            explain_slow_query,
+            entry_id,
+            data_source.id,
+            executor.query,
+            job_timeout=EXPLAIN_TIMEOUT,
+            ttl=EXPLAIN_TTL,
+            failure_ttl=settings.JOB_DEFAULT_FAILURE_TTL,
+            meta={"data_source_id": data_source.id, "org_id": data_source.org_id},
+        )
+
+    return entry_id
+
+
+def explain_slow_query(entry_id, data_source_id, query):
+    """Adds the EXPLAIN plan of `query` to its slow query log entry."""
+    data_source = models.DataSource.query.get(data_source_id)
+    if data_source is None:
+        return
+
+    # The plan is fetched through the runner's own connection, not the one the query used
+    # (that may still be busy streaming the result, or back in the pool).
+    query_runner = data_source.query_runner
+    models.db.session.close()
+
+    try:
+        plan = query_runner.explain_query(query, None)
+    except JobTimeoutException:
+        models.slow_query_log.update(
+            entry_id, explain_status="error", explain_error="EXPLAIN timed out."
+        )
+        raise
+    except Exception as e:
+        logger.warning("Failed explaining slow query %d: %s", entry_id, e)
+        models.slow_query_log.update(entry_id, explain_status="error", explain_error=str(e))
+        return
+
+    if plan is None:
+        # Scripts of several statements, or statements other than SELECT.
+        models.slow_query_log.update(entry_id, explain_status="skipped")
+        return
+
+    models.slow_query_log.update(entry_id, explain_status="done", explain=plan)
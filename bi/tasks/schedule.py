@@ -83,7 +83,15 @@ def periodic_job_definitions():
     ]
 
     if settings.QUERY_RESULTS_CLEANUP_ENABLED:
-        jobs.append({"func": cleanup_query_results, "interval": timedelta(minutes=5)})
+        jobs.append(
+            {
+                "func": cleanup_query_results,
+                "interval": timedelta(minutes=5),
+                # Room for the last batch, the backlog count and dropping partitions after
+                # the time limit.
+                "timeout": settings.QUERY_RESULTS_CLEANUP_TIME_LIMIT + 300,
+            }
+        )
 
     # Add your own custom periodic jobs in your dynamic_settings module.
     jobs.extend(settings.dynamic_settings.periodic_jobs() or [])
@@ -2,12 +2,18 @@ import errno
 import os
 import signal
 import time
-from bi import statsd_client
+from bi import settings, statsd_client
+from bi.metrics import prometheus as metrics
+from bi.query_runner.pool import pools as query_runner_pools
+from bi.utils import job_events
+from bi.utils.concurrency import data_source_semaphore
 from rq import Queue as BaseQueue, get_current_job
 from rq.worker import HerokuWorker # HerokuWorker implements graceful shutdown on SIGTERM
+from rq.worker import SimpleWorker
 from rq.utils import utcnow
 from rq.timeouts import UnixSignalDeathPenalty, HorseMonitorTimeoutException
 from rq.job import Job as BaseJob, JobStatus
+from rq_scheduler import Scheduler
 
 
 class CancellableJob(BaseJob):
@@ -16,6 +22,7 @@ class CancellableJob(BaseJob):
         self.save_meta()
 
         super().cancel(pipeline=pipeline)
+        job_events.publish(self.id, "cancelled")
 
     @property
     def is_cancelled(self):
@@ -59,6 +66,88 @@ class StatsdRecordingWorker(HerokuWorker):
                 statsd_client.incr("rq.jobs.failed.{}".format(queue.name))
 
 
+class MetricsRecordingWorker(HerokuWorker):
+    """
+    RQ Worker Mixin that records how long jobs waited in their queue and how long they ran
+    (see bi.metrics.prometheus), and writes the metrics buffered by each job when it ends.
+    """
+
+    def execute_job(self, job, queue):
+        if job.enqueued_at is not None:
+            metrics.queue_wait_time.observe(
+                (utcnow() - job.enqueued_at).total_seconds(), queue=queue.name
+            )
+
+        started_at = time.time()
+        try:
+            super().execute_job(job, queue)
+        finally:
+            metrics.job_time.observe(
+                time.time() - started_at,
+                queue=queue.name,
+                status=job.get_status() or "unknown",
+            )
+            metrics.flush()
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            # Work horses exit without running atexit handlers.
+            metrics.flush()
+
+
+class ConcurrencyLimitingWorker(HerokuWorker):
+    """
+    RQ Worker Mixin that only runs query jobs while their data source is under its concurrency
+    limit. Jobs of a data source at its limit are parked with rq-scheduler, which puts them
+    back at the end of their queue later, and the worker moves on to the next job.
+    """
+
+    def execute_job(self, job, queue):
+        data_source_id = job.meta.get("data_source_id")
+        if data_source_id is None:
+            return super().execute_job(job, queue)
+
+        if not data_source_semaphore.acquire(data_source_id, job.id, job.timeout):
+            self.defer_job(job, queue)
+            return
+
+        try:
+            super().execute_job(job, queue)
+        finally:
+            data_source_semaphore.release(data_source_id, job.id)
+
+    def defer_job(self, job, queue):
+        # The scheduler enqueues the job in its origin queue once it's due, like the jobs it
+        # schedules itself, so a queue holding only jobs of busy data sources isn't spun on.
+        retry_at = time.time() + settings.DATA_SOURCE_CONCURRENCY_RETRY_DELAY
+        self.connection.zadd(Scheduler.scheduled_jobs_key, {job.id: retry_at})
+        statsd_client.incr("rq.jobs.deferred.{}".format(queue.name))
+        self.log.debug(
+            "Job %s deferred: data source %s is at its concurrency limit.",
+            job.id,
+            job.meta.get("data_source_id"),
+        )
+
+
+class JobEventsWorker(HerokuWorker):
+    """
+    RQ Worker Mixin that publishes a job event once RQ has recorded the job's outcome, so
+    clients waiting on the job (see JobResource) fetch it in its final state.
+    """
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        super().handle_job_success(job, queue, started_job_registry)
+        job_events.publish(job.id, JobStatus.FINISHED)
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        super().handle_job_failure(
+            job, queue, started_job_registry=started_job_registry, exc_string=exc_string
+        )
+        job_events.publish(job.id, JobStatus.FAILED)
+
+
 class HardLimitingWorker(HerokuWorker):
     """
     RQ's work horses enforce time limits by setting a timed alarm and stopping jobs
@@ -165,9 +254,36 @@ class HardLimitingWorker(HerokuWorker):
             )
 
 
-class BiWorker(StatsdRecordingWorker, HardLimitingWorker):
+class BiWorker(
+    ConcurrencyLimitingWorker,
+    JobEventsWorker,
+    MetricsRecordingWorker,
+    StatsdRecordingWorker,
+    HardLimitingWorker,
+):
     queue_class = BiQueue
 
+    def main_work_horse(self, job, queue):
+        # The work horse exits after this job, so its connections can't be reused.
+        query_runner_pools.disable()
+        super().main_work_horse(job, queue)
+
+
+class BiSimpleWorker(
+    ConcurrencyLimitingWorker,
+    JobEventsWorker,
+    MetricsRecordingWorker,
+    StatsdRecordingWorker,
+    SimpleWorker,
+):
+    """
+    Runs jobs in the worker process instead of a forked work horse, so state kept per
+    process (such as pooled data source connections) survives from one job to the next.
+    """
+
+    queue_class = BiQueue
+    job_class = CancellableJob
+
 
 Job = CancellableJob
 Queue = BiQueue
@@ -48,13 +48,45 @@ def slugify(s):
     return re.sub("[^a-z0-9_\-]+", "-", s.lower())
 
 
+# Opening characters of quoted identifiers ("Foo", `Foo`, [Foo]), whose case matters.
+QUOTED_IDENTIFIER_CHARS = ('"', "`", "[")
+
+
+def canonical_query_text(sql):
+    """Return the query as its tokens joined by single spaces, without comments or
+    trailing semicolons, and with keywords and unquoted names lower cased. String
+    literals and quoted identifiers are kept as they are, so queries that only differ
+    in their literals' case don't collide.
+    """
+    tokens = []
+    for ttype, value in sqlparse.lexer.tokenize(sql):
+        if ttype in sqlparse.tokens.Comment or ttype in sqlparse.tokens.Whitespace:
+            continue
+        if ttype in sqlparse.tokens.String or value[:1] in QUOTED_IDENTIFIER_CHARS:
+            tokens.append(value)
+        else:
+            tokens.append(value.lower())
+
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+
+    return " ".join(tokens)
+
+
 def gen_query_hash(sql):
+    """Return hash of the given query's canonical text (see `canonical_query_text`),
+    so queries that only differ in whitespace, comments, keyword case or trailing
+    semicolons share their cached results and execution locks.
+    """
+    return hashlib.md5(canonical_query_text(sql).encode("utf-8")).hexdigest()
+
+
+def gen_legacy_query_hash(sql):
     """Return hash of the given query after stripping all comments, line breaks
     and multiple spaces, and lower casing all text.
 
-    TODO: possible issue - the following queries will get the same id:
-        1. SELECT 1 FROM table WHERE column='Value';
-        2. SELECT 1 FROM table where column='value';
+    This is how query hashes were computed before `canonical_query_text`. It's kept to
+    match results stored with those hashes (see `queries rehash`).
     """
     sql = COMMENTS_REGEX.sub("", sql)
     sql = "".join(sql.split()).lower()
@@ -0,0 +1,237 @@
+"""
+Versioned, compressed columnar encoding for query result payloads.
+
+A result of the form ``{"columns": [...], "rows": [{...}, ...]}`` is stored as its
+column metadata once plus one list of values per column. The body is compressed and
+wrapped in a small text envelope (``columnar:<version>:<codec>:<base64>[:<base64>...]``)
+so it fits in the existing ``query_results.data`` text column. Payloads without the
+envelope are legacy row JSON and are decoded as before.
+
+Since version 2 the header (columns, row count, extra fields) and each group of
+ROW_GROUP_SIZE rows are compressed separately, so a page of a large result only
+decompresses and parses the groups it overlaps. A group holds all of its columns, so
+selecting columns doesn't save any decoding. Version 1 payloads are a single segment.
+"""
+import base64
+import zlib
+
+from bi.utils import json_dumps, json_loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+ENVELOPE_PREFIX = "columnar:"
+FORMAT_VERSION = 2
+ROW_GROUP_SIZE = 10000
+
+
+def _zlib_compress(raw):
+    return zlib.compress(raw, 6)
+
+
+def _zstd_compress(raw):
+    return zstandard.ZstdCompressor(level=3).compress(raw)
+
+
+def _zstd_decompress(raw):
+    return zstandard.ZstdDecompressor().decompress(raw)
+
+
+codecs = {"zlib": (_zlib_compress, zlib.decompress)}
+
+if zstandard is not None:
+    codecs["zstd"] = (_zstd_compress, _zstd_decompress)
+
+if lz4 is not None:
+    codecs["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def resolve_codec(preferred):
+    """Returns `preferred` if its library is installed, otherwise zlib."""
+    return preferred if preferred in codecs else "zlib"
+
+
+def is_columnar(payload):
+    return isinstance(payload, str) and payload.startswith(ENVELOPE_PREFIX)
+
+
+def to_columns(data):
+    """
+    Converts a row-oriented result into a columnar body. Returns None when the rows don't
+    line up exactly with the declared columns, in which case the result should be kept as
+    row JSON so that nothing is lost.
+    """
+    columns = data.get("columns") or []
+    rows = data.get("rows") or []
+    names = [column["name"] for column in columns]
+    name_set = set(names)
+
+    if len(name_set) != len(names):
+        return None
+
+    for row in rows:
+        if row.keys() != name_set:
+            return None
+
+    return {
+        "columns": columns,
+        "length": len(rows),
+        "values": [[row[name] for row in rows] for name in names],
+        "extra": {k: v for k, v in data.items() if k not in ("columns", "rows")},
+    }
+
+
+def from_columns(body):
+    """Rebuilds the row-oriented result from a columnar body."""
+    names = [column["name"] for column in body["columns"]]
+
+    if names:
+        rows = [dict(zip(names, values)) for values in zip(*body["values"])]
+    else:
+        rows = [{} for _ in range(body["length"])]
+
+    data = dict(body.get("extra") or {})
+    data["columns"] = body["columns"]
+    data["rows"] = rows
+    return data
+
+
+def _slice(body, values, start, offset, limit, names):
+    # `values` hold the column values from row `start` on.
+    indexes = [
+        index
+        for index, column in enumerate(body["columns"])
+        if names is None or column["name"] in names
+    ]
+    end = body["length"] if limit is None else min(offset + limit, body["length"])
+    columns = [body["columns"][index] for index in indexes]
+    selected = [column["name"] for column in columns]
+
+    if selected:
+        rows = [
+            dict(zip(selected, row))
+            for row in zip(*[values[index][offset - start : end - start] for index in indexes])
+        ]
+    else:
+        rows = [{} for _ in range(max(end - offset, 0))]
+
+    data = dict(body.get("extra") or {})
+    data["columns"] = columns
+    data["rows"] = rows
+    data["total_rows"] = body["length"]
+    return data
+
+
+def slice_body(body, offset=0, limit=None, names=None):
+    """
+    Rebuilds rows `offset` to `offset + limit` of a columnar body, keeping only the columns
+    in `names` (all when None). Only the requested rows are turned into dicts.
+    """
+    return _slice(body, body["values"], 0, offset, limit, names)
+
+
+def _encode_segment(codec, value):
+    compress, _ = codecs[codec]
+    return base64.b64encode(compress(json_dumps(value).encode("utf-8"))).decode("ascii")
+
+
+def _decode_segment(codec, segment):
+    _, decompress = codecs[codec]
+    return json_loads(decompress(base64.b64decode(segment)).decode("utf-8"))
+
+
+def dump_body(body, codec="zstd", group_size=ROW_GROUP_SIZE):
+    codec = resolve_codec(codec)
+    header = {
+        "columns": body["columns"],
+        "length": body["length"],
+        "extra": body.get("extra") or {},
+        "group_size": group_size,
+    }
+    segments = [_encode_segment(codec, header)]
+    for start in range(0, body["length"], group_size):
+        group = [values[start : start + group_size] for values in body["values"]]
+        segments.append(_encode_segment(codec, group))
+
+    return "{}{}:{}:{}".format(ENVELOPE_PREFIX, FORMAT_VERSION, codec, ":".join(segments))
+
+
+def _split_envelope(payload):
+    _, version, codec, segments = payload.split(":", 3)
+
+    if int(version) > FORMAT_VERSION:
+        raise ValueError("Unsupported columnar result version: {}".format(version))
+
+    if codec not in codecs:
+        raise ValueError("Columnar result compressed with unavailable codec: {}".format(codec))
+
+    return int(version), codec, segments.split(":")
+
+
+def _load_groups(codec, header, segments):
+    values = [[] for _ in header["columns"]]
+    for segment in segments:
+        for column_values, group_values in zip(values, _decode_segment(codec, segment)):
+            column_values.extend(group_values)
+
+    return values
+
+
+def load_body(payload):
+    """Returns the columnar body stored in an envelope."""
+    version, codec, segments = _split_envelope(payload)
+    if version == 1:
+        return _decode_segment(codec, segments[0])
+
+    header = _decode_segment(codec, segments[0])
+    return {
+        "columns": header["columns"],
+        "length": header["length"],
+        "values": _load_groups(codec, header, segments[1:]),
+        "extra": header["extra"],
+    }
+
+
+def slice_payload(payload, offset=0, limit=None, names=None):
+    """
+    Same as `slice_body(load_body(payload), ...)`, but only decodes the row groups holding
+    the requested rows.
+    """
+    version, codec, segments = _split_envelope(payload)
+    if version == 1:
+        return slice_body(_decode_segment(codec, segments[0]), offset, limit, names)
+
+    header = _decode_segment(codec, segments[0])
+    group_size = header["group_size"]
+    end = header["length"] if limit is None else min(offset + limit, header["length"])
+    first_group = min(offset, end) // group_size
+    last_group = -(-end // group_size)
+    values = _load_groups(codec, header, segments[1 + first_group : 1 + last_group])
+    return _slice(header, values, first_group * group_size, offset, limit, names)
+
+
+def dumps(data, codec="zstd"):
+    """
+    Encodes a result dict, falling back to row JSON when it can't be represented as
+    columns.
+    """
+    body = to_columns(data)
+    if body is None:
+        return json_dumps(data)
+
+    return dump_body(body, codec)
+
+
+def loads(payload):
+    """Decodes a stored payload, whether columnar or legacy row JSON."""
+    if is_columnar(payload):
+        return from_columns(load_body(payload))
+
+    return json_loads(payload)
@@ -0,0 +1,87 @@
+"""
+Distributed per-data-source concurrency limits for query jobs.
+
+Each data source has a Redis sorted set of the jobs currently running against it, scored by
+the time their slot expires. Slots are leased for the job's time limit plus a grace period, so
+a worker that dies without releasing its slot only holds it until the lease runs out.
+"""
+import math
+import time
+
+import redis
+
+from bi import redis_connection, settings
+
+# Added to a job's time limit, which the hard limit of the worker enforces (+15s).
+LEASE_GRACE_PERIOD = 60
+# Lease used for jobs without a time limit.
+DEFAULT_LEASE = 3600
+
+
+def concurrency_limit(data_source_id):
+    return settings.DATA_SOURCE_CONCURRENCY_LIMITS.get(
+        int(data_source_id), settings.DATA_SOURCE_CONCURRENCY_LIMIT
+    )
+
+
+class DataSourceSemaphore(object):
+    KEY_PREFIX = "data_source:in_flight"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _key(self, data_source_id):
+        return "{}:{}".format(self.KEY_PREFIX, data_source_id)
+
+    def acquire(self, data_source_id, job_id, timeout=None):
+        """
+        Takes a slot for `job_id` if the data source is under its limit. Returns False when
+        the data source is at its limit and the job should wait.
+        """
+        limit = concurrency_limit(data_source_id)
+        if not limit:
+            return True
+
+        lease = timeout + LEASE_GRACE_PERIOD if timeout and timeout > 0 else DEFAULT_LEASE
+        key = self._key(data_source_id)
+
+        with self.connection.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    now = time.time()
+                    in_flight = pipe.zcount(key, now, "+inf")
+                    if in_flight >= limit and pipe.zscore(key, job_id) is None:
+                        pipe.unwatch()
+                        return False
+
+                    # The key lives as long as its longest lease, so a short job doesn't
+                    # expire the slots of longer ones still running.
+                    longest = pipe.zrange(key, -1, -1, withscores=True)
+                    expires_at = max([now + lease] + [score for _, score in longest])
+
+                    pipe.multi()
+                    pipe.zremrangebyscore(key, "-inf", now)
+                    pipe.zadd(key, {job_id: now + lease})
+                    pipe.expireat(key, int(math.ceil(expires_at)))
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    def release(self, data_source_id, job_id):
+        self.connection.zrem(self._key(data_source_id), job_id)
+
+    def in_flight(self, data_source_ids):
+        """Returns the number of running jobs per data source id."""
+        data_source_ids = list(data_source_ids)
+        now = time.time()
+
+        pipe = self.connection.pipeline()
+        for data_source_id in data_source_ids:
+            pipe.zcount(self._key(data_source_id), now, "+inf")
+
+        return dict(zip(data_source_ids, pipe.execute()))
+
+
+data_source_semaphore = DataSourceSemaphore(redis_connection)
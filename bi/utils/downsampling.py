@@ -0,0 +1,282 @@
+"""
+Server-side downsampling of query results for chart visualizations.
+
+A chart opts in with ``options["downsampling"] = {"enabled": true}`` (optionally with
+``maxPoints`` per series and ``topN`` pie slices). Line and area series are reduced with
+Largest-Triangle-Three-Buckets, scatter and bubble series keep one point per cell of a 2D
+grid, and pies keep their largest slices plus an "Other" slice. Reduced results are cached
+per query result and visualization, keyed by the options they were computed with.
+"""
+import hashlib
+import warnings
+
+import numpy as np
+
+from bi import redis_connection, settings
+from bi.utils import json_dumps, json_loads
+
+LINE_TYPES = ("line", "area")
+SCATTER_TYPES = ("scatter", "bubble")
+PIE_TYPES = ("pie",)
+OTHER_LABEL = "Other"
+
+
+def downsampling_options(options):
+    """Returns the chart's downsampling settings, or None when it isn't downsampled."""
+    downsampling = (options or {}).get("downsampling") or {}
+    if not downsampling.get("enabled"):
+        return None
+
+    return {
+        "maxPoints": int(
+            downsampling.get("maxPoints")
+            or settings.VISUALIZATION_DOWNSAMPLING_MAX_POINTS
+        ),
+        "topN": int(downsampling.get("topN") or settings.VISUALIZATION_DOWNSAMPLING_TOP_N),
+    }
+
+
+def _column_mapping(columns, options):
+    mapping = options.get("columnMapping") or {}
+    roles = {}
+    for column in columns:
+        name = column["name"]
+        if name in mapping:
+            roles[name] = mapping[name]
+        elif "::" in name:
+            roles[name] = name.split("::")[1]
+
+    def named(role):
+        return [name for name, r in roles.items() if r == role]
+
+    x, series = named("x"), named("series")
+    return (x[0] if x else None), named("y"), (series[0] if series else None)
+
+
+def _numeric(values):
+    """Converts a column to floats (dates to epoch milliseconds), or None if it's neither."""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        with warnings.catch_warnings():
+            # Parsing timezone offsets is deprecated, but they are still converted to UTC.
+            warnings.simplefilter("ignore")
+            dates = np.asarray(values, dtype="datetime64[ms]")
+    except (TypeError, ValueError):
+        return None
+
+    numeric = dates.view(np.int64).astype(np.float64)
+    numeric[np.isnat(dates)] = np.nan
+    return numeric
+
+
+def _summable(values):
+    """Like _numeric, but non-numeric columns count as zeros."""
+    numeric = _numeric(values)
+    return numeric if numeric is not None else np.zeros(len(values))
+
+
+def _categories(values):
+    _, codes = np.unique(np.asarray([str(v) for v in values]), return_inverse=True)
+    return codes.astype(np.float64)
+
+
+def _groups(series_values, length):
+    """Returns the row indexes of each series."""
+    if series_values is None:
+        return [np.arange(length)]
+
+    keys = np.asarray([str(value) for value in series_values])
+    _, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    splits = np.flatnonzero(np.diff(inverse[order])) + 1
+    return np.split(order, splits)
+
+
+def lttb(x, y, threshold):
+    """Returns the indexes of the `threshold` points that Largest-Triangle-Three-Buckets keeps."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    y = np.nan_to_num(y)
+    every = (n - 2) / (threshold - 2)
+    bounds = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    bounds[-1] = n - 1
+
+    indexes = np.empty(threshold, dtype=np.int64)
+    indexes[0], indexes[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            next_start, next_end = bounds[i + 1], bounds[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        indexes[i + 1] = a
+
+    return indexes
+
+
+def grid_sample(x, y, max_points):
+    """Returns the index of the first point in each occupied cell of a grid of about `max_points` cells."""
+    bins = max(int(np.sqrt(max_points)), 1)
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(finite) <= max_points:
+        return finite
+
+    def cells(values):
+        low, high = values.min(), values.max()
+        span = (high - low) or 1
+        return np.minimum(((values - low) / span * bins).astype(np.int64), bins - 1)
+
+    keys = cells(x[finite]) * bins + cells(y[finite])
+    _, first = np.unique(keys, return_index=True)
+    return np.sort(finite[first])
+
+
+def _sample_line(x, ys, indexes, max_points):
+    x = x[indexes] if x is not None else np.arange(len(indexes), dtype=np.float64)
+    order = np.argsort(x, kind="stable")
+    x, indexes = x[order], indexes[order]
+    keep = [lttb(x, y[indexes], max_points) for y in ys]
+    return indexes[np.unique(np.concatenate(keep))] if keep else indexes
+
+
+def _sample_scatter(x, ys, indexes, max_points):
+    x = x[indexes]
+    keep = [grid_sample(x, y[indexes], max_points) for y in ys]
+    return indexes[np.unique(np.concatenate(keep))] if keep else indexes
+
+
+def _top_slices(labels, ys, indexes, top_n):
+    """
+    Returns the (label, sums) of the `top_n` labels with the largest sums of the first y
+    column among `indexes`, and of an "Other" slice adding up the rest. None when there
+    are `top_n` labels or fewer.
+    """
+    _, first, inverse = np.unique(
+        np.asarray([str(labels[i]) for i in indexes]), return_index=True, return_inverse=True
+    )
+    if len(first) <= top_n:
+        return None
+
+    sums = [
+        np.bincount(inverse, weights=np.nan_to_num(y[indexes]), minlength=len(first))
+        for y in ys
+    ]
+    top = np.argsort(-sums[0], kind="stable")[:top_n]
+    rest = np.setdiff1d(np.arange(len(first)), top)
+
+    slices = [(labels[indexes[first[t]]], [float(s[t]) for s in sums]) for t in top]
+    slices.append((OTHER_LABEL, [float(s[rest].sum()) for s in sums]))
+    return slices
+
+
+def downsample(body, options):
+    """
+    Returns the rows of the columnar result `body` (see bi.utils.columnar) reduced according
+    to the chart `options`, with a `downsampling` entry describing what was done, or None
+    when there is nothing to reduce. Only the rows that are kept are built.
+    """
+    downsampling = downsampling_options(options)
+    length = body["length"]
+    if downsampling is None or not length:
+        return None
+
+    chart_type = options.get("globalSeriesType")
+    columns = body["columns"]
+    x_column, y_columns, series_column = _column_mapping(columns, options)
+    if x_column is None or not y_columns:
+        return None
+
+    names = [column["name"] for column in columns]
+    values = dict(zip(names, body["values"]))
+    series_values = values[series_column] if series_column is not None else None
+    max_points, top_n = downsampling["maxPoints"], downsampling["topN"]
+    groups = _groups(series_values, length)
+
+    if chart_type in PIE_TYPES:
+        method = "top_n"
+        ys = [_summable(values[column]) for column in y_columns]
+        slices = [_top_slices(values[x_column], ys, indexes, top_n) for indexes in groups]
+        if all(group_slices is None for group_slices in slices):
+            return None
+
+        rows = []
+        for indexes, group_slices in zip(groups, slices):
+            if group_slices is None:
+                rows.extend({name: values[name][i] for name in names} for i in indexes)
+                continue
+
+            for label, sums in group_slices:
+                row = {x_column: label}
+                if series_column is not None:
+                    row[series_column] = series_values[indexes[0]]
+                row.update(zip(y_columns, sums))
+                rows.append(row)
+    elif chart_type in LINE_TYPES or chart_type in SCATTER_TYPES:
+        if all(len(indexes) <= max_points for indexes in groups):
+            return None
+
+        x = _numeric(values[x_column])
+        if chart_type in LINE_TYPES:
+            method = "lttb"
+            sample = _sample_line
+        else:
+            method = "grid"
+            sample = _sample_scatter
+            if x is None:
+                x = _categories(values[x_column])
+
+        ys = [y for y in (_numeric(values[column]) for column in y_columns) if y is not None]
+        kept = np.sort(
+            np.concatenate([sample(x, ys, indexes, max_points) for indexes in groups])
+        )
+        if len(kept) == length:
+            return None
+
+        rows = [{name: values[name][i] for name in names} for i in kept]
+    else:
+        return None
+
+    reduced = dict(body.get("extra") or {})
+    reduced["columns"] = columns
+    reduced["rows"] = rows
+    reduced["downsampling"] = {"method": method, "original_rows": length}
+    return reduced
+
+
+def _cache_key(query_result_id, visualization_id, options):
+    digest = hashlib.md5(json_dumps(options, sort_keys=True).encode("utf-8")).hexdigest()
+    return "visualization_data:{}:{}:{}".format(query_result_id, visualization_id, digest)
+
+
+def downsampled_data(query_result, visualization):
+    """Returns the query result's data as shown by `visualization`, cached when reduced."""
+    options = json_loads(visualization.options) if visualization.options else {}
+    if visualization.type != "CHART" or downsampling_options(options) is None:
+        return query_result.data
+
+    key = _cache_key(query_result.id, visualization.id, options)
+    cached = redis_connection.get(key)
+    if cached is not None:
+        return json_loads(cached)
+
+    data = downsample(query_result.columnar_body(), options)
+    if data is None:
+        return query_result.data
+
+    redis_connection.set(key, json_dumps(data), ex=settings.VISUALIZATION_DOWNSAMPLING_CACHE_TTL)
+    return data
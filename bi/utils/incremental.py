@@ -0,0 +1,130 @@
+"""
+Incremental (append-only) refreshes of scheduled queries.
+
+A query opts in with ``options["incremental"] = {"watermark_column": "...", "retention": N}``.
+Each refresh then only fetches the rows whose watermark column is greater than the highest
+value in the previous result and appends them to it. ``retention`` optionally drops rows more
+than N seconds (for date/time watermarks) or N units (for numeric ones) behind the newest row.
+"""
+import datetime
+import logging
+import numbers
+
+from dateutil import parser
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_KEY = "watermark"
+DATE_TYPES = ("date", "datetime")
+NUMBER_TYPES = ("integer", "float")
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def incremental_options(query, data=None):
+    """
+    Returns the query's incremental settings, or None if it refreshes in full. With `data`
+    (its previous result), also None when the watermark column isn't in it, or when a
+    retention window is set on a column that isn't a number or a date/time.
+    """
+    options = ((query.options or {}) if query is not None else {}).get("incremental")
+    if not options or not options.get("watermark_column"):
+        return None
+
+    if data is None:
+        return options
+
+    column = options["watermark_column"]
+    if column not in [c["name"] for c in data.get("columns") or []]:
+        return None
+
+    retention = options.get("retention")
+    if retention:
+        column_type = _column_type(data, column)
+        newest = watermark(data, column)
+        if not _is_number(retention) or not (
+            column_type in DATE_TYPES + NUMBER_TYPES
+            or (column_type is None and _is_number(newest))
+        ):
+            logger.warning(
+                "Ignoring incremental refresh of query %s: retention needs a numeric or "
+                "date/time watermark column (%s is %s).",
+                query.id,
+                column,
+                column_type,
+            )
+            return None
+
+    return options
+
+
+def _column_type(data, column):
+    for c in data.get("columns") or []:
+        if c["name"] == column:
+            return c.get("type")
+
+    return None
+
+
+def _sort_key(value, column_type):
+    if column_type in DATE_TYPES and isinstance(value, str):
+        return parser.parse(value)
+
+    return value
+
+
+def watermark(data, column):
+    """Returns the highest value of `column` in `data` (as stored in the result), or None."""
+    if WATERMARK_KEY in data:
+        return data[WATERMARK_KEY]
+
+    column_type = _column_type(data, column)
+    values = [row.get(column) for row in data.get("rows") or []]
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+
+    return max(values, key=lambda value: _sort_key(value, column_type))
+
+
+def merge(previous, delta, column, retention=None):
+    """
+    Appends the rows of `delta` to `previous`, applies the retention window and records the
+    new watermark. Returns None when the two results don't have the same columns or `delta`
+    was truncated (its rows come in no particular order, so the watermark would skip the ones
+    left out), in which case the query needs a full refresh.
+    """
+    if delta.get("truncated"):
+        return None
+
+    previous_names = [c["name"] for c in previous.get("columns") or []]
+    delta_names = [c["name"] for c in delta.get("columns") or []]
+    if previous_names != delta_names or column not in delta_names:
+        return None
+
+    column_type = _column_type(delta, column)
+    rows = (previous.get("rows") or []) + (delta.get("rows") or [])
+
+    merged = dict(delta)
+    merged.pop(WATERMARK_KEY, None)
+    merged["rows"] = rows
+    newest = watermark(merged, column)
+
+    if retention and newest is not None:
+        newest_key = _sort_key(newest, column_type)
+        if isinstance(newest_key, datetime.datetime):
+            cutoff = newest_key - datetime.timedelta(seconds=retention)
+        else:
+            cutoff = newest_key - retention
+
+        merged["rows"] = [
+            row
+            for row in rows
+            if row.get(column) is not None
+            and _sort_key(row[column], column_type) >= cutoff
+        ]
+
+    merged[WATERMARK_KEY] = newest
+    return merged
@@ -0,0 +1,45 @@
+"""
+Redis pub/sub notifications of job state changes.
+
+Workers publish an event on a job's channel as the job makes progress and when it ends (see
+QueryExecutor._log_progress and JobEventsWorker), so API requests waiting on a job can
+subscribe to its channel instead of polling RQ.
+"""
+import time
+from contextlib import contextmanager
+
+from bi import redis_connection
+from bi.utils import json_dumps, json_loads
+
+CHANNEL_PREFIX = "job_events"
+
+
+def channel(job_id):
+    return "{}:{}".format(CHANNEL_PREFIX, job_id)
+
+
+def publish(job_id, state):
+    redis_connection.publish(channel(job_id), json_dumps({"job_id": job_id, "state": state}))
+
+
+@contextmanager
+def subscription(job_id):
+    pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(job_id))
+    try:
+        yield pubsub
+    finally:
+        pubsub.close()
+
+
+def next_event(pubsub, timeout):
+    """Returns the next event published on the subscribed channel, or None after `timeout` seconds."""
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+
+        message = pubsub.get_message(timeout=remaining)
+        if message is not None and message["type"] == "message":
+            return json_loads(message["data"])
@@ -0,0 +1,59 @@
+"""
+Sorted set indexes of expiring Redis keys.
+
+Keys that have to be enumerated, such as query locks and runtime estimates, are added to an
+index scored by the time they expire. They are then listed with ZSCAN and pipelined MGETs in
+batches, instead of KEYS (which blocks Redis for every client) or a SCAN of the whole keyspace.
+Entries of keys that expired are pruned by score.
+"""
+import time
+
+from funcy import chunks
+
+from bi import redis_connection
+
+
+class KeyIndex(object):
+    def __init__(self, name, connection=redis_connection):
+        self.name = name
+        self.connection = connection
+
+    def add(self, key, ttl, pipe=None):
+        """Indexes `key`, which expires in `ttl` seconds. Runs in `pipe` when given."""
+        (pipe or self.connection).zadd(self.name, {key: time.time() + ttl})
+
+    def remove(self, *keys, pipe=None):
+        if keys:
+            (pipe or self.connection).zrem(self.name, *keys)
+
+    def prune(self):
+        """Drops the entries of keys that expired. Returns how many were dropped."""
+        return self.connection.zremrangebyscore(self.name, "-inf", time.time())
+
+    def size(self):
+        return self.connection.zcard(self.name)
+
+    def scan(self, batch_size=500):
+        """Yields the indexed keys with their values, `batch_size` at a time (None for keys that are gone)."""
+        entries = self.connection.zscan_iter(self.name, count=batch_size)
+        for batch in chunks(batch_size, entries):
+            keys = [key for key, _ in batch]
+            yield list(zip(keys, self.connection.mget(keys)))
+
+    def backfill(self, match, batch_size=500):
+        """Indexes the existing keys matching `match`, found with SCAN. Returns how many there were."""
+        count = 0
+        keys = self.connection.scan_iter(match=match, count=batch_size)
+        for batch in chunks(batch_size, keys):
+            pipe = self.connection.pipeline()
+            for key in batch:
+                pipe.ttl(key)
+            ttls = pipe.execute()
+
+            now = time.time()
+            entries = {key: now + ttl for key, ttl in zip(batch, ttls) if ttl > 0}
+            if entries:
+                self.connection.zadd(self.name, entries)
+            count += len(entries)
+
+        return count
@@ -17,7 +17,13 @@ from bi.tasks.worker import Queue
 
 
 default_operational_queues = ["periodic", "emails", "default"]
-default_query_queues = ["scheduled_queries", "queries", "schemas"]
+# Lanes of the default queues (see bi.tasks.queries.routing); they stay empty unless query
+# routing is enabled. Each has a pool of workers of its own (the fast_worker and slow_worker
+# programs of worker.conf), so long reports never hold the shared workers. The shared
+# workers still take fast lanes first.
+fast_lane_queues = ["queries_fast", "scheduled_queries_fast"]
+slow_lane_queues = ["queries_slow", "scheduled_queries_slow"]
+default_query_queues = fast_lane_queues + ["scheduled_queries", "queries", "schemas"]
 default_queues = default_operational_queues + default_query_queues
 
 
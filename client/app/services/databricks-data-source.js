@@ -4,7 +4,7 @@ import DataSource from "@/services/data-source";
 import { fetchDataFromJob } from "@/services/query-result";
 
 function fetchDataFromJobOrReturnData(data) {
-  return has(data, "job.id") ? fetchDataFromJob(data.job.id, 1000) : data;
+  return has(data, "job.id") ? fetchDataFromJob(data.job.id) : data;
 }
 
 function rejectErrorResponse(data) {
@@ -2,7 +2,7 @@ import debug from "debug";
 import moment from "moment";
 import { axios } from "@/services/axios";
 import { QueryResultError } from "@/services/query";
-import { Auth } from "@/services/auth";
+import { Auth, clientConfig } from "@/services/auth";
 import { isString, uniqBy, each, isNumber, includes, extend, forOwn, get } from "lodash";
 
 const logger = debug("redash:services:QueryResult");
@@ -100,11 +100,23 @@ function sleep(ms) {
   return new Promise(resolve => setTimeout(resolve, ms));
 }
 
-export function fetchDataFromJob(jobId, interval = 1000) {
-  return axios.get(`api/jobs/${jobId}`).then(data => {
+// Delay before the next job status request, growing while the job runs.
+function pollDelay(tryNumber) {
+  return Math.min(500 * Math.pow(1.2, tryNumber - 1), 3000);
+}
+
+// When the server long-polls (jobStatusWait, see JobResource), each job status request is also
+// held until the job changes, for at most that many seconds.
+function jobStatusParams(knownStatus) {
+  const wait = clientConfig.jobStatusWait;
+  return wait > 0 ? { wait, status: knownStatus } : {};
+}
+
+export function fetchDataFromJob(jobId, tryNumber = 1, knownStatus = undefined) {
+  return axios.get(`api/jobs/${jobId}`, { params: jobStatusParams(knownStatus) }).then(data => {
     const status = statuses[data.job.status];
     if (status === ExecutionStatus.WAITING || status === ExecutionStatus.PROCESSING) {
-      return sleep(interval).then(() => fetchDataFromJob(data.job.id));
+      return sleep(pollDelay(tryNumber)).then(() => fetchDataFromJob(data.job.id, tryNumber + 1, data.job.status));
     } else if (status === ExecutionStatus.DONE) {
       return data.job.result;
     } else if (status === ExecutionStatus.FAILED) {
@@ -333,14 +345,16 @@ class QueryResult {
     return this.deferred.promise;
   }
 
-  static getById(queryId, id) {
+  static getById(queryId, id, visualizationId = undefined) {
     const queryResult = new QueryResult();
 
     queryResult.isLoadingResult = true;
     queryResult.deferred.onStatusChange(ExecutionStatus.LOADING_RESULT);
 
+    // With a visualization id, charts that enable downsampling get their data reduced.
+    const params = visualizationId ? { visualization_id: visualizationId } : {};
     axios
-      .get(`api/queries/${queryId}/results/${id}.json`)
+      .get(`api/queries/${queryId}/results/${id}.json`, { params })
       .then(response => {
         // Success handler
         queryResult.isLoadingResult = false;
@@ -370,7 +384,13 @@ class QueryResult {
     this.isLoadingResult = true;
     this.deferred.onStatusChange(ExecutionStatus.LOADING_RESULT);
 
-    QueryResultResource.get({ id: this.job.query_result_id })
+    const request = this.visualizationId
+      ? axios.get(`api/queries/${this.queryId}/results/${this.job.query_result_id}.json`, {
+          params: { visualization_id: this.visualizationId },
+        })
+      : QueryResultResource.get({ id: this.job.query_result_id });
+
+    request
       .then(response => {
         this.update(response);
         this.isLoadingResult = false;
@@ -401,9 +421,10 @@ class QueryResult {
     const loadResult = () =>
       Auth.isAuthenticated() ? this.loadResult() : this.loadLatestCachedResult(query, parameters);
 
+    const params = jobStatusParams(this.job.status);
     const request = Auth.isAuthenticated()
-      ? axios.get(`api/jobs/${this.job.id}`)
-      : axios.get(`api/queries/${query}/jobs/${this.job.id}`);
+      ? axios.get(`api/jobs/${this.job.id}`, { params })
+      : axios.get(`api/queries/${query}/jobs/${this.job.id}`, { params });
 
     request
       .then(jobResponse => {
@@ -412,7 +433,7 @@ class QueryResult {
         if (this.getStatus() === "processing" && this.job.query_result_id && this.job.query_result_id !== "None") {
           loadResult();
         } else if (this.getStatus() !== "failed") {
-          const waitTime = tryNumber > 10 ? 3000 : 500;
+          const waitTime = pollDelay(tryNumber);
           setTimeout(() => {
             this.refreshStatus(query, parameters, tryNumber + 1);
           }, waitTime);
@@ -442,11 +463,19 @@ class QueryResult {
     return `${queryName.replace(/ /g, "_") + moment(this.getUpdatedAt()).format("_YYYY_MM_DD")}.${fileType}`;
   }
 
-  static getByQueryId(id, parameters, applyAutoLimit, maxAge) {
+  static getByQueryId(id, parameters, applyAutoLimit, maxAge, visualizationId = undefined) {
     const queryResult = new QueryResult();
+    queryResult.queryId = id;
+    queryResult.visualizationId = visualizationId;
 
     axios
-      .post(`api/queries/${id}/results`, { id, parameters, apply_auto_limit: applyAutoLimit, max_age: maxAge })
+      .post(`api/queries/${id}/results`, {
+        id,
+        parameters,
+        apply_auto_limit: applyAutoLimit,
+        max_age: maxAge,
+        visualization_id: visualizationId,
+      })
       .then(response => {
         queryResult.update(response);
 
@@ -88,7 +88,7 @@ export class Query {
     return this.getParametersDefs().length > 0;
   }
 
-  prepareQueryResultExecution(execute, maxAge) {
+  prepareQueryResultExecution(execute, maxAge, visualizationId = undefined) {
     const parameters = this.getParameters();
     const missingParams = parameters.getMissing();
 
@@ -122,7 +122,7 @@ export class Query {
       }
     } else if (this.latest_query_data_id && maxAge !== 0) {
       if (!this.queryResult) {
-        this.queryResult = QueryResult.getById(this.id, this.latest_query_data_id);
+        this.queryResult = QueryResult.getById(this.id, this.latest_query_data_id, visualizationId);
       }
     } else {
       this.queryResult = execute();
@@ -131,10 +131,16 @@ export class Query {
     return this.queryResult;
   } 
 
-  getQueryResult(maxAge) {
+  getQueryResult(maxAge, visualizationId = undefined) {
     const execute = () =>
-      QueryResult.getByQueryId(this.id, this.getParameters().getExecutionValues(), this.getAutoLimit(), maxAge);
-    return this.prepareQueryResultExecution(execute, maxAge);
+      QueryResult.getByQueryId(
+        this.id,
+        this.getParameters().getExecutionValues(),
+        this.getAutoLimit(),
+        maxAge,
+        visualizationId
+      );
+    return this.prepareQueryResultExecution(execute, maxAge, visualizationId);
   }
 
   getQueryResultByText(maxAge, selectedQueryText) {
@@ -2,6 +2,7 @@ import moment from "moment";
 import { axios } from "@/services/axios";
 import {
   each,
+  get,
   pick,
   extend,
   isObject,
@@ -134,6 +135,15 @@ class Widget {
     return this.data;
   }
 
+  // Charts that enable downsampling have their data reduced by the server.
+  getDownsampledVisualizationId() {
+    const visualization = this.visualization;
+    if (visualization && visualization.type === "CHART" && get(visualization, "options.downsampling.enabled")) {
+      return visualization.id;
+    }
+    return undefined;
+  }
+
   getName() {
     if (this.visualization) {
       return `${this.visualization.query.name} (${this.visualization.name})`;
@@ -159,7 +169,7 @@ class Widget {
         maxAge = force ? 0 : undefined;
       }
 
-      const queryResult = this.getQuery().getQueryResult(maxAge);
+      const queryResult = this.getQuery().getQueryResult(maxAge, this.getDownsampledVisualizationId());
       this.queryResult = queryResult;
 
       queryResult
@@ -0,0 +1,53 @@
+import datetime
+from unittest import TestCase
+
+from bi.query_runner import TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER, TYPE_STRING
+from bi.query_runner.mongodb import parse_results
+
+
+class TestParseResults(TestCase):
+    def test_flattens_rows_and_collects_columns_in_order(self):
+        rows, columns, truncated = parse_results(
+            [{"a": 1, "b": "x"}, {"b": "y", "c": 1.5}]
+        )
+
+        self.assertEqual([{"a": 1, "b": "x"}, {"b": "y", "c": 1.5}], rows)
+        self.assertEqual(["a", "b", "c"], [column["name"] for column in columns])
+        self.assertEqual(
+            [TYPE_INTEGER, TYPE_STRING, TYPE_FLOAT], [column["type"] for column in columns]
+        )
+        self.assertFalse(truncated)
+
+    def test_column_type_comes_from_first_value(self):
+        now = datetime.datetime(2023, 1, 1)
+        _, columns, _ = parse_results([{"at": now}, {"at": "later"}])
+        self.assertEqual(TYPE_DATETIME, columns[0]["type"])
+
+    def test_unknown_types_are_strings(self):
+        _, columns, _ = parse_results([{"tags": ["a", "b"]}])
+        self.assertEqual(TYPE_STRING, columns[0]["type"])
+
+    def test_flattens_nested_documents_to_max_depth(self):
+        document = {"a": {"b": 1, "c": {"d": 2}}}
+
+        rows, columns, _ = parse_results([document])
+        self.assertEqual([{"a.b": 1, "a.c": {"d": 2}}], rows)
+        self.assertEqual(["a.b", "a.c"], [column["name"] for column in columns])
+
+        rows, _, _ = parse_results([document], max_depth=2)
+        self.assertEqual([{"a.b": 1, "a.c.d": 2}], rows)
+
+        rows, _, _ = parse_results([document], max_depth=0)
+        self.assertEqual([document], rows)
+
+    def test_stops_at_max_rows(self):
+        rows, _, truncated = parse_results(({"i": i} for i in range(10)), max_rows=3)
+
+        self.assertEqual([{"i": 0}, {"i": 1}, {"i": 2}], rows)
+        self.assertTrue(truncated)
+
+    def test_not_truncated_at_exactly_max_rows(self):
+        rows, _, truncated = parse_results([{"i": 0}, {"i": 1}], max_rows=2)
+
+        self.assertEqual(2, len(rows))
+        self.assertFalse(truncated)
@@ -0,0 +1,124 @@
+from unittest import TestCase
+
+from bi.utils import columnar, json_dumps
+
+
+def make_result(rows=3):
+    return {
+        "columns": [
+            {"name": "id", "friendly_name": "id", "type": "integer"},
+            {"name": "name", "friendly_name": "name", "type": "string"},
+        ],
+        "rows": [{"id": i, "name": "row {}".format(i)} for i in range(rows)],
+        "truncated": False,
+    }
+
+
+class TestToColumns(TestCase):
+    def test_splits_rows_into_column_lists(self):
+        body = columnar.to_columns(make_result())
+
+        self.assertEqual(3, body["length"])
+        self.assertEqual([[0, 1, 2], ["row 0", "row 1", "row 2"]], body["values"])
+        self.assertEqual({"truncated": False}, body["extra"])
+
+    def test_round_trips(self):
+        data = make_result()
+        self.assertEqual(data, columnar.from_columns(columnar.to_columns(data)))
+
+    def test_returns_none_for_rows_missing_columns(self):
+        data = make_result()
+        del data["rows"][1]["name"]
+        self.assertIsNone(columnar.to_columns(data))
+
+    def test_returns_none_for_rows_with_extra_keys(self):
+        data = make_result()
+        data["rows"][1]["other"] = 1
+        self.assertIsNone(columnar.to_columns(data))
+
+    def test_returns_none_for_duplicate_column_names(self):
+        data = make_result()
+        data["columns"].append({"name": "id"})
+        self.assertIsNone(columnar.to_columns(data))
+
+    def test_keeps_row_count_without_columns(self):
+        data = {"columns": [], "rows": [{}, {}]}
+        self.assertEqual(data, columnar.from_columns(columnar.to_columns(data)))
+
+
+class TestDumpsLoads(TestCase):
+    def test_round_trips_with_every_codec(self):
+        data = make_result(100)
+        for codec in columnar.codecs:
+            payload = columnar.dumps(data, codec)
+            self.assertTrue(columnar.is_columnar(payload))
+            self.assertEqual(data, columnar.loads(payload))
+
+    def test_falls_back_to_zlib_for_unavailable_codecs(self):
+        payload = columnar.dumps(make_result(), "unknown")
+        self.assertTrue(payload.startswith("columnar:{}:zlib:".format(columnar.FORMAT_VERSION)))
+
+    def test_keeps_irregular_results_as_row_json(self):
+        data = make_result()
+        del data["rows"][0]["name"]
+
+        payload = columnar.dumps(data)
+
+        self.assertFalse(columnar.is_columnar(payload))
+        self.assertEqual(data, columnar.loads(payload))
+
+    def test_loads_legacy_row_json(self):
+        data = make_result()
+        self.assertEqual(data, columnar.loads(json_dumps(data)))
+
+    def test_rejects_newer_format_versions(self):
+        payload = "columnar:{}:zlib:".format(columnar.FORMAT_VERSION + 1)
+        with self.assertRaises(ValueError):
+            columnar.loads(payload)
+
+
+class TestSlicing(TestCase):
+    def setUp(self):
+        self.data = make_result(25)
+        self.body = columnar.to_columns(self.data)
+        self.payload = columnar.dump_body(self.body, "zlib", group_size=10)
+
+    def expected(self, offset, limit, names=None):
+        end = None if limit is None else offset + limit
+        return [
+            {k: v for k, v in row.items() if names is None or k in names}
+            for row in self.data["rows"][offset:end]
+        ]
+
+    def test_slice_body(self):
+        page = columnar.slice_body(self.body, 5, 3)
+
+        self.assertEqual(self.expected(5, 3), page["rows"])
+        self.assertEqual(25, page["total_rows"])
+        self.assertFalse(page["truncated"])
+
+    def test_slice_body_selects_columns(self):
+        page = columnar.slice_body(self.body, 0, 2, {"name"})
+
+        self.assertEqual(["name"], [column["name"] for column in page["columns"]])
+        self.assertEqual(self.expected(0, 2, {"name"}), page["rows"])
+
+    def test_slice_payload_across_row_groups(self):
+        for offset, limit in [(0, None), (0, 10), (8, 5), (10, 10), (19, 100), (25, 5), (40, 5)]:
+            page = columnar.slice_payload(self.payload, offset, limit)
+            self.assertEqual(self.expected(offset, limit), page["rows"], (offset, limit))
+            self.assertEqual(25, page["total_rows"])
+
+    def test_slice_payload_matches_slice_body(self):
+        for offset, limit, names in [(3, 4, {"id"}), (12, 0, None), (0, 5, set())]:
+            self.assertEqual(
+                columnar.slice_body(self.body, offset, limit, names),
+                columnar.slice_payload(self.payload, offset, limit, names),
+            )
+
+    def test_slice_payload_reads_version_1(self):
+        body = columnar._encode_segment("zlib", self.body)
+        payload = "columnar:1:zlib:{}".format(body)
+
+        self.assertEqual(self.body, columnar.load_body(payload))
+        self.assertEqual(self.expected(5, 3), columnar.slice_payload(payload, 5, 3)["rows"])
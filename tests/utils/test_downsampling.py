@@ -0,0 +1,150 @@
+from unittest import TestCase
+
+import numpy as np
+
+from bi.utils import columnar
+from bi.utils.downsampling import OTHER_LABEL, downsample, downsampling_options, grid_sample, lttb
+
+
+def make_body(rows, names):
+    return columnar.to_columns(
+        {"columns": [{"name": name} for name in names], "rows": rows}
+    )
+
+
+def chart_options(chart_type, mapping, **downsampling):
+    downsampling["enabled"] = True
+    return {
+        "globalSeriesType": chart_type,
+        "columnMapping": mapping,
+        "downsampling": downsampling,
+    }
+
+
+class TestDownsamplingOptions(TestCase):
+    def test_none_unless_enabled(self):
+        self.assertIsNone(downsampling_options(None))
+        self.assertIsNone(downsampling_options({"downsampling": {"enabled": False}}))
+
+    def test_uses_chart_settings(self):
+        options = downsampling_options({"downsampling": {"enabled": True, "maxPoints": 50, "topN": 4}})
+        self.assertEqual({"maxPoints": 50, "topN": 4}, options)
+
+
+class TestLttb(TestCase):
+    def test_keeps_every_point_under_threshold(self):
+        x = np.arange(10, dtype=np.float64)
+        self.assertEqual(list(range(10)), list(lttb(x, x, 20)))
+
+    def test_keeps_endpoints_and_peaks(self):
+        x = np.arange(1000, dtype=np.float64)
+        y = np.zeros(1000)
+        y[500] = 100
+
+        kept = lttb(x, y, 20)
+
+        self.assertEqual(20, len(kept))
+        self.assertEqual(0, kept[0])
+        self.assertEqual(999, kept[-1])
+        self.assertIn(500, kept)
+
+
+class TestGridSample(TestCase):
+    def test_keeps_every_point_under_max(self):
+        x = np.arange(5, dtype=np.float64)
+        self.assertEqual(list(range(5)), list(grid_sample(x, x, 10)))
+
+    def test_keeps_one_point_per_cell(self):
+        x = np.repeat([0.0, 1.0], 500)
+        y = np.repeat([0.0, 1.0], 500)
+
+        self.assertEqual([0, 500], list(grid_sample(x, y, 4)))
+
+    def test_skips_missing_values(self):
+        x = np.array([0.0, np.nan, 1.0])
+        self.assertEqual([0, 2], list(grid_sample(x, x, 10)))
+
+
+class TestDownsample(TestCase):
+    def test_none_when_disabled(self):
+        body = make_body([{"x": 1, "y": 2}], ["x", "y"])
+        self.assertIsNone(downsample(body, {"globalSeriesType": "line"}))
+
+    def test_none_when_small_enough(self):
+        body = make_body([{"x": i, "y": i} for i in range(10)], ["x", "y"])
+        options = chart_options("line", {"x": "x", "y": "y"}, maxPoints=20)
+        self.assertIsNone(downsample(body, options))
+
+    def test_line_per_series(self):
+        rows = [{"x": i, "y": i % 7, "s": "ab"[i % 2]} for i in range(1000)]
+        options = chart_options("line", {"x": "x", "y": "y", "s": "series"}, maxPoints=50)
+
+        reduced = downsample(make_body(rows, ["x", "y", "s"]), options)
+
+        self.assertEqual({"method": "lttb", "original_rows": 1000}, reduced["downsampling"])
+        self.assertEqual(100, len(reduced["rows"]))
+        for series in "ab":
+            xs = [row["x"] for row in reduced["rows"] if row["s"] == series]
+            self.assertEqual(50, len(xs))
+            self.assertEqual(sorted(xs), xs)
+
+    def test_line_with_dates(self):
+        rows = [
+            {"x": "2023-01-01T00:{:02d}:{:02d}".format(i // 60, i % 60), "y": i}
+            for i in range(600)
+        ]
+        options = chart_options("line", {"x": "x", "y": "y"}, maxPoints=30)
+
+        reduced = downsample(make_body(rows, ["x", "y"]), options)
+
+        self.assertEqual(30, len(reduced["rows"]))
+        self.assertEqual(rows[0], reduced["rows"][0])
+        self.assertEqual(rows[-1], reduced["rows"][-1])
+
+    def test_scatter_with_categories(self):
+        rows = [{"x": "c{}".format(i % 3), "y": i % 5} for i in range(1000)]
+        options = chart_options("scatter", {"x": "x", "y": "y"}, maxPoints=100)
+
+        reduced = downsample(make_body(rows, ["x", "y"]), options)
+
+        self.assertEqual("grid", reduced["downsampling"]["method"])
+        self.assertEqual(15, len(reduced["rows"]))
+
+    def test_pie_keeps_top_slices_per_series(self):
+        rows = [{"label": "l{}".format(i % 10), "value": i, "s": "ab"[i // 50]} for i in range(100)]
+        options = chart_options("pie", {"label": "x", "value": "y", "s": "series"}, topN=2)
+
+        reduced = downsample(make_body(rows, ["label", "value", "s"]), options)
+
+        self.assertEqual(
+            [
+                {"label": "l9", "s": "a", "value": 145.0},
+                {"label": "l8", "s": "a", "value": 140.0},
+                {"label": OTHER_LABEL, "s": "a", "value": 940.0},
+                {"label": "l9", "s": "b", "value": 395.0},
+                {"label": "l8", "s": "b", "value": 390.0},
+                {"label": OTHER_LABEL, "s": "b", "value": 2940.0},
+            ],
+            reduced["rows"],
+        )
+
+    def test_pie_keeps_groups_with_few_slices(self):
+        rows = [{"label": "l{}".format(i % 5), "value": i, "s": "a"} for i in range(50)]
+        rows += [{"label": "only", "value": 1, "s": "b"}]
+        options = chart_options("pie", {"label": "x", "value": "y", "s": "series"}, topN=2)
+
+        reduced = downsample(make_body(rows, ["label", "value", "s"]), options)
+
+        self.assertEqual(4, len(reduced["rows"]))
+        self.assertEqual(rows[-1], reduced["rows"][-1])
+
+    def test_keeps_result_fields(self):
+        rows = [{"x": i, "y": i} for i in range(100)]
+        body = make_body(rows, ["x", "y"])
+        body["extra"] = {"truncated": True}
+        options = chart_options("line", {"x": "x", "y": "y"}, maxPoints=10)
+
+        reduced = downsample(body, options)
+
+        self.assertTrue(reduced["truncated"])
+        self.assertEqual([{"name": "x"}, {"name": "y"}], reduced["columns"])
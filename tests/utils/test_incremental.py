@@ -0,0 +1,131 @@
+from collections import namedtuple
+from unittest import TestCase
+
+from bi.query_runner import BaseSQLQueryRunner
+from bi.utils.incremental import WATERMARK_KEY, incremental_options, merge, watermark
+
+Query = namedtuple("Query", ["id", "options"])
+
+
+def make_result(rows, column_type="integer"):
+    return {
+        "columns": [
+            {"name": "id", "type": column_type},
+            {"name": "value", "type": "string"},
+        ],
+        "rows": [{"id": id, "value": "v{}".format(id)} for id in rows],
+    }
+
+
+class TestIncrementalOptions(TestCase):
+    def test_none_without_watermark_column(self):
+        self.assertIsNone(incremental_options(Query(1, {})))
+        self.assertIsNone(incremental_options(Query(1, {"incremental": {}})))
+        self.assertIsNone(incremental_options(None))
+
+    def test_returns_options(self):
+        options = {"watermark_column": "id"}
+        self.assertEqual(options, incremental_options(Query(1, {"incremental": options})))
+
+    def test_none_when_column_is_missing_from_previous_result(self):
+        query = Query(1, {"incremental": {"watermark_column": "created_at"}})
+        self.assertIsNone(incremental_options(query, make_result([1, 2])))
+
+    def test_none_for_retention_on_string_column(self):
+        query = Query(1, {"incremental": {"watermark_column": "value", "retention": 10}})
+        self.assertIsNone(incremental_options(query, make_result([1, 2])))
+
+    def test_allows_retention_on_numeric_column(self):
+        options = {"watermark_column": "id", "retention": 10}
+        query = Query(1, {"incremental": options})
+        self.assertEqual(options, incremental_options(query, make_result([1, 2])))
+
+
+class TestWatermark(TestCase):
+    def test_highest_value(self):
+        self.assertEqual(3, watermark(make_result([2, 3, 1]), "id"))
+
+    def test_ignores_nulls(self):
+        self.assertEqual(2, watermark(make_result([None, 2, None]), "id"))
+
+    def test_none_without_rows(self):
+        self.assertIsNone(watermark(make_result([]), "id"))
+
+    def test_compares_date_strings_as_dates(self):
+        data = {
+            "columns": [{"name": "at", "type": "datetime"}],
+            "rows": [
+                {"at": "2023-01-02T00:00:00+00:00"},
+                {"at": "2023-01-10T00:00:00+00:00"},
+                {"at": "2023-01-03T00:00:00+00:00"},
+            ],
+        }
+        self.assertEqual("2023-01-10T00:00:00+00:00", watermark(data, "at"))
+
+    def test_uses_stored_watermark(self):
+        data = make_result([1, 2])
+        data[WATERMARK_KEY] = 10
+        self.assertEqual(10, watermark(data, "id"))
+
+
+class TestMerge(TestCase):
+    def test_appends_rows_and_records_watermark(self):
+        merged = merge(make_result([1, 2]), make_result([3, 4]), "id")
+
+        self.assertEqual([1, 2, 3, 4], [row["id"] for row in merged["rows"]])
+        self.assertEqual(4, merged[WATERMARK_KEY])
+
+    def test_keeps_previous_watermark_when_delta_is_empty(self):
+        merged = merge(make_result([1, 2]), make_result([]), "id")
+        self.assertEqual(2, merged[WATERMARK_KEY])
+
+    def test_applies_numeric_retention(self):
+        merged = merge(make_result([1, 5, 8]), make_result([10]), "id", retention=5)
+        self.assertEqual([5, 8, 10], [row["id"] for row in merged["rows"]])
+
+    def test_applies_date_retention_in_seconds(self):
+        def result(dates):
+            return {
+                "columns": [{"name": "at", "type": "datetime"}],
+                "rows": [{"at": "2023-01-{:02d}T00:00:00".format(day)} for day in dates],
+            }
+
+        merged = merge(result([1, 2, 3]), result([4]), "at", retention=2 * 86400)
+        self.assertEqual(
+            ["2023-01-02T00:00:00", "2023-01-03T00:00:00", "2023-01-04T00:00:00"],
+            [row["at"] for row in merged["rows"]],
+        )
+
+    def test_none_when_columns_differ(self):
+        delta = make_result([3])
+        delta["columns"].append({"name": "other", "type": "string"})
+        self.assertIsNone(merge(make_result([1]), delta, "id"))
+
+    def test_none_when_delta_is_truncated(self):
+        delta = make_result([3])
+        delta["truncated"] = True
+        self.assertIsNone(merge(make_result([1]), delta, "id"))
+
+
+class TestApplyWatermark(TestCase):
+    def setUp(self):
+        self.runner = BaseSQLQueryRunner({})
+
+    def test_wraps_query(self):
+        self.assertEqual(
+            'SELECT * FROM (\nSELECT * FROM events\n) AS incremental_source WHERE "id" > 10',
+            self.runner.apply_watermark("SELECT * FROM events", "id", 10),
+        )
+
+    def test_quotes_string_watermarks(self):
+        query = self.runner.apply_watermark("SELECT * FROM events", "created_at", "2023-01-01'")
+        self.assertTrue(query.endswith("WHERE \"created_at\" > '2023-01-01'''"))
+
+    def test_quotes_column_names(self):
+        query = self.runner.apply_watermark("SELECT * FROM events", 'a"b', 1)
+        self.assertIn('WHERE "a""b" > 1', query)
+
+    def test_only_wraps_last_statement(self):
+        query = self.runner.apply_watermark("SET x = 1; SELECT * FROM events", "id", 1)
+        self.assertTrue(query.startswith("SET x = 1;"))
+        self.assertIn("SELECT * FROM (\nSELECT * FROM events\n)", query)
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+from bi.utils import canonical_query_text, gen_legacy_query_hash, gen_query_hash
+
+
+class TestCanonicalQueryText(TestCase):
+    def test_joins_tokens_with_single_spaces(self):
+        self.assertEqual(
+            "select a , b from t where a = 1",
+            canonical_query_text("SELECT a,\n       b\nFROM   t\nWHERE a=1"),
+        )
+
+    def test_drops_comments(self):
+        self.assertEqual(
+            "select 1",
+            canonical_query_text("-- count\nSELECT /* inline */ 1 # trailing"),
+        )
+
+    def test_drops_trailing_semicolons(self):
+        self.assertEqual("select 1", canonical_query_text("select 1;;"))
+        self.assertEqual(
+            "select 1 ; select 2", canonical_query_text("select 1; select 2;")
+        )
+
+    def test_lower_cases_keywords_and_unquoted_names(self):
+        self.assertEqual(
+            canonical_query_text("SELECT Name FROM Users"),
+            canonical_query_text("select name from users"),
+        )
+
+    def test_keeps_string_literals(self):
+        self.assertEqual(
+            "select * from t where name = 'Bob'",
+            canonical_query_text("SELECT * FROM t WHERE name = 'Bob'"),
+        )
+        self.assertNotEqual(
+            canonical_query_text("select 'A'"), canonical_query_text("select 'a'")
+        )
+
+    def test_keeps_whitespace_inside_literals(self):
+        self.assertNotEqual(
+            canonical_query_text("select 'a  b'"), canonical_query_text("select 'a b'")
+        )
+
+    def test_keeps_quoted_identifiers(self):
+        self.assertEqual('select "Foo" from t', canonical_query_text('select "Foo" from t'))
+        self.assertEqual("select `Foo` from t", canonical_query_text("select `Foo` from t"))
+        self.assertNotEqual(
+            canonical_query_text('select "Foo"'), canonical_query_text('select "foo"')
+        )
+
+
+class TestGenQueryHash(TestCase):
+    def test_formatting_does_not_change_hash(self):
+        self.assertEqual(
+            gen_query_hash("SELECT 1 -- one"), gen_query_hash("select\n  1;")
+        )
+
+    def test_literals_change_hash(self):
+        self.assertNotEqual(
+            gen_query_hash("select * from t where a = 'x y'"),
+            gen_query_hash("select * from t where a = 'xy'"),
+        )
+
+    def test_legacy_hash_ignores_all_whitespace_and_case(self):
+        self.assertEqual(
+            gen_legacy_query_hash("SELECT 'A B'"), gen_legacy_query_hash("select 'ab'")
+        )
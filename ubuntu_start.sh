@@ -10,6 +10,8 @@ echo $! >./user_upload_files/.web.pid.txt
 echo $! >./user_upload_files/.scheduler.pid.txt
 ./bin/run ./manage.py rq worker  >./log/worker.log 2>&1 &
 echo $! >./user_upload_files/.worker.pid.txt
+./bin/run ./manage.py rq worker queries_slow,scheduled_queries_slow >./log/slow_worker.log 2>&1 &
+echo $! >./user_upload_files/.slow_worker.pid.txt
 ./bin/run ./manage.py run_ai  >./log/ai.log 2>&1 &
 echo $! >./user_upload_files/.ai.pid.txt
 ./bin/run ./manage.py run_ai_api  >./log/run_ai_api.log 2>&1 &
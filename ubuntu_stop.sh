@@ -9,6 +9,8 @@ pid=$(cat ./user_upload_files/.scheduler.pid.txt)
 kill $pid
 pid=$(cat ./user_upload_files/.worker.pid.txt)
 kill $pid
+pid=$(cat ./user_upload_files/.slow_worker.pid.txt)
+kill $pid
 pid=$(cat ./user_upload_files/.ai.pid.txt)
 kill $pid
 pid=$(cat ./user_upload_files/.run_ai_api.pid.txt)